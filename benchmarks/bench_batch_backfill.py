@@ -0,0 +1,55 @@
+import json
+import time
+
+from types import SimpleNamespace
+
+from model.batch_backend import GeminiBatch
+from benchmarks.fake_gmail import make_mailbox
+from benchmarks.fake_gemini_batch import FakeGeminiBatchClient
+from email_service.email_grabber import EmailGrabber
+
+# Runs a historical backfill through the batch backend against the fake batch endpoint, and compares the
+# number of gemini api calls with one generate_content call per receipt.
+# Run from the repo root with: python -m benchmarks.bench_batch_backfill
+
+SENDER = "ticket-caisse@e-ticket.cooperative-u.fr"
+
+
+def responder(pdf: bytes) -> str:
+    n = int(pdf.rsplit(b" ", 1)[-1])
+    if n % 97 == 0:
+        raise RuntimeError("model error")
+    return json.dumps({f"ITEM {n}": {"quantity": 1, "price": n / 100}})
+
+
+def gemini_stand_in():
+    # the bits of the Gemini wrapper the batch backend reads, without needing an api key
+    stand_in = SimpleNamespace(
+        model_name="gemini-2.5-flash-lite",
+        temperature=0.2,
+        system_instruction="",
+        cache=None,
+        from_cache=lambda payload: None,
+    )
+    stand_in.fingerprint = lambda: f"{stand_in.model_name} t={stand_in.temperature!r}"
+    return stand_in
+
+
+def run(n: int):
+    grabber = EmailGrabber(credentials=None, senders=[SENDER], service=make_mailbox(n, SENDER))
+    client = FakeGeminiBatchClient(responder)
+    backend = GeminiBatch(gemini_stand_in(), client=client, poll_interval=0)
+
+    start = time.perf_counter()
+    results = list(backend.run(grabber.iter_historical_messages()))
+    elapsed = time.perf_counter() - start
+
+    assert len(results) == n
+    assert all(a[0]["internal_ms"] <= b[0]["internal_ms"] for a, b in zip(results, results[1:]))
+    failed = sum(1 for _, mo in results if mo is None)
+    print(f"{n:>5} receipts | {n:>5} calls per receipt | {client.calls:>2} calls batched | {failed} failed | {elapsed:5.2f}s")
+
+
+if __name__ == "__main__":
+    for n in (100, 1000):
+        run(n)
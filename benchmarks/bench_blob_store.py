@@ -0,0 +1,92 @@
+import os
+import time
+import random
+import tempfile
+
+from email_service.blob_store import BlobStore
+from email_service.email_grabber import EmailGrabber
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.fake_receipts import make_receipt
+
+# Compares a setup.py fetch of the whole mailbox without the local pdf store, with it empty (first run) and with it
+# filled (every run after): time, gmail round trips and bytes over the wire. Then reads every stored receipt back
+# offline, the way a re-extraction does, and fills a small store past its size to show eviction and compaction.
+# Run from the repo root with: python -m benchmarks.bench_blob_store
+
+SENDER = "ticket-caisse@e-ticket.cooperative-u.fr"
+RECEIPTS = 1000
+LATENCY = 0.005  # seconds per round trip
+# about the size of a real U e-ticket pdf
+PDF_BYTES = 40_000
+
+
+def receipt_pdf(i: int) -> bytes:
+    pdf, _ = make_receipt(i)
+    return pdf + random.Random(i).randbytes(PDF_BYTES - len(pdf))
+
+
+def mailbox(n: int) -> FakeGmailService:
+    service = FakeGmailService(latency=LATENCY)
+    for i in range(n):
+        service.add_receipt(f"m{i:06d}", SENDER, 1_700_000_000_000 + i * 3_600_000, pdf=receipt_pdf(i))
+    return service
+
+
+def fetch(service: FakeGmailService, blobs) -> dict:
+    trips, received = service.round_trips, service.bytes_received
+    grabber = EmailGrabber(credentials=None, senders=[SENDER], service=service, blobs=blobs)
+    start = time.perf_counter()
+    payloads = grabber.ingest_historical_messages()
+    return {
+        "seconds": time.perf_counter() - start,
+        "receipts": len(payloads),
+        "round_trips": service.round_trips - trips,
+        "mb": (service.bytes_received - received) / 2**20,
+        "pdfs": sorted((p["message_id"], p["pdf_sha256"], p["file_data"]) for p in payloads),
+    }
+
+
+def run_fetch(directory: str):
+    service = mailbox(RECEIPTS)
+    runs = [("no store", fetch(service, None))]
+    blobs = BlobStore(os.path.join(directory, "pdfs"))
+    runs.append(("store, first run", fetch(service, blobs)))
+    runs.append(("store, next runs", fetch(service, blobs)))
+    assert all(r["pdfs"] == runs[0][1]["pdfs"] for _, r in runs), "the stored pdfs differ from gmail's"
+    for name, r in runs:
+        print(f"{name:<17} | {r['receipts']} receipts in {r['seconds']:6.2f}s | {r['round_trips']:>4} round trips | "
+              f"{r['mb']:6.2f} MB from gmail")
+
+    start = time.perf_counter()
+    read = sum(len(p["file_data"]) for p in blobs.iter_payloads())
+    elapsed = time.perf_counter() - start
+    print(f"{'offline read':<17} | {RECEIPTS} receipts in {elapsed:6.2f}s | {read / 2**20 / elapsed:7.0f} MB/s from the memory maps")
+    blobs.close()
+
+
+def run_compaction(directory: str):
+    # room for about half the receipts, in packs of about 50
+    blobs = BlobStore(os.path.join(directory, "small"), max_bytes=RECEIPTS // 2 * PDF_BYTES, pack_bytes=50 * PDF_BYTES)
+    rng = random.Random(0)
+    for i in range(RECEIPTS):
+        blobs.put(f"m{i:06d}", f"a{i}", receipt_pdf(i), internal_ms=i)
+        # a re-extraction reading back older receipts now and then, so what gets evicted is spread over the packs
+        if i % 4 == 0:
+            blobs.payload(f"m{rng.randrange(i + 1):06d}")
+    before = blobs.stats()
+    start = time.perf_counter()
+    result = blobs.compact()
+    elapsed = time.perf_counter() - start
+    after = blobs.stats()
+    print(f"{'eviction':<17} | {RECEIPTS} pdfs put, {before['pdfs']} kept ({before['bytes'] / 2**20:.1f} MB), "
+          f"{before['packs']} packs, {before['disk_bytes'] / 2**20:.1f} MB on disk")
+    print(f"{'compaction':<17} | {result['packs_rewritten']} packs rewritten in {elapsed:.2f}s, "
+          f"{after['packs']} packs, {after['disk_bytes'] / 2**20:.1f} MB on disk")
+    assert after["pdfs"] == before["pdfs"] and len(list(blobs.iter_payloads())) == before["pdfs"]
+    blobs.close()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        run_fetch(directory)
+        run_compaction(directory)
@@ -0,0 +1,49 @@
+import os
+import time
+
+from datetime import date
+
+from model.local_extractor import LocalExtractor
+from pipeline.cpu_stage import CpuStage
+from benchmarks.fake_receipts import make_receipt
+
+# Compares reading the pdf text layers inline against the process pool cpu stage, at 1, 2, 4, ... workers
+# up to the number of cores. Run from the repo root with: python -m benchmarks.bench_cpu_stage
+
+SENDER = "ticket-caisse@e-ticket.cooperative-u.fr"
+
+
+def make_payloads(n: int):
+    return [
+        {"file_data": make_receipt(i)[0], "date": date(2024, 1, 1), "message_id": f"m{i:06d}", "sender": SENDER}
+        for i in range(n)
+    ]
+
+
+def run(n: int):
+    payloads = make_payloads(n)
+
+    local = LocalExtractor()
+    start = time.perf_counter()
+    for p in payloads:
+        local.extract(p)
+    inline = time.perf_counter() - start
+    print(f"{'inline':>10} | {n:>5} receipts | {n / inline:8.1f} receipts/s")
+
+    cores = os.cpu_count() or 1
+    workers = 1
+    while workers <= cores:
+        local = LocalExtractor()
+        stage = CpuStage(local=local, workers=workers)
+        start = time.perf_counter()
+        hits = sum(1 for p in stage.run(dict(p) for p in payloads) if p["local_output"] is not None)
+        elapsed = time.perf_counter() - start
+        assert hits == n
+        print(f"{workers:>2} workers | {n:>5} receipts | {n / elapsed:8.1f} receipts/s | {inline / elapsed:4.1f}x inline")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    print(f"{os.cpu_count()} cores")
+    for n in (1000, 5000):
+        run(n)
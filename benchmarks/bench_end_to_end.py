@@ -0,0 +1,213 @@
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import resource
+import subprocess
+import contextlib
+
+from typing import Any, Dict, List, Tuple
+
+from email_service.email_grabber import EmailGrabber
+from model.local_extractor import LocalExtractor
+from pipeline.extraction import ExtractionPipeline
+from pipeline.cpu_stage import CpuStage
+from pipeline.committer import BatchCommitter
+from writers.sqlite_writer import SQLiteWriter
+from utils import metrics
+from utils.rate_limiter import RateLimiter
+from utils.token_bucket import TokenBucket
+from utils.utils import load_config
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.fake_gemini import replay_gemini, load_outputs
+from benchmarks.fake_receipts import make_receipt
+from benchmarks.bench_excel_append import build_workbook
+
+# Runs the whole backfill (what setup.py does) offline: gmail listing and downloads from a fake mailbox, the
+# local extractor and the cpu stage, the real Gemini wrapper answering from canned outputs, and the committer
+# writing to the local store and a pre-populated workbook. Each mailbox size runs in a fresh process, and
+# reports receipts per second, peak RSS, and the time per stage from utils/metrics.py.
+#
+# The mailboxes are synthetic (make_receipt pdfs, a share of them from a sender without a known layout so they go
+# to the model), or replayed from fixtures recorded with benchmarks/record_fixtures.py.
+#
+# Run from the repo root with: python -m benchmarks.bench_end_to_end [--sizes 100 1000 10000] [--gmail-429 0.05]
+# --save results.json keeps the numbers, and --compare results.json fails if receipts per second dropped by more
+# than --tolerance since then.
+
+KNOWN = "ticket-caisse@e-ticket.cooperative-u.fr"
+UNKNOWN = "receipts@other-shop.example"
+STAGES = ["gmail_call", "gemini_call", "local_extract", "store_write", "xlsx_sync"]
+
+
+def synthetic_mailbox(n: int, unknown_share: float, **kwargs) -> Tuple[FakeGmailService, Dict[str, str]]:
+    """
+    n receipts one hour apart, every 1/unknown_share-th of them from a sender without a template. Returns the
+    mailbox and the model's answer for every pdf.
+    """
+    service = FakeGmailService(**kwargs)
+    outputs: Dict[str, str] = {}
+    every = round(1 / unknown_share) if unknown_share else 0
+    for i in range(n):
+        pdf, expected = make_receipt(i)
+        sender = UNKNOWN if every and i % every == 0 else KNOWN
+        service.add_receipt(f"m{i:06d}", sender, 1_700_000_000_000 + i * 3_600_000, pdf=pdf)
+        outputs[hashlib.sha256(pdf).hexdigest()] = json.dumps({item: {"quantity": q, "price": p} for item, q, p in expected}, ensure_ascii=False)
+    return service, outputs
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_once(n: int, args: argparse.Namespace, directory: str) -> Dict[str, Any]:
+    service_kwargs = {"latency": args.gmail_latency, "throttle_rate": args.gmail_429, "retry_after": args.retry_after}
+    if args.fixtures:
+        service = FakeGmailService.load(os.path.join(args.fixtures, "gmail.json.gz"), **service_kwargs)
+        outputs = load_outputs(os.path.join(args.fixtures, "gemini.json.gz"))
+        senders = sorted({h["value"] for m in service.messages.values() for h in m["payload"]["headers"] if h["name"] == "From"})
+    else:
+        service, outputs = synthetic_mailbox(n, args.unknown_share, **service_kwargs)
+        senders = [KNOWN, UNKNOWN]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        excel_writer = build_workbook(directory, args.workbook_rows)
+
+    if args.config_quota:
+        cfg = load_config()
+        gmail_limiter = RateLimiter.from_config("Gmail", cfg, table="gmail_rate_limit")
+        gemini_limiter = RateLimiter.from_config("Gemini", cfg)
+    else:
+        # the point is to measure this code, not to wait out the real quotas
+        gmail_limiter = RateLimiter("Gmail", TokenBucket(requests_per_minute=1_000_000))
+        gemini_limiter = RateLimiter("Gemini", TokenBucket(requests_per_minute=1_000_000))
+
+    grabber = EmailGrabber(credentials=None, senders=senders, service=service, limiter=gmail_limiter)
+    gemini = replay_gemini(outputs, latency=args.gemini_latency, throttle_rate=args.gemini_429, retry_after=args.retry_after)
+    local = None if args.no_local else LocalExtractor()
+    pipeline = ExtractionPipeline(gemini=gemini, limiter=gemini_limiter, max_workers=4, pack_size=args.pack_size, local=local)
+    cpu_stage = CpuStage.from_config(local=local, cfg={"pipeline": {"cpu_workers": args.cpu_workers}})
+    store = SQLiteWriter(app_directory=directory)
+    committer = BatchCommitter(store=store, excel_writer=excel_writer, checkpoint_path=os.path.join(directory, "checkpoint.json"))
+
+    rss_before = _peak_rss_mb()
+    since = metrics.snapshot()
+    start = time.perf_counter()
+    # the per receipt prints would be most of what gets timed
+    with contextlib.redirect_stdout(io.StringIO()):
+        payloads = grabber.iter_historical_messages()
+        if cpu_stage is not None:
+            payloads = cpu_stage.run(payloads)
+        for payload, mo in pipeline.run(payloads):
+            committer.add(payload, mo)
+        committer.flush()
+    elapsed = time.perf_counter() - start
+    summary = metrics.summary(since=since)
+    store.close()
+
+    receipts = committer.receipts_seen
+    return {
+        "receipts": receipts,
+        "processed": committer.receipts_processed,
+        "rows": committer.rows_written,
+        "seconds": round(elapsed, 3),
+        "receipts_per_s": round(receipts / elapsed, 1) if elapsed else 0.0,
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "rss_before_run_mb": round(rss_before, 1),
+        "gmail_round_trips": service.round_trips,
+        "gmail_429": service.throttled,
+        "gemini_calls": gemini.models.calls,
+        "gemini_429": gemini.models.throttled,
+        "stages_s": {stage: s["total_s"] for stage, s in summary["stages"].items()},
+        "counters": summary["counters"],
+    }
+
+
+def run_in_subprocess(n: int, argv: List[str]) -> Dict[str, Any]:
+    """
+    A fresh interpreter per size, so the peak RSS belongs to that run alone.
+    """
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_end_to_end", "--one", str(n)] + argv,
+        capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"run of {n} receipts failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline_path: str, tolerance: float) -> bool:
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    ok = True
+    for n, result in results.items():
+        before = baseline.get(n)
+        if before is None or not before["receipts_per_s"]:
+            continue
+        change = result["receipts_per_s"] / before["receipts_per_s"] - 1
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        print(f"{n:>6} | {before['receipts_per_s']:8.1f} -> {result['receipts_per_s']:8.1f} receipts/s ({change:+.0%})"
+              f"{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="End to end backfill benchmark on fake gmail and gemini")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="receipts per synthetic mailbox")
+    parser.add_argument("--fixtures", help="directory with gmail.json.gz and gemini.json.gz from record_fixtures.py, instead of synthetic mailboxes")
+    parser.add_argument("--unknown-share", type=float, default=0.2, help="share of receipts without a known layout, i.e., going to the model")
+    parser.add_argument("--workbook-rows", type=int, default=50_000, help="rows already in the workbook")
+    parser.add_argument("--gmail-latency", type=float, default=0.0, help="seconds per gmail round trip")
+    parser.add_argument("--gemini-latency", type=float, default=0.05, help="seconds per model call")
+    parser.add_argument("--gmail-429", type=float, default=0.0, help="share of gmail round trips answered with a 429")
+    parser.add_argument("--gemini-429", type=float, default=0.0, help="share of model calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="retry delay the injected 429s ask for")
+    parser.add_argument("--pack-size", type=int, default=1)
+    parser.add_argument("--cpu-workers", type=int, default=0)
+    parser.add_argument("--no-local", action="store_true", help="send every receipt to the model")
+    parser.add_argument("--config-quota", action="store_true", help="use the rate limits in config.toml instead of none")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="json file from --save to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown in receipts/s that counts as a regression")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+
+    if args.one is not None:
+        with tempfile.TemporaryDirectory() as directory:
+            print(json.dumps(run_once(args.one, args, directory)))
+        return
+
+    sizes = [0] if args.fixtures else args.sizes
+    results: Dict[str, Dict[str, Any]] = {}
+    print(f"{'size':>6} | {'receipts/s':>10} | {'seconds':>8} | {'peak RSS':>9} | " + " | ".join(f"{s:>13}" for s in STAGES) + " | 429s (gmail/gemini)")
+    for n in sizes:
+        # the child only looks at --one and the knobs, the rest of argv is harmless to pass along
+        r = run_in_subprocess(n, argv)
+        results[str(r["receipts"] if args.fixtures else n)] = r
+        stages = " | ".join(f"{r['stages_s'].get(s, 0.0):12.2f}s" for s in STAGES)
+        print(f"{r['receipts']:>6} | {r['receipts_per_s']:10.1f} | {r['seconds']:7.2f}s | {r['peak_rss_mb']:6.0f} MB | {stages} | "
+              f"{r['gmail_429']}/{r['gemini_429']}")
+        if r["processed"] != r["receipts"]:
+            print(f"{'':>6} | {r['receipts'] - r['processed']} receipts came out without rows")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from datetime import datetime, timedelta
+
+from model.model_output import Row
+from writers.excel_writer import ExcelWriter
+
+# Measures how long it takes to append a typical update (5 rows) to workbooks that already hold
+# 1k, 50k and 500k rows, for the streaming append path and for the old load_workbook/save path.
+# Run from the repo root with: python -m benchmarks.bench_excel_append [--openpyxl-max 50000]
+
+SIZES = (1_000, 50_000, 500_000)
+APPEND = 5
+FILL_CHUNK = 50_000
+
+
+def make_rows(n: int, start: datetime) -> list[Row]:
+    return [
+        Row(item=f"ITEM {i % 997}", quantity=1 + i % 3, price=1.5 + i % 7, price_per_unit=1.5, date=start + timedelta(days=i // 20))
+        for i in range(n)
+    ]
+
+
+def build_workbook(directory: str, n: int) -> ExcelWriter:
+    """
+    Copies the template into directory and fills it with n rows.
+    """
+    template = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "receipt-buddy.xlsx")
+    shutil.copy(template, os.path.join(directory, "receipt-buddy.xlsx"))
+    writer = ExcelWriter(app_directory=directory)
+    rows = make_rows(n, datetime(2023, 1, 1))
+    for i in range(0, n, FILL_CHUNK):
+        writer.write_rows(rows[i:i + FILL_CHUNK])
+    return writer
+
+
+def time_append(writer: ExcelWriter, use_openpyxl: bool) -> float:
+    rows = make_rows(APPEND, datetime(2025, 1, 1))
+    start = time.perf_counter()
+    if use_openpyxl:
+        writer._write_rows_openpyxl(rows)
+    else:
+        writer.write_rows(rows)
+    return time.perf_counter() - start
+
+
+def main():
+    openpyxl_max = 50_000
+    if "--openpyxl-max" in sys.argv:
+        openpyxl_max = int(sys.argv[sys.argv.index("--openpyxl-max") + 1])
+
+    results = []
+    for n in SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            # the per row prints from the fill would drown out the results
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                writer = build_workbook(directory, n)
+                size_mb = os.path.getsize(writer.write_path) / 1e6
+                fast = min(time_append(writer, use_openpyxl=False) for _ in range(3))
+                slow = time_append(writer, use_openpyxl=True) if n <= openpyxl_max else None
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            results.append((n, size_mb, fast, slow))
+            print(f"{n:>8} rows | {size_mb:7.1f} MB | append {APPEND}: {fast:7.3f}s" + (f" | openpyxl: {slow:7.3f}s" if slow is not None else ""))
+
+
+if __name__ == "__main__":
+    main()
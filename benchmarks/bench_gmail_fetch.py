@@ -0,0 +1,78 @@
+import time
+
+from email_service.email_grabber import EmailGrabber
+from benchmarks.fake_gmail import FakeGmailService, make_mailbox
+
+# Compares gmail round trips for the one-request-per-call fetch against the batched fetch. Then, for a mailbox
+# with several senders, the round trips and bytes of a listing with one search per sender, pages of 100 and whole
+# responses, against the OR'ed search with pages of 500 and field masks.
+# Run from the repo root with: python -m benchmarks.bench_gmail_fetch
+
+SENDER = "ticket-caisse@e-ticket.cooperative-u.fr"
+LATENCY = 0.005  # seconds per round trip
+
+
+def serial_fetch(grabber: EmailGrabber):
+    """
+    The old path: one messages().get and one attachments().get per receipt
+    """
+    messages = grabber._list_message_ids()
+    messages.reverse()
+    return [p for p in (grabber._get_attachment_payload(message=m) for m in messages) if p is not None]
+
+
+class UnmaskedGrabber(EmailGrabber):
+    """
+    The listing before the OR'ed search and field masks: one search per sender, 100 ids a page, whole responses.
+    """
+    fields = {name: None for name in EmailGrabber.fields}
+    page_size = 100
+    senders_per_query = 1
+
+
+def mixed_mailbox(n: int, senders: int) -> FakeGmailService:
+    service = FakeGmailService(latency=LATENCY)
+    for i in range(n):
+        service.add_receipt(f"m{i:06d}", f"receipts@shop{i % senders}.example", 1_700_000_000_000 + i * 3_600_000,
+                            pdf=b"%PDF-1.4 fake receipt " + str(i).encode())
+    return service
+
+
+def run_masks(n: int, senders: int = 5):
+    sender_list = [f"receipts@shop{s}.example" for s in range(senders)]
+    for name, cls in (("whole", UnmaskedGrabber), ("masked", EmailGrabber)):
+        service = mixed_mailbox(n, senders)
+        grabber = cls(credentials=None, senders=sender_list, service=service)
+        start = time.perf_counter()
+        listed = len(grabber._list_message_ids())
+        list_trips, list_bytes = service.round_trips, service.bytes_received
+        payloads = grabber.ingest_historical_messages()
+        elapsed = time.perf_counter() - start
+        assert listed == n and len(payloads) == n
+        print(f"{name:>8} | {n:>5} receipts, {senders} senders | listing {list_trips:>3} round trips {list_bytes / 1024:7.0f} KB | "
+              f"all {service.round_trips:>4} round trips {service.bytes_received / 1024 ** 2:6.1f} MB | {elapsed:6.2f}s")
+
+
+def run(n: int):
+    for name, fetch in (("serial", serial_fetch), ("batched", EmailGrabber.ingest_historical_messages)):
+        service = make_mailbox(n, SENDER, latency=LATENCY)
+        grabber = EmailGrabber(credentials=None, senders=[SENDER], service=service)
+        start = time.perf_counter()
+        payloads = fetch(grabber)
+        elapsed = time.perf_counter() - start
+        assert len(payloads) == n
+        print(f"{name:>8} | {n:>5} receipts | {service.round_trips:>5} round trips | {elapsed:6.2f}s")
+
+    # update run where every receipt from the checkpoint day is a candidate
+    service = make_mailbox(n, SENDER, latency=LATENCY)
+    grabber = EmailGrabber(credentials=None, senders=[SENDER], service=service)
+    last_ms = int(service.messages[f"m{n // 2:06d}"]["internalDate"])
+    payloads, _, _ = grabber.ingest_new_messages(last_internal_ms=last_ms)
+    print(f"{'update':>8} | {len(payloads):>5} receipts | {service.round_trips:>5} round trips")
+
+
+if __name__ == "__main__":
+    for n in (100, 1000):
+        run(n)
+    for n in (1000, 5000):
+        run_masks(n)
@@ -0,0 +1,76 @@
+import os
+import time
+import tempfile
+import threading
+
+from email_service.email_grabber import EmailGrabber
+from email_service.history_sync import HistorySync
+from benchmarks.fake_gmail import make_mailbox
+
+# Runs the daemon's sync loop against the fake history endpoint: the first sync falls back to the day search,
+# the next ones only list history. Prints the round trips per sync and how long a new receipt takes to show up.
+# Run from the repo root with: python -m benchmarks.bench_history_sync
+
+SENDER = "ticket-caisse@e-ticket.cooperative-u.fr"
+OTHER = "newsletter@example.com"
+POLL_SECONDS = 0.2
+
+
+def sync_once(sync: HistorySync, label: str):
+    service = sync.grabber.service
+    before = service.round_trips
+    payloads, history_id, max_ms = sync.poll()
+    sync.commit(history_id=history_id, max_ms=max_ms)
+    print(f"{label:>22} | {len(payloads):>4} receipts | {service.round_trips - before:>3} round trips")
+    return payloads
+
+
+def run(n: int):
+    service = make_mailbox(n, SENDER)
+    grabber = EmailGrabber(credentials=None, senders=[SENDER], service=service)
+    with tempfile.TemporaryDirectory() as tmp:
+        sync = HistorySync(grabber=grabber, checkpoint_path=os.path.join(tmp, "checkpoint.json"))
+        last_ms = int(service.messages[f"m{n - 1:06d}"]["internalDate"])
+
+        # the checkpoint is on the last receipt, like after setup.py
+        sync.commit(history_id=None, max_ms=last_ms)
+        sync_once(sync, "first (day search)")
+        assert not sync_once(sync, "nothing new")
+
+        for i in range(3):
+            service.add_receipt(f"new{i}", SENDER, last_ms + (i + 1) * 60_000, pdf=b"%PDF-1.4 new " + str(i).encode())
+        service.add_receipt("spam", OTHER, last_ms + 10 * 60_000, pdf=b"%PDF-1.4 not a receipt")
+        assert [p["message_id"] for p in sync_once(sync, "3 new + 1 other sender")] == ["new0", "new1", "new2"]
+
+        service.expire_history()
+        service.add_receipt("late", SENDER, last_ms + 20 * 60_000, pdf=b"%PDF-1.4 late")
+        assert [p["message_id"] for p in sync_once(sync, "expired history")] == ["late"]
+
+        # how long a receipt takes to be picked up by a loop polling every POLL_SECONDS
+        arrived = {}
+        stop = threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                payloads, history_id, max_ms = sync.poll()
+                for p in payloads:
+                    arrived[p["message_id"]] = time.monotonic()
+                sync.commit(history_id=history_id, max_ms=max_ms)
+                stop.wait(POLL_SECONDS)
+
+        thread = threading.Thread(target=loop)
+        thread.start()
+        time.sleep(POLL_SECONDS * 1.5)  # land somewhere between two polls
+        sent = time.monotonic()
+        service.add_receipt("live", SENDER, last_ms + 30 * 60_000, pdf=b"%PDF-1.4 live")
+        while "live" not in arrived and time.monotonic() - sent < 5:
+            time.sleep(0.01)
+        stop.set()
+        thread.join()
+        print(f"{'live receipt':>22} | picked up after {arrived['live'] - sent:.2f}s (polling every {POLL_SECONDS}s)")
+
+
+if __name__ == "__main__":
+    for n in (100, 1000):
+        print(f"mailbox of {n}")
+        run(n)
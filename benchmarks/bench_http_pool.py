@@ -0,0 +1,99 @@
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.http_pool import HttpPool
+
+# Compares the shared keep-alive pool (utils/http_pool.py) against httplib2, googleapiclient's own transport, for
+# concurrent calls from several threads: one httplib2.Http per thread (a gmail client per shard, as before), and a
+# new connection for every call. The server is local, with a delay on every new connection standing in for the
+# TCP and TLS handshakes to google, and counts the connections it was asked to open.
+# Run from the repo root with: python -m benchmarks.bench_http_pool
+
+THREADS = (4, 12)
+CALLS_PER_THREAD = 50
+# a TCP and a TLS handshake at ~20ms round trips
+HANDSHAKE_SECONDS = 0.06
+# about what gmail takes to answer a messages.get
+SERVER_SECONDS = 0.05
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body go out in separate writes
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # once per connection
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(HANDSHAKE_SECONDS)
+        super().setup()
+
+    def do_GET(self):
+        time.sleep(SERVER_SECONDS)
+        body = b'{"historyId": "42"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.lock = threading.Lock()
+        self.connections = 0
+
+    def take_connections(self) -> int:
+        with self.lock:
+            n, self.connections = self.connections, 0
+        return n
+
+
+def run_threads(threads: int, call) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda t: [call(t) for _ in range(CALLS_PER_THREAD)], range(threads)))
+    return time.perf_counter() - start
+
+
+def run(server: _Server, threads: int):
+    import httplib2
+
+    url = f"http://127.0.0.1:{server.server_port}/gmail/v1/users/me/profile"
+    calls = threads * CALLS_PER_THREAD
+    results = []
+
+    fresh = lambda t: httplib2.Http().request(url, headers={"connection": "close"})
+    results.append(("new connection per call", run_threads(threads, fresh), server.take_connections()))
+
+    per_thread = [httplib2.Http() for _ in range(threads)]
+    results.append(("httplib2 per shard", run_threads(threads, lambda t: per_thread[t].request(url)), server.take_connections()))
+
+    pool = HttpPool(max_connections=threads)
+    shared = pool.gmail_http(None)
+    results.append(("shared pool", run_threads(threads, lambda t: shared.request(url)), server.take_connections()))
+    reused = pool.stats()["hosts"]["127.0.0.1"]["reused_share"]
+    pool.close()
+
+    for name, seconds, connections in results:
+        print(f"{threads:>3} threads | {name:<24} | {calls} calls in {seconds:6.2f}s | "
+              f"{calls / seconds:7.0f} calls/s | {connections:>4} connections opened")
+    print(f"{'':>3}         | shared pool reused a connection for {reused:.0%} of calls")
+
+
+if __name__ == "__main__":
+    server = _Server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for n in THREADS:
+        run(server, n)
+    server.shutdown()
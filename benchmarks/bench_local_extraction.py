@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import argparse
+
+from collections import Counter
+from datetime import date
+
+from model.model_output import ModelOutput
+from model.local_extractor import LocalExtractor
+from pipeline.extraction import ExtractionPipeline
+from utils.token_bucket import TokenBucket
+from utils.rate_limiter import RateLimiter
+from email_service.email_grabber import EmailGrabber
+from benchmarks.fake_receipts import make_receipt
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.fake_gemini import load_outputs
+
+# Compares receipts per second for the local text layer path against the model path. The model is faked
+# with a fixed latency per call; the quota bound is what 15 requests per minute allows on top of that.
+# With --fixtures (recorded from the real mailbox with benchmarks/record_fixtures.py) it instead checks the
+# templates against real receipts: how many each one reads, and whether those rows agree with the model's answer.
+# Run from the repo root with: python -m benchmarks.bench_local_extraction [--fixtures benchmarks/fixtures]
+
+SENDER = "ticket-caisse@e-ticket.cooperative-u.fr"
+
+
+class FakeGemini:
+    """
+    Answers every receipt correctly after latency seconds.
+    """
+    def __init__(self, answers, latency: float):
+        self.answers = answers
+        self.latency = latency
+        self.cache = None
+
+    def from_cache(self, payload):
+        return None
+
+    def respond(self, payload, use_cache: bool = True):
+        time.sleep(self.latency)
+        raw = json.dumps({item: {"quantity": q, "price": p} for item, q, p in self.answers[payload["message_id"]]})
+        return ModelOutput.from_raw(raw_model_text=raw, date=payload["date"])
+
+
+def make_payloads(n: int):
+    payloads, answers = [], {}
+    for i in range(n):
+        pdf, expected = make_receipt(i)
+        message_id = f"m{i:06d}"
+        payloads.append({"file_data": pdf, "date": date(2024, 1, 1), "message_id": message_id, "sender": SENDER})
+        answers[message_id] = expected
+    return payloads, answers
+
+
+def run(n: int, latency: float, rpm: int):
+    payloads, answers = make_payloads(n)
+
+    local = LocalExtractor()
+    start = time.perf_counter()
+    outputs = [local.extract(p) for p in payloads]
+    elapsed = time.perf_counter() - start
+    correct = sum(1 for p, mo in zip(payloads, outputs) if mo and [(r.item, r.quantity, r.price) for r in mo.rows] == answers[p["message_id"]])
+    stats = local.stats()[SENDER]
+    print(f"{'local':>6} | {n:>5} receipts | {n / elapsed:8.1f} receipts/s | {stats['hits']} hits, {correct} correct")
+
+    # only time a slice of the model path, it is the slow one
+    sample = payloads[:min(n, 40)]
+    pipeline = ExtractionPipeline(gemini=FakeGemini(answers, latency), limiter=RateLimiter("Gemini", TokenBucket(requests_per_minute=10_000)), max_workers=4)
+    start = time.perf_counter()
+    for _ in pipeline.run(sample):
+        pass
+    elapsed = time.perf_counter() - start
+    print(f"{'model':>6} | {len(sample):>5} receipts | {len(sample) / elapsed:8.1f} receipts/s | "
+          f"{rpm / 60:.2f} receipts/s under {rpm} rpm")
+
+
+def check_fixtures(directory: str):
+    service = FakeGmailService.load(os.path.join(directory, "gmail.json.gz"))
+    outputs = load_outputs(os.path.join(directory, "gemini.json.gz"))
+    local = LocalExtractor()
+    senders = sorted({h["value"] for m in service.messages.values() for h in m["payload"]["headers"] if h["name"] == "From"})
+    payloads = [p for p in EmailGrabber(credentials=None, senders=senders, service=service).ingest_historical_messages()
+                if p["sender"] in local.templates]
+
+    same, prices_only, different, unanswered = 0, 0, [], 0
+    for payload in payloads:
+        mo = local.extract(payload)
+        if mo is None:
+            continue
+        answer = outputs.get(payload["pdf_sha256"])
+        model = ModelOutput.from_raw(raw_model_text=answer, date=payload["date"]) if answer else None
+        if not isinstance(model, ModelOutput):
+            unanswered += 1
+            continue
+        ours = Counter((r.item, r.quantity, round(r.price, 2)) for r in mo.rows)
+        theirs = Counter((r.item, r.quantity, round(r.price, 2)) for r in model.rows)
+        if ours == theirs:
+            same += 1
+        elif Counter(k[1:] for k in ours.elements()) == Counter(k[1:] for k in theirs.elements()):
+            # same lines and prices, the model spelled some item names differently
+            prices_only += 1
+        else:
+            different.append((payload["message_id"], sorted(ours.elements()), sorted(theirs.elements())))
+
+    for sender, stats in local.stats().items():
+        print(f"{sender} | {stats['hits'] + stats['misses']} receipts | {stats['hits']} read locally, {stats['misses']} left to the model")
+    print(f"of those read locally: {same} same rows as the model, {prices_only} same prices with other item names, "
+          f"{len(different)} different, {unanswered} without a model answer to compare to")
+    for message_id, ours, theirs in different:
+        print(f"  {message_id}\n    template: {ours}\n    model:    {theirs}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=1.5, help="seconds per model call")
+    parser.add_argument("--rpm", type=int, default=15)
+    parser.add_argument("--fixtures", help="directory with gmail.json.gz and gemini.json.gz from record_fixtures.py")
+    args = parser.parse_args()
+    if args.fixtures:
+        check_fixtures(args.fixtures)
+    else:
+        for n in (100, 1000):
+            run(n, latency=args.latency, rpm=args.rpm)
@@ -0,0 +1,143 @@
+import io
+import os
+import json
+import time
+import hashlib
+import tempfile
+import contextlib
+
+from typing import Dict, List, Tuple
+from datetime import date, datetime, timezone
+
+from email_service.blob_store import BlobStore
+from model.model_output import ModelOutput
+from pipeline.extraction import ExtractionPipeline
+from pipeline.reextraction import Reextractor
+from writers.sqlite_writer import SQLiteWriter
+from utils.rate_limiter import RateLimiter
+from utils.token_bucket import TokenBucket
+from benchmarks.fake_gemini import replay_gemini
+from benchmarks.fake_receipts import make_receipt
+from benchmarks.bench_excel_append import build_workbook
+
+# Migrates a stored corpus to a new model that reads every CHANGED_EVERY-th receipt differently. The run is cut off
+# halfway and started again, to check that it resumes without extracting anything twice, and the result is checked
+# against the new model's rows and against rollups recomputed from scratch. Reports the model calls and rows
+# rewritten, next to rewriting every receipt into a fresh store and spreadsheet (the way to do it before).
+# Run from the repo root with: python -m benchmarks.bench_reextraction
+
+SIZES = (500, 2000)
+CHANGED_EVERY = 10
+SENDER = "receipts@other-shop.example"
+
+
+def answer(items: List[Tuple[str, int, float]]) -> str:
+    return json.dumps({item: {"quantity": q, "price": p} for item, q, p in items}, ensure_ascii=False)
+
+
+def corpus(n: int) -> Tuple[List[Tuple[bytes, str, str]], Dict[str, str]]:
+    """
+    Returns (pdf, old answer, new answer) per receipt, and the new model's {pdf sha256: answer}.
+    """
+    receipts, new_outputs = [], {}
+    for i in range(n):
+        pdf, items = make_receipt(i)
+        new_items = list(items)
+        if i % CHANGED_EVERY == 0:
+            # the new model reads the first line's price differently
+            name, q, p = new_items[0]
+            new_items[0] = (name, q, round(p + 0.1, 2))
+        receipts.append((pdf, answer(items), answer(new_items)))
+        new_outputs[hashlib.sha256(pdf).hexdigest()] = answer(new_items)
+    return receipts, new_outputs
+
+
+def _day(ms: int) -> date:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).date()
+
+
+def fill(directory: str, receipts: List[Tuple[bytes, str, str]]) -> Tuple[SQLiteWriter, BlobStore]:
+    store = SQLiteWriter(app_directory=directory)
+    blobs = BlobStore(os.path.join(directory, "pdfs"))
+    batch = []
+    for i, (pdf, old, _) in enumerate(receipts):
+        ms = 1_700_000_000_000 + i * 3_600_000
+        sha256 = blobs.put(f"m{i:06d}", f"a{i}", pdf, internal_ms=ms, date=_day(ms), sender=SENDER)
+        batch.append((f"m{i:06d}", sha256, ModelOutput.from_raw(old, date=_day(ms)).rows))
+    store.write_receipts(batch)
+    return store, blobs
+
+
+def engine(store, blobs, excel_writer, new_outputs) -> Tuple[Reextractor, object]:
+    gemini = replay_gemini(new_outputs)
+    gemini.model_name = "the-new-model"
+    # the point is to measure this code, not to wait out the real quota
+    limiter = RateLimiter("Gemini", TokenBucket(requests_per_minute=1_000_000))
+    pipeline = ExtractionPipeline(gemini=gemini, limiter=limiter, max_workers=4)
+    return Reextractor(store, blobs, pipeline, excel_writer, config=gemini.fingerprint()), gemini
+
+
+def run(n: int):
+    receipts, new_outputs = corpus(n)
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        store, blobs = fill(directory, receipts)
+        excel_writer = build_workbook(directory, 0)
+        excel_writer.sync(store)
+
+        start = time.perf_counter()
+        first, gemini = engine(store, blobs, excel_writer, new_outputs)
+        first.run(limit=n // 2)
+        # started again, as after a kill or with --limit
+        second, gemini_again = engine(store, blobs, excel_writer, new_outputs)
+        second.run()
+        elapsed = time.perf_counter() - start
+        calls = gemini.models.calls + gemini_again.models.calls
+        changed = first.counts["changed"] + second.counts["changed"]
+        rows_rewritten = first.rows_written + second.rows_written
+        left = engine(store, blobs, excel_writer, new_outputs)[0].plan()[0]
+
+        expected = sorted(
+            (item, q, round(p, 2))
+            for _, _, new in receipts for item, v in json.loads(new).items() for q, p in [(v["quantity"], v["price"])]
+        )
+        stored = sorted((r.item, r.quantity, round(r.price, 2)) for r in store.iter_rows())
+        rollups = (store.rollups.daily(), store.rollups.monthly(), store.rollups.items())
+        store.rollups.rebuild()
+        rebuilt = (store.rollups.daily(), store.rollups.monthly(), store.rollups.items())
+        exported = excel_writer.exported_through() == store.max_id()
+
+        # before: wiping the store and writing every receipt again (and the spreadsheet with it)
+        os.makedirs(os.path.join(directory, "fresh"))
+        fresh = SQLiteWriter(app_directory=os.path.join(directory, "fresh"))
+        fresh_rows = 0
+        start = time.perf_counter()
+        batch = []
+        for i, (pdf, _, new) in enumerate(receipts):
+            rows = ModelOutput.from_raw(new, date=_day(1_700_000_000_000 + i * 3_600_000)).rows
+            batch.append((f"m{i:06d}", hashlib.sha256(pdf).hexdigest(), rows))
+            fresh_rows += len(rows)
+        fresh.write_receipts(batch)
+        excel_writer.rebuild(fresh)
+        t_fresh = time.perf_counter() - start
+
+    assert calls == n, f"{calls} model calls for {n} receipts"
+    assert stored == expected, "the store doesn't hold the new model's rows"
+    assert _close(rollups, rebuilt), "the rollups drifted from the rows"
+    assert not left and exported
+    print(f"{n:>6} receipts | {calls} model calls over 2 runs | {changed} receipts ({rows_rewritten} rows) rewritten "
+          f"in {elapsed:6.2f}s | rewriting everything: {fresh_rows} rows, store and sheet alone {t_fresh:6.2f}s")
+
+
+def _close(a, b) -> bool:
+    if isinstance(a, float) and isinstance(b, float):
+        return abs(a - b) < 1e-6
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(_close(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_close(a[k], b[k]) for k in a)
+    return a == b
+
+
+if __name__ == "__main__":
+    for n in SIZES:
+        run(n)
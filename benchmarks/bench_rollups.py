@@ -0,0 +1,90 @@
+import time
+import tempfile
+
+from datetime import datetime
+
+from writers.sqlite_writer import SQLiteWriter
+from benchmarks.bench_excel_append import make_rows
+
+# Compares reading monthly spend and per item unit price stats from the rollups, against aggregating every row
+# (in sqlite, and in pandas over query_frame), on stores of 100k and 1M rows. Also reports what keeping the rollups
+# up to date adds to writing a batch of 20 receipts.
+# Run from the repo root with: python -m benchmarks.bench_rollups
+
+SIZES = (100_000, 1_000_000)
+FILL_CHUNK = 100_000
+BATCH_RECEIPTS = 20
+ROWS_PER_RECEIPT = 12
+
+
+def timed(fn, repeat: int = 3):
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def scan_sql(store: SQLiteWriter):
+    monthly = store.conn.execute("SELECT substr(date, 1, 7), COUNT(*), SUM(quantity), SUM(price) FROM rows GROUP BY 1").fetchall()
+    items = store.conn.execute(
+        "SELECT item, COUNT(*), SUM(price), MIN(price_per_unit), MAX(price_per_unit), AVG(price_per_unit) "
+        "FROM rows WHERE quantity > 0 GROUP BY item"
+    ).fetchall()
+    return len(monthly), len(items)
+
+
+def scan_pandas(store: SQLiteWriter):
+    frame = store.query_frame()
+    monthly = frame.groupby(frame["date"].dt.to_period("M"))["price"].sum()
+    items = frame[frame["quantity"] > 0].groupby("item")["price_per_unit"].agg(["min", "max", "mean"])
+    return len(monthly), len(items)
+
+
+def from_rollups(store: SQLiteWriter):
+    return len(store.rollups.monthly()), len(store.rollups.items())
+
+
+def run(n: int):
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteWriter(app_directory=directory)
+        # years of receipts, 20 rows a day
+        rows = make_rows(n, datetime(2000, 1, 1))
+        for i in range(0, n, FILL_CHUNK):
+            store.write_rows(rows[i:i + FILL_CHUNK])
+
+        t_rollups, counts = timed(lambda: from_rollups(store))
+        t_sql, sql_counts = timed(lambda: scan_sql(store))
+        t_pandas, _ = timed(lambda: scan_pandas(store), repeat=1)
+        assert counts == sql_counts, "the rollups and the full scan disagree"
+        print(f"{n:>8} rows | {counts[0]} months, {counts[1]} items | rollups {t_rollups * 1000:8.2f}ms | "
+              f"sqlite scan {t_sql * 1000:8.1f}ms | pandas {t_pandas * 1000:8.1f}ms")
+
+        # one committer flush on top of the full store, and what the rollups took of it
+        batch = make_rows(BATCH_RECEIPTS * ROWS_PER_RECEIPT, datetime(2030, 1, 1))
+        receipts = [
+            (f"m{k}", "sha", batch[k * ROWS_PER_RECEIPT:(k + 1) * ROWS_PER_RECEIPT]) for k in range(BATCH_RECEIPTS)
+        ]
+        catch_up, spent = store.rollups.catch_up, []
+
+        def timed_catch_up(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return catch_up(*args, **kwargs)
+            finally:
+                spent.append(time.perf_counter() - start)
+
+        store.rollups.catch_up = timed_catch_up
+        start = time.perf_counter()
+        store.write_receipts(receipts)
+        t_write = time.perf_counter() - start
+        t_catch_up = sum(spent)
+        print(f"{'':>8}      | batch of {BATCH_RECEIPTS} receipts written in {t_write * 1000:6.1f}ms, "
+              f"of which rollups {t_catch_up * 1000:5.1f}ms")
+        store.close()
+
+
+if __name__ == "__main__":
+    for n in SIZES:
+        run(n)
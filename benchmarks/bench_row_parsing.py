@@ -0,0 +1,78 @@
+import json
+import time
+import tempfile
+
+from datetime import date, timedelta
+
+from model.model_output import ModelOutput, RowTable
+from writers.sqlite_writer import SQLiteWriter
+from benchmarks.fake_receipts import make_receipt
+
+# Compares turning raw model outputs (and stored rows) into spreadsheet values one pydantic Row at a time,
+# against the columnar RowTable path. Both end at the [item, quantity, price, price_per_unit, date] lists
+# ExcelWriter writes, and are checked to agree.
+# Run from the repo root with: python -m benchmarks.bench_row_parsing
+
+SIZES = (1_000, 10_000, 100_000)
+DISTINCT = 2_000
+
+
+def make_raws(n: int):
+    """
+    n raw outputs like the model writes them, some fenced and with decimal commas, cycling through DISTINCT receipts.
+    """
+    distinct = []
+    for i in range(DISTINCT):
+        _, expected = make_receipt(i)
+        obj = {item: {"quantity": q, "price": p if i % 3 else f"{p:.2f}".replace(".", ",")} for item, q, p in expected}
+        raw = json.dumps(obj, ensure_ascii=False)
+        distinct.append(f"```json\n{raw}\n```" if i % 2 else raw)
+    raws = [distinct[i % DISTINCT] for i in range(n)]
+    dates = [date(2023, 1, 1) + timedelta(days=i // 3) for i in range(n)]
+    return raws, dates
+
+
+def per_row(raws, dates):
+    values = []
+    for raw, d in zip(raws, dates):
+        mo = ModelOutput.from_raw(raw_model_text=raw, date=d)
+        values.extend([r.item, r.quantity, r.price, r.price_per_unit, r.date] for r in mo.rows)
+    return values
+
+
+def bulk(raws, dates):
+    table, _, errors = RowTable.from_raws(raws, dates)
+    assert not errors
+    return table.values()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - start, out
+
+
+def run(n: int):
+    raws, dates = make_raws(n)
+    t_row, v_row = timed(per_row, raws, dates)
+    t_bulk, v_bulk = timed(bulk, raws, dates)
+    assert v_row == [list(v) for v in v_bulk], "the two paths disagree"
+    print(f"{n:>7} outputs | {len(v_row):>8} rows | per row {t_row:7.3f}s | RowTable {t_bulk:7.3f}s | {t_row / t_bulk:5.1f}x")
+
+    # the same rows coming back out of the local store, i.e., ExcelWriter.sync / rebuild
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteWriter(app_directory=directory)
+        table, _, _ = RowTable.from_raws(raws, dates)
+        store.write_rows(table.rows())
+        t_row, rows = timed(lambda: [[r.item, r.quantity, r.price, r.price_per_unit, r.date] for _, r in store.rows_after(0)])
+        t_bulk, (_, stored) = timed(store.table_after, 0)
+        assert rows == [list(v) for v in stored.values()]
+        print(f"{'':>7} from store | {len(rows):>8} rows | per row {t_row:7.3f}s | RowTable {t_bulk:7.3f}s | {t_row / t_bulk:5.1f}x")
+        store.close()
+
+
+if __name__ == "__main__":
+    # RowTable imports numpy on first use, which isn't what's being compared
+    RowTable.empty()
+    for n in SIZES:
+        run(n)
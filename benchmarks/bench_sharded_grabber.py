@@ -0,0 +1,67 @@
+import time
+
+from email_service.email_grabber import EmailGrabber
+from email_service.sharded_grabber import ShardedGrabber
+from benchmarks.fake_gmail import FakeGmailService
+
+# Compares listing and downloading the backfill of several gmail accounts with several senders each, one
+# (account, sender) after the other like a single EmailGrabber per account does, against ShardedGrabber running
+# every shard at once and merging them by internal_ms. Every round trip to the fake mailboxes takes LATENCY.
+# Run from the repo root with: python -m benchmarks.bench_sharded_grabber
+
+LATENCY = 0.02  # seconds per round trip
+RECEIPTS_PER_SHARD = 300
+LAYOUTS = ((1, 1), (1, 4), (3, 4))  # (accounts, senders per account)
+
+
+def make_accounts(accounts: int, senders: int):
+    """
+    {account name: mailbox} and the config.toml it would take, the receipts of all shards interleaved in time.
+    """
+    cfg = {"senders": [], "accounts": [], "gmail_rate_limit": {"requests_per_minute": 1_000_000}}
+    services = {}
+    for a in range(accounts):
+        name = f"account{a}"
+        service = FakeGmailService(latency=LATENCY)
+        account_senders = [f"receipts@shop{s}.example" for s in range(senders)]
+        for s, sender in enumerate(account_senders):
+            shard = a * senders + s
+            for i in range(RECEIPTS_PER_SHARD):
+                ms = 1_700_000_000_000 + (i * accounts * senders + shard) * 60_000
+                service.add_receipt(f"{name}-{shard}-{i:05d}", sender, ms, pdf=f"%PDF-1.4 {name} {shard} {i}".encode())
+        services[name] = service
+        cfg["accounts"].append({"name": name, "senders": account_senders})
+    return cfg, services
+
+
+def serial(cfg, services):
+    payloads = []
+    for account in cfg["accounts"]:
+        grabber = EmailGrabber(credentials=None, senders=account["senders"], service=services[account["name"]], account=account["name"])
+        payloads.extend(grabber.iter_historical_messages())
+    return sorted(payloads, key=lambda p: p["internal_ms"])
+
+
+def sharded(cfg, services):
+    grabber = ShardedGrabber.from_config(cfg, credentials_for=None, service_for=lambda account: services[account.name])
+    return list(grabber.iter_historical_messages())
+
+
+def run(accounts: int, senders: int):
+    times = {}
+    for name, fetch in (("serial", serial), ("sharded", sharded)):
+        cfg, services = make_accounts(accounts, senders)
+        start = time.perf_counter()
+        payloads = fetch(cfg, services)
+        times[name] = time.perf_counter() - start
+        assert len(payloads) == accounts * senders * RECEIPTS_PER_SHARD
+        ms = [p["internal_ms"] for p in payloads]
+        assert ms == sorted(ms), "the merged stream is out of order"
+    shards = accounts * senders
+    print(f"{accounts} accounts x {senders} senders | {shards * RECEIPTS_PER_SHARD:>5} receipts | "
+          f"serial {times['serial']:6.2f}s | sharded {times['sharded']:6.2f}s | {times['serial'] / times['sharded']:4.1f}x")
+
+
+if __name__ == "__main__":
+    for accounts, senders in LAYOUTS:
+        run(accounts, senders)
@@ -0,0 +1,83 @@
+import re
+import sys
+import json
+import subprocess
+
+from typing import List, Tuple
+
+# Measures what a scheduled update.py run pays before it knows whether there is any new mail: the import time
+# of update.py from python -X importtime, the heaviest modules under it, and the wall time of a whole
+# no-new-mail run (imports, gmail client, one history poll) against the fake mailbox, each in a fresh process.
+# Run from the repo root with: python -m benchmarks.bench_startup
+
+HEAVY = ["google.genai", "openpyxl", "pandas", "pypdf", "googleapiclient.discovery"]
+# what update.py imported at the top before the heavy imports were deferred
+EAGER = "import update, model.model_wrapper, model.local_extractor, pipeline.extraction, openpyxl, googleapiclient.discovery"
+
+_IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+# a no-new-mail run: the checkpoint has a history id, and nothing was added since
+NO_NEW_MAIL = """
+import time
+start = time.perf_counter()
+import os, sys, json, tempfile
+import update
+from email_service.email_grabber import EmailGrabber
+from email_service.history_sync import HistorySync
+from benchmarks.fake_gmail import FakeGmailService
+
+service = FakeGmailService()
+grabber = EmailGrabber(credentials=None, senders=["ticket-caisse@e-ticket.cooperative-u.fr"], service=service)
+with tempfile.TemporaryDirectory() as tmp:
+    sync = HistorySync(grabber=grabber, checkpoint_path=os.path.join(tmp, "checkpoint.json"))
+    sync.commit(history_id=service.history_id, max_ms=1_700_000_000_000)
+    payloads, history_id, max_ms = sync.poll()
+    sync.commit(history_id=history_id, max_ms=max_ms)
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "receipts": len(payloads),
+    "heavy": [m for m in %r if m in sys.modules],
+}))
+""" % (HEAVY,)
+
+
+def import_times(statement: str) -> Tuple[float, List[Tuple[float, str]]]:
+    """
+    Runs statement under -X importtime in a fresh interpreter. Returns the total seconds spent importing the
+    modules it names, and the (cumulative seconds, module) of everything those import directly, heaviest first.
+    """
+    named = set(re.findall(r"[\w\.]+", statement.replace("import", "", 1)))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True)
+    total, children, pending = 0.0, [], []
+    # a module's line comes after the lines of everything it imports, one level deeper
+    for line in result.stderr.splitlines():
+        m = _IMPORTTIME.match(line)
+        if not m:
+            continue
+        cumulative, depth, module = int(m.group(2)) / 1e6, len(m.group(3)) // 2, m.group(4)
+        if depth == 1:
+            pending.append((cumulative, module))
+        elif depth == 0:
+            if module in named:
+                total += cumulative
+                children.extend(pending)
+            pending = []
+    return total, sorted(children, reverse=True)
+
+
+def no_new_mail_run() -> dict:
+    result = subprocess.run([sys.executable, "-c", NO_NEW_MAIL], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    for label, statement in (("update.py", "import update"), ("eager imports", EAGER)):
+        total, top = import_times(statement)
+        print(f"{label:>14} | {total:6.3f}s importing")
+        for seconds, module in top[:6]:
+            print(f"{'':>14} | {seconds:6.3f}s {module}")
+
+    runs = [no_new_mail_run() for _ in range(5)]
+    best = min(runs, key=lambda r: r["seconds"])
+    print(f"{'no new mail':>14} | {best['seconds']:6.3f}s (best of {len(runs)}), {best['receipts']} receipts, "
+          f"heavy modules loaded: {', '.join(best['heavy']) or 'none'}")
@@ -0,0 +1,106 @@
+import os
+import gzip
+import json
+import time
+import random
+import hashlib
+import threading
+
+from typing import Any, Dict, List, Optional
+
+from google.genai import errors
+
+from model.model_wrapper import Gemini
+from model.extraction_cache import ExtractionCache
+
+
+# This module replays canned model outputs through the real Gemini wrapper. Only the http call is faked: the
+# wrapper's models.generate_content is swapped for one that looks the pdf up by its sha256 in a table of
+# {pdf sha256: raw model text}, so Gemini.respond, respond_packed, the extraction cache and ModelOutput.from_raw
+# all run as they would against the api. Latency and 429s (as the api sends them, with a RetryInfo delay) can be
+# injected.
+
+
+class _Usage:
+    def __init__(self, total_token_count: int):
+        self.total_token_count = total_token_count
+
+
+class _Response:
+    def __init__(self, text: str, total_token_count: int):
+        self.text = text
+        self.usage_metadata = _Usage(total_token_count)
+
+
+class FakeModels:
+    """
+    Stands in for genai's client.models. latency is seconds per call, throttle_rate the share of calls that
+    get a 429 asking to retry after retry_after seconds. Unknown pdfs are answered with an empty object.
+    """
+    def __init__(
+            self,
+            outputs: Dict[str, str],
+            latency: float = 0.0,
+            throttle_rate: float = 0.0,
+            retry_after: float = 0.05,
+            tokens_per_receipt: int = 1500,
+            seed: int = 0,
+        ):
+        self.outputs = outputs
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.tokens_per_receipt = tokens_per_receipt
+        self.calls = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate_content(self, model: str, config: Any, contents: List[Any]) -> _Response:
+        with self._lock:
+            self.calls += 1
+            throttle = self.throttle_rate and self._random.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            raise errors.ClientError(429, {"error": {
+                "code": 429,
+                "status": "RESOURCE_EXHAUSTED",
+                "message": "You exceeded your current quota.",
+                "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{self.retry_after}s"}],
+            }})
+
+        pdfs = [part.inline_data.data for part in contents if getattr(part, "inline_data", None) is not None]
+        answers = [self.outputs.get(hashlib.sha256(pdf).hexdigest(), "{}") for pdf in pdfs]
+        if len(pdfs) == 1:
+            text = answers[0]
+        else:
+            # packed request, keyed r1..rN like the wrapper asks for
+            text = json.dumps({f"r{i + 1}": json.loads(answer) for i, answer in enumerate(answers)}, ensure_ascii=False)
+        return _Response(text, self.tokens_per_receipt * len(pdfs))
+
+
+def replay_gemini(outputs: Dict[str, str], cache: Optional[ExtractionCache] = None, **kwargs) -> Gemini:
+    """
+    A real Gemini wrapper whose calls are answered by FakeModels(outputs, **kwargs), reachable as .models.
+    """
+    # the client wants a key, but never gets to use it
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    gemini = Gemini(model_name="gemini-2.5-flash-lite", temperature=0.2, cache=cache)
+    gemini._models = FakeModels(outputs, **kwargs)
+    return gemini
+
+
+def save_outputs(outputs: Dict[str, str], path: str):
+    """
+    Writes {pdf sha256: raw model text} to a gzipped json fixture.
+    """
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(outputs, f, ensure_ascii=False)
+
+
+def load_outputs(path: str) -> Dict[str, str]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,85 @@
+import json
+import base64
+
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Optional
+
+
+# This module holds a local stand in for the files and batches parts of the genai client, so that
+# GeminiBatch can be run end to end without a key. Jobs move through pending and running on each get(),
+# and then every request line is answered by the responder function.
+
+class _Files:
+    def __init__(self, client: "FakeGeminiBatchClient"):
+        self.client = client
+
+    def upload(self, file: str, config: Optional[Dict[str, Any]] = None):
+        self.client.calls += 1
+        name = f"files/upload-{len(self.client.blobs)}"
+        with open(file, "rb") as f:
+            self.client.blobs[name] = f.read()
+        return SimpleNamespace(name=name)
+
+    def download(self, file: str) -> bytes:
+        self.client.calls += 1
+        return self.client.blobs[file]
+
+
+class _Batches:
+    STATES = ["JOB_STATE_PENDING", "JOB_STATE_RUNNING", "JOB_STATE_SUCCEEDED"]
+
+    def __init__(self, client: "FakeGeminiBatchClient"):
+        self.client = client
+
+    def create(self, model: str, src: str, config: Optional[Dict[str, Any]] = None):
+        self.client.calls += 1
+        name = f"batches/job-{len(self.client.jobs)}"
+        self.client.jobs[name] = {"src": src, "step": 0, "dest": None}
+        return self._view(name)
+
+    def get(self, name: str):
+        self.client.calls += 1
+        job = self.client.jobs[name]
+        job["step"] = min(job["step"] + 1, len(self.STATES) - 1)
+        if self.STATES[job["step"]] == "JOB_STATE_SUCCEEDED" and job["dest"] is None:
+            job["dest"] = self.client._answer(job["src"])
+        return self._view(name)
+
+    def _view(self, name: str):
+        job = self.client.jobs[name]
+        return SimpleNamespace(
+            name=name,
+            state=SimpleNamespace(name=self.STATES[job["step"]]),
+            dest=SimpleNamespace(file_name=job["dest"]),
+            error=None,
+        )
+
+
+class FakeGeminiBatchClient:
+    """
+    A fake batch endpoint. responder gets the decoded pdf bytes of one request and returns the model text,
+    or raises to make that one request fail. calls counts every api call made.
+    """
+    def __init__(self, responder: Callable[[bytes], str]):
+        self.responder = responder
+        self.calls = 0
+        self.blobs: Dict[str, bytes] = {}
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.files = _Files(self)
+        self.batches = _Batches(self)
+
+    def _answer(self, src: str) -> str:
+        out = []
+        for line in self.blobs[src].decode("utf-8").splitlines():
+            request = json.loads(line)
+            part = request["request"]["contents"][0]["parts"][0]
+            pdf = base64.b64decode(part["inline_data"]["data"])
+            try:
+                text = self.responder(pdf)
+                result = {"key": request["key"], "response": {"candidates": [{"content": {"parts": [{"text": text}]}}]}}
+            except Exception as e:
+                result = {"key": request["key"], "error": {"code": 500, "message": str(e)}}
+            out.append(json.dumps(result))
+        name = f"files/result-{len(self.blobs)}"
+        self.blobs[name] = "\n".join(out).encode("utf-8")
+        return name
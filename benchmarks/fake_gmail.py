@@ -0,0 +1,378 @@
+import re
+import gzip
+import json
+import time
+import base64
+import random
+import threading
+
+from typing import Any, Callable, Dict, List, Optional
+from datetime import datetime, timezone
+
+
+# This module holds a local, in-memory stand in for the gmail api service returned by
+# googleapiclient.discovery.build. It only implements the calls the EmailGrabber makes, and it counts
+# every http round trip (and the bytes of json that came back) so that the fetch paths can be compared offline.
+# Like the real api, every call takes a fields mask for a partial response.
+
+
+# roughly the size of the html part of a U e-ticket email
+_RECEIPT_HTML = (
+    b"<html><body><table>"
+    + b"".join(b'<tr><td style="font-family:Arial;font-size:12px;padding:4px">line %d</td></tr>' % i for i in range(150))
+    + b"</table></body></html>"
+)
+
+
+class _FakeResponse(dict):
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(status=str(status))
+        self.status = status
+        if retry_after is not None:
+            self["retry-after"] = str(retry_after)
+
+
+class FakeHttpError(Exception):
+    """
+    Stands in for googleapiclient's HttpError, which carries the status as .resp.status (and the headers in .resp)
+    """
+    def __init__(self, status: int, reason: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"<HttpError {status}: {reason}>")
+        self.resp = _FakeResponse(status, retry_after=retry_after)
+
+class FakeRequest:
+    """
+    Stands in for googleapiclient's HttpRequest. Calling execute() is one round trip.
+    """
+    def __init__(self, service: "FakeGmailService", fn: Callable[[], Dict[str, Any]], fields: Optional[str] = None):
+        self.service = service
+        self.fn = fn
+        self.fields = fields
+
+    def execute(self) -> Dict[str, Any]:
+        self.service._round_trip()
+        return self.respond()
+
+    def respond(self) -> Dict[str, Any]:
+        response = apply_fields(self.fn(), self.fields)
+        self.service._received(response)
+        return response
+
+
+class FakeBatch:
+    """
+    Stands in for googleapiclient's BatchHttpRequest. The whole batch is one round trip.
+    """
+    def __init__(self, service: "FakeGmailService", callback: Optional[Callable] = None):
+        self.service = service
+        self.callback = callback
+        self.requests: List[Any] = []
+
+    def add(self, request: FakeRequest, callback: Optional[Callable] = None, request_id: Optional[str] = None):
+        if len(self.requests) >= 100:
+            raise ValueError("Gmail batches are limited to 100 calls")
+        request_id = request_id if request_id is not None else str(len(self.requests))
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        self.service._round_trip()
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.respond(), None
+            except Exception as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+
+class _Attachments:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def get(self, userId: str, messageId: str, id: str, fields: Optional[str] = None) -> FakeRequest:
+        def fn():
+            data = self.service.attachments[(messageId, id)]
+            return {"attachmentId": id, "size": len(data), "data": base64.urlsafe_b64encode(data).decode("UTF-8")}
+        return FakeRequest(self.service, fn, fields)
+
+
+class _Messages:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def list(self, userId: str, labelIds: Optional[List[str]] = None, q: str = "", pageToken: Optional[str] = None, 
+             maxResults: int = 100, fields: Optional[str] = None) -> FakeRequest:
+        def fn():
+            if maxResults > 500:
+                raise FakeHttpError(400, "maxResults is at most 500")
+            matches = self.service._search(q)
+            start = int(pageToken or 0)
+            page = matches[start:start + maxResults]
+            resp: Dict[str, Any] = {"messages": [{"id": m["id"], "threadId": m["threadId"]} for m in page]}
+            if start + maxResults < len(matches):
+                resp["nextPageToken"] = str(start + maxResults)
+            return resp
+        return FakeRequest(self.service, fn, fields)
+
+    def get(self, userId: str, id: str, format: str = "full", metadataHeaders: Optional[List[str]] = None,
+            fields: Optional[str] = None) -> FakeRequest:
+        def fn():
+            m = self.service.messages[id]
+            if format == "full":
+                return m
+            out = {k: m[k] for k in ("id", "threadId", "labelIds", "internalDate")}
+            if format == "metadata":
+                wanted = {h.lower() for h in metadataHeaders or []}
+                headers = [h for h in m["payload"]["headers"] if not wanted or h["name"].lower() in wanted]
+                out["payload"] = {"headers": headers}
+            return out
+        return FakeRequest(self.service, fn, fields)
+
+    def attachments(self) -> _Attachments:
+        return _Attachments(self.service)
+
+
+class _History:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def list(self, userId: str, startHistoryId: str, historyTypes: Optional[List[str]] = None, labelId: Optional[str] = None,
+             pageToken: Optional[str] = None, maxResults: int = 100, fields: Optional[str] = None) -> FakeRequest:
+        def fn():
+            start = int(startHistoryId)
+            if start < self.service.oldest_history_id:
+                raise FakeHttpError(404, "Requested entity was not found.")
+            records = [
+                {"id": str(history_id), "messagesAdded": [{"message": {"id": message_id, "labelIds": ["INBOX"]}}]}
+                for history_id, message_id in self.service.history
+                if history_id > start
+            ]
+            offset = int(pageToken or 0)
+            resp: Dict[str, Any] = {"history": records[offset:offset + maxResults], "historyId": str(self.service.history_id)}
+            if offset + maxResults < len(records):
+                resp["nextPageToken"] = str(offset + maxResults)
+            return resp
+        return FakeRequest(self.service, fn, fields)
+
+
+class _Users:
+    def __init__(self, service: "FakeGmailService"):
+        self.service = service
+
+    def messages(self) -> _Messages:
+        return _Messages(self.service)
+
+    def history(self) -> _History:
+        return _History(self.service)
+
+    def getProfile(self, userId: str, fields: Optional[str] = None) -> FakeRequest:
+        return FakeRequest(self.service, lambda: {"emailAddress": "me@example.com", "historyId": str(self.service.history_id)}, fields)
+
+
+class FakeGmailService:
+    """
+    A fake gmail mailbox. latency is the number of seconds each round trip sleeps for, to mimic the network.
+    throttle_rate is the share of round trips that are turned away with a 429 (asking to retry after
+    retry_after seconds), drawn from a seeded generator so that runs are repeatable.
+    """
+    def __init__(self, latency: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 0.05, seed: int = 0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        # several grabbers (the shards of an account) can share one mailbox
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.bytes_received = 0
+        self.throttled = 0
+        self.messages: Dict[str, Dict[str, Any]] = {}
+        self.attachments: Dict[tuple, bytes] = {}
+        # every message added bumps the history id, like gmail does
+        self.history_id = 1000
+        self.history: List[tuple] = []
+        self.oldest_history_id = 0
+
+    def add_receipt(self, message_id: str, sender: str, internal_ms: int, pdf: bytes):
+        """
+        Adds a message from sender with a single pdf attachment to the mailbox. Like a real e-ticket it
+        also has an html body, which gmail sends inline with the full message.
+        """
+        attachment_id = f"att-{message_id}"
+        html = base64.urlsafe_b64encode(_RECEIPT_HTML).decode("ascii")
+        self.add_message({
+            "id": message_id,
+            "threadId": message_id,
+            "labelIds": ["INBOX"],
+            "snippet": "Merci de votre visite, voici votre ticket de caisse",
+            "sizeEstimate": len(pdf) + len(html),
+            "historyId": str(self.history_id + 1),
+            "internalDate": str(internal_ms),
+            "payload": {
+                "mimeType": "multipart/mixed",
+                "headers": [
+                    {"name": "From", "value": sender},
+                    {"name": "Subject", "value": "Votre ticket de caisse"},
+                    {"name": "Date", "value": datetime.fromtimestamp(internal_ms / 1000, tz=timezone.utc).strftime("%a, %d %b %Y %H:%M:%S +0000")},
+                ],
+                "parts": [
+                    {"mimeType": "text/html", "filename": "", "body": {"size": len(_RECEIPT_HTML), "data": html}},
+                    {"mimeType": "application/pdf", "filename": "ticket.pdf",
+                     "body": {"attachmentId": attachment_id, "size": len(pdf)}},
+                ],
+            },
+        }, {attachment_id: pdf})
+
+    def add_message(self, message: Dict[str, Any], attachments: Dict[str, bytes]):
+        """
+        Adds a message as gmail returns it in format="full", with its attachments by attachment id.
+        """
+        self.messages[message["id"]] = message
+        for attachment_id, data in attachments.items():
+            self.attachments[(message["id"], attachment_id)] = data
+        self.history_id += 1
+        self.history.append((self.history_id, message["id"]))
+
+    def save(self, path: str):
+        """
+        Writes the mailbox to a gzipped json fixture, which load() replays.
+        """
+        fixture = {
+            "messages": list(self.messages.values()),
+            "attachments": [
+                {"message_id": message_id, "attachment_id": attachment_id, "data": base64.b64encode(data).decode("ascii")}
+                for (message_id, attachment_id), data in self.attachments.items()
+            ],
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(fixture, f)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "FakeGmailService":
+        """
+        Reads a fixture written by save() (or recorded from a real mailbox, see benchmarks/record_fixtures.py).
+        kwargs go to the constructor.
+        """
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            fixture = json.load(f)
+        attachments: Dict[str, Dict[str, bytes]] = {}
+        for a in fixture["attachments"]:
+            attachments.setdefault(a["message_id"], {})[a["attachment_id"]] = base64.b64decode(a["data"])
+        service = cls(**kwargs)
+        for message in sorted(fixture["messages"], key=lambda m: int(m["internalDate"])):
+            service.add_message(message, attachments.get(message["id"], {}))
+        return service
+
+    def expire_history(self):
+        """
+        Forgets all history so far, i.e., what gmail does after about a week
+        """
+        self.oldest_history_id = self.history_id + 1
+
+    def users(self) -> _Users:
+        return _Users(self)
+
+    def new_batch_http_request(self, callback: Optional[Callable] = None) -> FakeBatch:
+        return FakeBatch(self, callback=callback)
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+            throttle = self.throttle_rate and self._random.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            raise FakeHttpError(429, "rateLimitExceeded", retry_after=self.retry_after)
+
+    def _received(self, response: Dict[str, Any]):
+        size = len(json.dumps(response))
+        with self._lock:
+            self.bytes_received += size
+
+    def _search(self, q: str) -> List[Dict[str, Any]]:
+        """
+        Understands the from: and after: parts of the query, and returns newest first like gmail does.
+        """
+        senders = re.search(r"from:\(([^)]*)\)|from:(\S+)", q)
+        wanted = (
+            {s.strip() for s in (senders.group(1) or senders.group(2)).split(" OR ")}
+            if senders else None
+        )
+        after = re.search(r"after:(\d{4}/\d{2}/\d{2})", q)
+        after_ms = (
+            int(datetime.strptime(after.group(1), "%Y/%m/%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+            if after else 0
+        )
+        out = []
+        for m in self.messages.values():
+            from_header = next(h["value"] for h in m["payload"]["headers"] if h["name"] == "From")
+            if wanted is not None and from_header not in wanted:
+                continue
+            if int(m["internalDate"]) < after_ms:
+                continue
+            out.append(m)
+        out.sort(key=lambda m: int(m["internalDate"]), reverse=True)
+        return out
+
+
+def apply_fields(obj: Any, fields: Optional[str]) -> Any:
+    """
+    Cuts a response down to a partial response fields mask, i.e., 'id,payload(headers,parts/body/attachmentId)'.
+    """
+    if not fields:
+        return obj
+    return _select(obj, _parse_fields(fields))
+
+
+def _parse_fields(fields: str) -> Dict[str, Any]:
+    """
+    The mask as a tree of {field: {subfield: ...}}, an empty dict being the whole field.
+    """
+    tree: Dict[str, Any] = {}
+    stack = [tree]
+    current, path = "", []
+
+    def close():
+        nonlocal current, path
+        node = stack[-1]
+        for name in path + ([current] if current else []):
+            node = node.setdefault(name, {})
+        current, path = "", []
+        return node
+
+    for ch in fields:
+        if ch == "/":
+            path.append(current)
+            current = ""
+        elif ch == "(":
+            stack.append(close())
+        elif ch == ",":
+            close()
+        elif ch == ")":
+            close()
+            stack.pop()
+        else:
+            current += ch.strip()
+    close()
+    return tree
+
+
+def _select(obj: Any, tree: Dict[str, Any]) -> Any:
+    if not tree:
+        return obj
+    if isinstance(obj, list):
+        return [_select(item, tree) for item in obj]
+    if isinstance(obj, dict):
+        return {k: _select(obj[k], sub) for k, sub in tree.items() if k in obj}
+    return obj
+
+
+def make_mailbox(n: int, sender: str, latency: float = 0.0, start_ms: int = 1_700_000_000_000) -> FakeGmailService:
+    """
+    Builds a fake mailbox with n receipts from sender, one hour apart.
+    """
+    service = FakeGmailService(latency=latency)
+    for i in range(n):
+        service.add_receipt(f"m{i:06d}", sender, start_ms + i * 3_600_000, pdf=b"%PDF-1.4 fake receipt " + str(i).encode())
+    return service
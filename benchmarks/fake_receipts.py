@@ -0,0 +1,80 @@
+import random
+
+from typing import List, Tuple
+
+
+# This module writes small pdfs with a text layer laid out like the U Express e-tickets, so that the local
+# extractor can be exercised without real receipts. The pdf is written by hand (one page, Courier), it only
+# needs to be good enough for a text extractor to read back.
+
+HEADER = ["U EXPRESS", "12 RUE DU MARCHE", "75011 PARIS", "TEL 01 23 45 67 89", ""]
+PRODUCTS = ["LAIT DEMI ECREME 1L", "PAIN DE MIE COMPLET", "YAOURT NATURE X4", "POMMES GOLDEN KG", "BEURRE DOUX 250G",
+            "CAFE MOULU 250G", "PATES FUSILLI 500G", "TOMATES GRAPPE", "EMMENTAL RAPE 200G", "EAU MINERALE 6X1.5L"]
+WIDTH = 42
+
+
+def _money(value: float) -> str:
+    return f"{value:.2f}".replace(".", ",")
+
+
+def receipt_lines(items: List[Tuple[str, int, float]], discount: float = 0.0) -> List[str]:
+    """
+    items are (name, quantity, unit price). Quantities above one get an "N x PRICE" line under the item.
+    """
+    lines = list(HEADER)
+    total = 0.0
+    for name, quantity, unit in items:
+        price = round(quantity * unit, 2)
+        total += price
+        lines.append(f"{name:<{WIDTH - 10}}{_money(price) + ' €':>10}")
+        if quantity > 1:
+            lines.append(f"   {quantity} x {_money(unit)} €")
+    if discount:
+        lines.append(f"{'REMISE FIDELITE':<{WIDTH - 10}}{_money(-discount) + ' €':>10}")
+        total -= discount
+    lines += ["", f"{'TOTAL':<{WIDTH - 10}}{_money(total) + ' €':>10}", f"CB {_money(total)} €", "MERCI DE VOTRE VISITE"]
+    return lines
+
+
+def make_pdf(lines: List[str]) -> bytes:
+    """
+    Writes the lines top to bottom on one page.
+    """
+    def esc(s: str) -> str:
+        return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    text = ["BT", "/F1 10 Tf", "12 TL", "40 800 Td"]
+    for line in lines:
+        text.append(f"({esc(line)}) Tj T*")
+    text.append("ET")
+    stream = "\n".join(text).encode("cp1252")
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for off in offsets:
+        out += f"{off:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def make_receipt(seed: int) -> Tuple[bytes, List[Tuple[str, int, float]]]:
+    """
+    A random receipt. Returns the pdf and the (item, quantity, price) it should be read as.
+    """
+    rng = random.Random(seed)
+    items = [(name, rng.choice([1, 1, 1, 2, 3]), rng.randint(50, 900) / 100) for name in rng.sample(PRODUCTS, rng.randint(3, 8))]
+    discount = rng.choice([0.0, 0.0, 0.5])
+    pdf = make_pdf(receipt_lines(items, discount=discount))
+    return pdf, [(name, quantity, round(quantity * unit, 2)) for name, quantity, unit in items]
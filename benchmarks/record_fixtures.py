@@ -0,0 +1,59 @@
+import os
+import base64
+import argparse
+
+from typing import Dict
+
+from email_service.email_grabber import EmailGrabber
+from model.model_output import ModelOutput
+from model.model_wrapper import Gemini
+from model.extraction_cache import ExtractionCache
+from utils.utils import setup, load_config
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.fake_gemini import save_outputs
+
+# Records the latest receipts of the real mailbox as fixtures for bench_end_to_end.py: the gmail list/get/attachment
+# responses go to gmail.json.gz, and the model's answer for each pdf to gemini.json.gz. Answers already in the
+# extraction cache don't cost a model call. The fixtures hold real receipts, keep them out of git.
+# Run from the repo root with: python -m benchmarks.record_fixtures [--limit 100] [--out benchmarks/fixtures]
+# then replay them with: python -m benchmarks.bench_end_to_end --fixtures benchmarks/fixtures
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+
+
+def record(limit: int, out: str):
+    cfg = load_config()
+    credentials = setup(SCOPES=SCOPES)
+    grabber = EmailGrabber(credentials=credentials, senders=cfg["senders"])
+    gemini = Gemini(model_name=cfg["model_name"], temperature=cfg["temperature"], cache=ExtractionCache.from_config(os.getcwd(), cfg))
+    messages = grabber.service.users().messages()
+
+    recorded = FakeGmailService()
+    outputs: Dict[str, str] = {}
+    # newest first, like the listing
+    for listed in grabber._list_message_ids()[:limit]:
+        message = messages.get(userId="me", id=listed["id"], format="full").execute()
+        attachment_id = grabber._find_pdf_attachment_id(message)
+        if attachment_id is None:
+            continue
+        attachment = messages.attachments().get(userId="me", messageId=listed["id"], id=attachment_id).execute()
+        recorded.add_message(message, {attachment_id: base64.urlsafe_b64decode(attachment["data"].encode("UTF-8"))})
+
+        payload = grabber._build_payload(message, attachment)
+        mo = gemini.respond(payload)
+        if isinstance(mo, ModelOutput):
+            outputs[payload["pdf_sha256"]] = mo.raw
+        print(f"Recorded {len(recorded.messages)} receipts")
+
+    os.makedirs(out, exist_ok=True)
+    recorded.save(os.path.join(out, "gmail.json.gz"))
+    save_outputs(outputs, os.path.join(out, "gemini.json.gz"))
+    print(f"{len(recorded.messages)} receipts and {len(outputs)} model answers written to {out}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", type=int, default=100, help="number of the latest receipts to record")
+    parser.add_argument("--out", default=os.path.join("benchmarks", "fixtures"))
+    args = parser.parse_args()
+    record(limit=args.limit, out=args.out)
@@ -0,0 +1,32 @@
+import os
+import argparse
+
+from email_service.blob_store import BlobStore
+from utils.utils import load_config
+
+# The local copy of the receipt pdfs (cache/pdfs, see [blobs] in config.toml) only drops the index entries of what it
+# evicts, and deletes a pack file once nothing in it is used anymore. This script rewrites the packs to give the
+# space of everything else that was evicted back to the disk. With --max-mb it first shrinks the store to that size.
+
+cwd = os.getcwd()
+
+def main(max_mb: int = 0):
+  cfg = load_config()
+  blobs = BlobStore.from_config(cwd, cfg)
+  if blobs is None:
+    print("The pdf store is turned off in config.toml ([blobs] enabled = false)")
+    return
+
+  result = blobs.compact(max_bytes=max_mb * 1024 * 1024 if max_mb else None)
+  stats = blobs.stats()
+  blobs.close()
+
+  print(f"{stats['pdfs']} pdfs for {stats['messages']} emails in {stats['packs']} packs")
+  print(f"Rewrote {result['packs_rewritten']} packs: {result['bytes_before'] / 2**20:.1f} MB -> {result['bytes_after'] / 2**20:.1f} MB on disk")
+  print("🤖: Done!")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Give the space of evicted pdfs in the local pdf store back to the disk")
+  parser.add_argument("--max-mb", type=int, default=0, help="evict the least recently used pdfs down to this size first")
+  args = parser.parse_args()
+  main(max_mb=args.max_mb)
@@ -0,0 +1,87 @@
+import os
+import time
+
+from google.auth.exceptions import RefreshError
+
+from email_service.blob_store import BlobStore
+from email_service.sharded_grabber import ShardedGrabber, ShardedHistorySync
+from model.model_wrapper import Gemini
+from model.extraction_cache import ExtractionCache
+from model.local_extractor import LocalExtractor
+from pipeline.extraction import ExtractionPipeline
+from pipeline.committer import BatchCommitter
+from writers.excel_writer import ExcelWriter
+from writers.sqlite_writer import SQLiteWriter
+from utils import metrics
+from utils.http_pool import HttpPool
+from utils.utils import read_checkpoint, setup, load_config
+
+
+# The long running version of update.py. The clients are built once and kept warm, and the mailbox is checked
+# every poll_seconds through the gmail history api, so a new receipt is in the spreadsheet within seconds
+# instead of at the next scheduled update.
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+cwd = os.getcwd()
+cfg = load_config()
+model_name = cfg["model_name"]
+temperature = cfg["temperature"]
+checkpoint_file_path = os.path.join(cwd, "checkpoint.json")
+poll_seconds = cfg.get("daemon", {}).get("poll_seconds", 15)
+metrics_port = cfg.get("daemon", {}).get("metrics_port", 0)
+
+def main():
+
+  # one keep-alive connection pool for every gmail and gemini call, so the connections stay warm between polls
+  http_pool = HttpPool.from_config(cfg)
+  # every downloaded pdf is kept on disk, see [blobs] in config.toml
+  blobs = BlobStore.from_config(cwd, cfg)
+  # one grabber per gmail account in config.toml, each with its own token and quota
+  mail_grabber = ShardedGrabber.from_config(
+    cfg, credentials_for=lambda account: setup(SCOPES=SCOPES, token_path=account.token_path), http=http_pool, blobs=blobs
+  )
+  print("Credentials validated")
+  extraction_cache = ExtractionCache.from_config(cwd, cfg)
+  local_extractor = LocalExtractor.from_config(cfg)
+  gemini = Gemini(model_name=model_name, temperature=temperature, cache=extraction_cache, http=http_pool)
+  store = SQLiteWriter(app_directory=cwd)
+  excel_writer = ExcelWriter(app_directory=cwd)
+  pipeline = ExtractionPipeline.from_config(gemini=gemini, cfg=cfg, local=local_extractor)
+  history_sync = ShardedHistorySync(grabber=mail_grabber, checkpoint_path=checkpoint_file_path)
+
+  # finish anything a previous, interrupted run left between the store and the spreadsheet
+  excel_writer.sync(store)
+  if metrics_port:
+    metrics.serve(metrics_port)
+    print(f"Serving metrics on http://127.0.0.1:{metrics_port}/metrics")
+  print(f"Watching for new receipts every {poll_seconds}s")
+
+  while True:
+    since = metrics.snapshot()
+    try:
+      payloads, history_id, max_ms = history_sync.poll(skip_ids=store.journal.done_ids())
+      if payloads:
+        print(f"{len(payloads)} new receipts")
+        committer = BatchCommitter.from_config(
+          store=store, excel_writer=excel_writer, checkpoint_path=checkpoint_file_path, cfg=cfg,
+          checkpoint_ms=read_checkpoint(checkpoint_file_path)
+        )
+        for payload, mo in pipeline.run(payloads):
+          committer.add(payload, mo)
+        committer.flush()
+      # only once the rows are written, so a crash means listing the same changes again, not losing them
+      history_sync.commit(history_id=history_id, max_ms=max_ms)
+      if payloads:
+        # one summary per batch of receipts, the empty polls would only bury them
+        metrics.write_summary(os.path.join(cwd, "logs"), run="daemon", since=since, receipts=len(payloads))
+    except RefreshError:
+      # a revoked token needs the browser, which a background process can't open
+      print("Token expired or revoked, run update.py once by hand to re-authorize")
+      return
+    except Exception as e:
+      # network trouble and the like, the next poll picks up from the same place
+      print(f"Sync failed: {e}")
+    time.sleep(poll_seconds)
+
+if __name__ == "__main__":
+  main()
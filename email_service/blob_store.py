@@ -0,0 +1,395 @@
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import threading
+
+from datetime import date
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+# This module holds the local copy of every receipt pdf downloaded from gmail, so a re-run, a re-extraction with a
+# new prompt or model, or a benchmark reads them from disk instead of the network.
+#
+# The pdfs are appended to pack files (pack-000001.bin, ...) and memory-mapped for reading, with a sqlite index of
+# where each one is. They are stored once per content (sha256), and looked up by gmail message id: gmail hands out a
+# new attachment id every time a message is fetched, so the attachment id is kept but can't be what finds a pdf.
+# Past max_bytes the least recently used pdfs are dropped from the index. A pack is deleted once nothing in it is
+# used anymore, and compact() (python compact.py) rewrites the packs to give back the space of the rest.
+
+PACK_PREFIX = "pack-"
+PACK_SUFFIX = ".bin"
+
+
+class BlobStore:
+    """
+    This class is a size bounded, content addressed store of receipt pdfs, with the message details needed to hand
+    them to the pipeline again (see payload()). Reads are served from memory maps of the packs, and every pdf is
+    checked against its sha256 on the way out, so a pack cut short by a crash reads as a miss, never as a bad pdf.
+    """
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024, pack_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.pack_bytes = pack_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        # the shards of the grabber call in from several threads, so everything is behind one lock
+        self._lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._conn = sqlite3.connect(os.path.join(path, "index.sqlite3"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "sha256 TEXT PRIMARY KEY, pack INTEGER NOT NULL, offset INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS blobs_pack ON blobs (pack)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS attachments ("
+            "message_id TEXT NOT NULL, attachment_id TEXT NOT NULL, sha256 TEXT NOT NULL, internal_ms INTEGER NOT NULL, "
+            "date TEXT, sender TEXT, account TEXT, PRIMARY KEY (message_id, attachment_id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS attachments_message ON attachments (message_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        packs = self._packs()
+        self._pack = packs[-1] if packs else 1
+
+    @classmethod
+    def from_config(cls, app_directory: str, cfg: Dict[str, Any]) -> Optional["BlobStore"]:
+        """
+        Builds the store from the [blobs] table of config.toml. Returns None if it is turned off.
+        """
+        blobs_cfg = cfg.get("blobs", {})
+        if not blobs_cfg.get("enabled", True):
+            return None
+        return cls(
+            path=os.path.join(app_directory, blobs_cfg.get("path", os.path.join("cache", "pdfs"))),
+            max_bytes=int(blobs_cfg.get("max_mb", 1024)) * 1024 * 1024,
+            pack_bytes=int(blobs_cfg.get("pack_mb", 64)) * 1024 * 1024,
+        )
+
+    def put(
+            self,
+            message_id: str,
+            attachment_id: str,
+            data: bytes,
+            sha256: Optional[str] = None,
+            internal_ms: int = 0,
+            date: Optional[date] = None,
+            sender: Optional[str] = None,
+            account: Optional[str] = None
+        ) -> str:
+        """
+        Stores the pdf of a message (only once if another message already has the same one). Returns its sha256.
+        """
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._put(message_id, attachment_id, data, sha256, internal_ms, date, sender, account)
+            self._evict()
+            self._conn.commit()
+        return sha256
+
+    def put_payloads(self, payloads: List[Dict[str, Any]], attachment_ids: Dict[str, str]):
+        """
+        put() for the payloads of a batch (see EmailGrabber._build_payload), in one transaction.
+        attachment_ids is {message_id: attachment_id}.
+        """
+        with self._lock:
+            for p in payloads:
+                self._put(
+                    p["message_id"], attachment_ids[p["message_id"]], p["file_data"], p["pdf_sha256"], p["internal_ms"],
+                    p["date"], p["sender"], p["account"],
+                )
+            self._evict()
+            self._conn.commit()
+
+    def get(self, sha256: str) -> Optional[bytes]:
+        """
+        The pdf with this sha256, or None if it isn't stored (anymore).
+        """
+        view = self.view(sha256)
+        return bytes(view) if view is not None else None
+
+    def view(self, sha256: str) -> Optional[memoryview]:
+        """
+        Same as get, without copying the pdf out of the memory map. Only good until compact() or close().
+        """
+        with self._lock:
+            views = self._views([sha256])
+            self._touch(list(views))
+        return views.get(sha256)
+
+    def payload(self, message_id: str) -> Optional[Dict[str, Any]]:
+        return self.payloads([message_id]).get(message_id)
+
+    def payloads(self, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        {message_id: payload} for the messages whose pdf is stored, in the same form as the grabber builds them
+        (see EmailGrabber._build_payload), so they can skip gmail altogether.
+        """
+        out: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            rows: List[Tuple] = []
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i:i + 500]
+                rows.extend(self._conn.execute(
+                    "SELECT message_id, sha256, internal_ms, date, sender, account FROM attachments "
+                    f"WHERE message_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall())
+            views = self._views(list({row[1] for row in rows}))
+            self._touch(list(views))
+            for message_id, sha256, internal_ms, date_str, sender, account in rows:
+                if sha256 in views and message_id not in out:
+                    out[message_id] = self._payload(message_id, sha256, bytes(views[sha256]), internal_ms, date_str, sender, account)
+        self.hits += len(out)
+        self.misses += len(set(message_ids)) - len(out)
+        return out
+
+    def messages(self) -> List[Tuple[str, str]]:
+        """
+        (message id, pdf sha256) of every stored receipt, oldest first, without reading the pdfs.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT message_id, MIN(sha256) FROM attachments GROUP BY message_id ORDER BY MIN(internal_ms), message_id"
+            ).fetchall()
+
+    def iter_payloads(self) -> Iterator[Dict[str, Any]]:
+        """
+        Every stored receipt as a payload, oldest first, i.e., to extract them again or benchmark offline without gmail.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT message_id, sha256, internal_ms, date, sender, account FROM attachments ORDER BY internal_ms, message_id"
+            ).fetchall()
+        seen = set()
+        for i in range(0, len(rows), 500):
+            chunk = [row for row in rows[i:i + 500] if row[0] not in seen]
+            with self._lock:
+                views = self._views(list({row[1] for row in chunk}))
+            for message_id, sha256, internal_ms, date_str, sender, account in chunk:
+                if sha256 in views:
+                    seen.add(message_id)
+                    yield self._payload(message_id, sha256, bytes(views[sha256]), internal_ms, date_str, sender, account)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            pdfs = self._conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+            messages = self._conn.execute("SELECT COUNT(DISTINCT message_id) FROM attachments").fetchone()[0]
+            disk = sum(os.path.getsize(self._pack_path(pack)) for pack in self._packs())
+        return {
+            "hits": self.hits, "misses": self.misses, "pdfs": pdfs, "messages": messages,
+            "bytes": self._total_bytes, "disk_bytes": disk, "packs": len(self._packs()),
+        }
+
+    def compact(self, max_bytes: Optional[int] = None) -> Dict[str, int]:
+        """
+        Evicts down to max_bytes (the store's own if not given), then rewrites every pack with space in it that
+        nothing uses anymore (evicted pdfs, or a write cut short) into new packs, and deletes the old ones.
+        Returns the disk usage before and after.
+        """
+        with self._lock:
+            before = sum(os.path.getsize(self._pack_path(pack)) for pack in self._packs())
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+            self._conn.commit()
+
+            live = dict(self._conn.execute("SELECT pack, SUM(size) FROM blobs GROUP BY pack").fetchall())
+            stale = [pack for pack in self._packs() if live.get(pack, 0) < os.path.getsize(self._pack_path(pack))]
+            if stale:
+                # copy into packs of their own, so nothing is appended to a pack that is about to go
+                self._pack = self._packs()[-1] + 1
+                for pack in stale:
+                    rows = self._conn.execute(
+                        "SELECT sha256, offset, size FROM blobs WHERE pack = ? ORDER BY offset", (pack,)
+                    ).fetchall()
+                    source = self._map(pack)
+                    for sha256, offset, size in rows:
+                        new_pack, new_offset = self._append(source[offset:offset + size])
+                        self._conn.execute("UPDATE blobs SET pack = ?, offset = ? WHERE sha256 = ?", (new_pack, new_offset, sha256))
+                # the old packs are only deleted once the index points at the new ones
+                self._conn.commit()
+                for pack in stale:
+                    self._drop_pack(pack)
+            self._conn.execute("VACUUM")
+            after = sum(os.path.getsize(self._pack_path(pack)) for pack in self._packs())
+        return {"bytes_before": before, "bytes_after": after, "packs_rewritten": len(stale), "live_bytes": self._total_bytes}
+
+    def close(self):
+        with self._lock:
+            for m in self._maps.values():
+                self._close_map(m)
+            self._maps.clear()
+            self._conn.close()
+
+# Helpers
+
+    def _put(
+            self,
+            message_id: str,
+            attachment_id: str,
+            data: bytes,
+            sha256: str,
+            internal_ms: int,
+            date: Optional[date],
+            sender: Optional[str],
+            account: Optional[str]
+        ):
+        """
+        Expects the lock to be held, and leaves evicting and committing to the caller.
+        """
+        if self._conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone() is None:
+            pack, offset = self._append(data)
+            self._conn.execute(
+                "INSERT INTO blobs (sha256, pack, offset, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (sha256, pack, offset, len(data), time.time()),
+            )
+            self._total_bytes += len(data)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO attachments (message_id, attachment_id, sha256, internal_ms, date, sender, account) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (message_id, attachment_id, sha256, internal_ms, date.isoformat() if date else None, sender, account),
+        )
+
+    def _pack_path(self, pack: int) -> str:
+        return os.path.join(self.path, f"{PACK_PREFIX}{pack:06d}{PACK_SUFFIX}")
+
+    def _packs(self) -> List[int]:
+        return sorted(
+            int(name[len(PACK_PREFIX):-len(PACK_SUFFIX)]) for name in os.listdir(self.path)
+            if name.startswith(PACK_PREFIX) and name.endswith(PACK_SUFFIX)
+        )
+
+    def _append(self, data: Any) -> Tuple[int, int]:
+        """
+        Writes data to the end of the current pack, starting a new one when it is full. Returns (pack, offset).
+        Expects the lock to be held.
+        """
+        path = self._pack_path(self._pack)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset and offset + len(data) > self.pack_bytes:
+            self._pack += 1
+            path, offset = self._pack_path(self._pack), 0
+        with open(path, "ab") as f:
+            f.write(data)
+        return self._pack, offset
+
+    def _map(self, pack: int, end: int = 0) -> mmap.mmap:
+        """
+        The read only memory map of a pack, mapped again if the pack has grown past end since.
+        """
+        m = self._maps.get(pack)
+        if m is None or len(m) < end:
+            if m is not None:
+                self._close_map(m)
+            with open(self._pack_path(pack), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack] = m
+        return m
+
+    def _views(self, sha256s: List[str]) -> Dict[str, memoryview]:
+        """
+        {sha256: the pdf in its memory map} for the ones that are stored and intact. Expects the lock to be held.
+        """
+        out: Dict[str, memoryview] = {}
+        broken = []
+        for i in range(0, len(sha256s), 500):
+            chunk = sha256s[i:i + 500]
+            rows = self._conn.execute(
+                f"SELECT sha256, pack, offset, size FROM blobs WHERE sha256 IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for sha256, pack, offset, size in rows:
+                try:
+                    view = memoryview(self._map(pack, end=offset + size))[offset:offset + size]
+                except (OSError, ValueError):
+                    view = None
+                if view is None or len(view) != size or hashlib.sha256(view).hexdigest() != sha256:
+                    # the pack is gone or was cut short, the pdf is downloaded again next time
+                    broken.append(sha256)
+                    continue
+                out[sha256] = view
+        if broken:
+            self._forget(broken)
+            self._conn.commit()
+        return out
+
+    def _touch(self, sha256s: List[str]):
+        if not sha256s:
+            return
+        now = time.time()
+        self._conn.executemany("UPDATE blobs SET last_used = ? WHERE sha256 = ?", [(now, s) for s in sha256s])
+        self._conn.commit()
+
+    def _forget(self, sha256s: List[str]):
+        """
+        Drops pdfs from the index, together with the messages that point at them. Expects the lock to be held.
+        """
+        for sha256 in sha256s:
+            row = self._conn.execute("SELECT size FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is None:
+                continue
+            self._conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            self._conn.execute("DELETE FROM attachments WHERE sha256 = ?", (sha256,))
+            self._total_bytes -= row[0]
+
+    def _evict(self):
+        """
+        Drops the least recently used pdfs until the store fits in max_bytes again, and deletes the packs that
+        are left with nothing in use. Expects the lock to be held.
+        """
+        evicted = False
+        while self._total_bytes > self.max_bytes:
+            oldest = self._conn.execute("SELECT sha256, size FROM blobs ORDER BY last_used ASC LIMIT 64").fetchall()
+            if not oldest:
+                break
+            for sha256, size in oldest:
+                self._forget([sha256])
+                evicted = True
+                if self._total_bytes <= self.max_bytes:
+                    break
+        if evicted:
+            used = {pack for (pack,) in self._conn.execute("SELECT DISTINCT pack FROM blobs").fetchall()}
+            for pack in self._packs():
+                if pack not in used and pack != self._pack:
+                    self._drop_pack(pack)
+
+    def _drop_pack(self, pack: int):
+        m = self._maps.pop(pack, None)
+        if m is not None:
+            self._close_map(m)
+        os.remove(self._pack_path(pack))
+
+    @staticmethod
+    def _close_map(m: mmap.mmap):
+        try:
+            m.close()
+        except BufferError:
+            # a view() into it is still around, the mapping goes when that does
+            pass
+
+    @staticmethod
+    def _payload(
+            message_id: str,
+            sha256: str,
+            file_data: bytes,
+            internal_ms: int,
+            date_str: Optional[str],
+            sender: Optional[str],
+            account: Optional[str]
+        ) -> Dict[str, Any]:
+        return {
+            "file_data": file_data,
+            "date": date.fromisoformat(date_str) if date_str else None,
+            "internal_ms": internal_ms,
+            "message_id": message_id,
+            "pdf_sha256": sha256,
+            "sender": sender,
+            "account": account,
+        }
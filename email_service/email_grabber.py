@@ -1,68 +1,222 @@
 import base64
+import hashlib
 
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterator, Optional, Set, Tuple
 from datetime import datetime, timezone, date
 
-from email.utils import parsedate_to_datetime
+from email.utils import parsedate_to_datetime, parseaddr
 from google.oauth2.credentials import Credentials  # your creds type
-from googleapiclient.discovery import build
+
+from utils import metrics
+from utils.rate_limiter import RateLimiter, error_status
+from email_service.blob_store import BlobStore
+
+
+# gmail accepts up to 100 calls per batch, but recommends staying at 50 to avoid rate limiting
+BATCH_SIZE = 50
+# quota units per call, for the per-user quota (messages.list, messages.get and attachments.get all cost 5)
+QUOTA_UNITS = 5
+# the most messages.list hands back per page
+LIST_PAGE_SIZE = 500
+# senders OR'ed into one search, more than this and the query gets long enough for gmail to turn it down
+SENDERS_PER_QUERY = 20
+# partial responses (the fields parameter): only what the grabber reads out of each response. A "full" message
+# then comes without the bodies of its html and text parts, i.e., just the headers and where the pdf is.
+FIELDS = {
+    "list": "messages/id,nextPageToken",
+    "full": "id,internalDate,payload(headers,parts(mimeType,filename,body/attachmentId))",
+    "metadata": "id,threadId,labelIds,internalDate,payload/headers",
+    "minimal": "id,internalDate",
+    "attachment": "data",
+    "profile": "historyId",
+    "history": "history/messagesAdded/message/id,historyId,nextPageToken",
+}
+
+
+class HistoryExpired(Exception):
+    """
+    The stored historyId is too old for gmail to list changes from (it keeps about a week), so a full
+    listing is needed instead.
+    """
 
 
 class EmailGrabber:
-    def __init__(self, credentials: Credentials, senders: List):
-        self.service = build("gmail", "v1", credentials=credentials)
+    # class attributes, so that benchmarks/bench_gmail_fetch.py can compare against full responses and small pages
+    fields: Dict[str, Optional[str]] = FIELDS
+    page_size: int = LIST_PAGE_SIZE
+    senders_per_query: int = SENDERS_PER_QUERY
+
+    def __init__(
+            self,
+            credentials: Credentials,
+            senders: List,
+            service: Optional[Any] = None,
+            limiter: Optional[RateLimiter] = None,
+            account: Optional[str] = None,
+            http: Optional[Any] = None,
+            blobs: Optional[BlobStore] = None
+        ):
+        # service can be handed in directly, i.e., a fake gmail service for benchmarking
+        self.credentials = credentials
+        self._given_service = service
+        # a thread-safe transport (utils/http_pool.py) to build the client on, instead of its own httplib2 connection
+        self.http = http
+        self.service = service if service is not None else self._build_service(credentials, http=http)
         self.senders: List[str] = senders
+        # every call goes through the rate limiter if there is one (see utils/rate_limiter.py)
+        self.limiter = limiter
+        # which mailbox this is, None for the one from token.json (see email_service/sharded_grabber.py).
+        # It goes into every payload, so the checkpoint of the right mailbox moves along with it
+        self.account = account
+        # the local copy of the pdfs (see email_service/blob_store.py). Receipts in it aren't downloaded again
+        self.blobs = blobs
+
+    def shard(self, senders: List[str]) -> "EmailGrabber":
+        """
+        A grabber on the same mailbox and quota, for some of the senders. On the shared http pool it uses the
+        same gmail client, otherwise it gets its own, since httplib2 connections can't be shared between threads.
+        """
+        return EmailGrabber(
+            credentials=self.credentials,
+            senders=senders,
+            service=self.service if self.http is not None else self._given_service,
+            limiter=self.limiter,
+            account=self.account,
+            http=self.http,
+            blobs=self.blobs,
+        )
 
 
-    def ingest_historical_messages(self) -> List[Dict[str, Any]]:
+    def ingest_historical_messages(self, skip_ids: Optional[Set[str]] = None) -> List[Dict[str, Any]]:
         """
         Searches for and ingests all previous messages from sender(s)
-        Returns a list of {"file_data": bytes, "date": date, internal_ms: internal ms}
+        Returns a list of {"file_data": bytes, "date": date, internal_ms: internal ms, message_id: gmail message id, 
+        pdf_sha256: hash of file_data, sender: from address, account: the grabber's account}
+        """
+        return list(self.iter_historical_messages(skip_ids=skip_ids))
+
+    def iter_historical_messages(self, skip_ids: Optional[Set[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Same as ingest_historical_messages, but yields the payloads oldest first as each batch comes in,
+        so that the model can start on them before everything is downloaded.
+        Messages in skip_ids (i.e., already done in a previous run) are never fetched.
         """
         historical_messages = self._list_message_ids(after_date_str=None)
+        if skip_ids:
+            historical_messages = [m for m in historical_messages if m["id"] not in skip_ids]
         #gmail api puts newest first but we want oldest first
         historical_messages.reverse()
-        payloads: List[Dict[str, Any]] = []
-        for message in historical_messages:
-            payload = self._get_attachment_payload(message=message)
-            if payload is not None:
-                payloads.append(payload)
-        return payloads
+        # go through in batch sized chunks so that only one chunk of full messages is held at a time
+        for i in range(0, len(historical_messages), BATCH_SIZE):
+            chunk = historical_messages[i:i + BATCH_SIZE]
+            yield from self._fetch_payloads(messages=chunk)
 
-    def ingest_new_messages(self, last_internal_ms: int) -> Tuple[List[Dict[str, Any]], int]:
+    def ingest_new_messages(
+            self, 
+            last_internal_ms: int, 
+            skip_ids: Optional[Set[str]] = None,
+            seen: Optional[Dict[str, int]] = None
+        ) -> Tuple[List[Dict[str, Any]], int, Dict[str, int]]:
         """
         This takes in the last internal milisecond timestamp of ingested emails, and only grabs emails
-        that are newer than that.
-        Returns a tuple: list of {"file_data": bytes, "date": date, internal_ms: internal ms} as well as an int max_ms
+        that are newer than that. Messages in skip_ids still count towards max_ms, but their attachments aren't fetched.
+        seen is {message_id: internal ms} for the messages a previous run already looked at, which aren't fetched at all.
+        Returns a tuple: list of {"file_data": bytes, "date": date, internal_ms: internal ms, message_id: gmail message id,
+        pdf_sha256: hash of file_data, sender: from address}, an int max_ms, and the seen dict to hand to the next run
         """
+        seen = seen or {}
         # coarse day filter for the query
         after_str = self._coarse_after_from_ms(ms=last_internal_ms)
         candidate_ids = self._list_message_ids(after_date_str=after_str) # newest to oldest
 
         # now we have to filter the candidate ids by the internalDate, which is the most precise time. Because there might be more than one on 
-        # each day.
-        newer: List[Tuple[Dict[str, str], int]] = []
+        # each day. format="minimal" is enough for that, only the messages that turn out to be newer are fetched in full.
+        unseen = [m["id"] for m in candidate_ids if m["id"] not in seen]
+        minimal = self._batch_get_messages(message_ids=unseen, format="minimal") if unseen else {}
+
+        newer: List[Dict[str, str]] = []
         max_ms = last_internal_ms
+        internal_ms: Dict[str, int] = {}
 
         for m in candidate_ids:
-            msg = self.service.users().messages().get(
-                userId="me", id=m['id'], format="full"
-            ).execute()
+            if m["id"] in seen:
+                internal_ms[m["id"]] = seen[m["id"]]
+                continue
+            msg = minimal.get(m["id"])
+            if msg is None:
+                # failed inside the batch, get it on its own
+                msg = self._execute(self._get_message(m["id"], format="minimal"))
             ms = int(msg.get("internalDate", 0))
+            internal_ms[m["id"]] = ms
             if ms > last_internal_ms:
-                newer.append((m, ms))
+                if not skip_ids or m["id"] not in skip_ids:
+                    newer.append(m)
                 if ms > max_ms:
                     max_ms = ms
         
         newer.reverse() # again, api returns newest first
-        payloads: List[Dict[str, Any]] = []
-        
-        for message, ms in newer:
-            payload = self._get_attachment_payload(message=message, internal_ms_hint=ms)
-            if payload is not None:
-                payloads.append(payload)
+        payloads = self._fetch_payloads(messages=newer)
+
+        return payloads, max_ms, self.seen_on_last_day(internal_ms, max_ms)
+
+    @staticmethod
+    def seen_on_last_day(internal_ms: Dict[str, int], max_ms: int) -> Dict[str, int]:
+        """
+        Keeps the messages the next day search will list again, i.e., the ones from the same day as max_ms.
+        """
+        after_str = EmailGrabber._coarse_after_from_ms(ms=max_ms)
+        if after_str is None:
+            return {}
+        day_start_ms = int(datetime.strptime(after_str, "%Y/%m/%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+        return {message_id: ms for message_id, ms in internal_ms.items() if ms >= day_start_ms}
 
-        return payloads, max_ms
+    def current_history_id(self) -> str:
+        """
+        The mailbox's latest historyId. Everything that happens after this can be listed with ingest_history.
+        """
+        return str(self._execute(self.service.users().getProfile(userId="me", fields=self.fields["profile"]))["historyId"])
+
+    def ingest_history(self, start_history_id: str, skip_ids: Optional[Set[str]] = None) -> Tuple[List[Dict[str, Any]], str]:
+        """
+        Gets the receipts added to the inbox since start_history_id, from the gmail history api, instead of 
+        searching by day. Only messages from the senders are downloaded in full, everything else is only 
+        looked at in metadata form.
+        Returns a tuple: the payloads oldest first (same as ingest_new_messages), and the historyId to start from next time.
+        Raises HistoryExpired if start_history_id is too old.
+        """
+        added_ids, latest_history_id = self._list_history(start_history_id)
+        if skip_ids:
+            added_ids = [message_id for message_id in added_ids if message_id not in skip_ids]
+        if not added_ids:
+            return [], latest_history_id
+
+        metadata = self._batch_get_messages(message_ids=added_ids, format="metadata")
+        senders = {sender.lower() for sender in self.senders}
+        matching = []
+        for message_id in added_ids:
+            msg = metadata.get(message_id)
+            if msg is None:
+                # failed inside the batch, get it on its own
+                msg = self._execute(self._get_message(message_id, format="metadata"))
+            sender = self._parse_sender_from_headers(msg.get("payload", {}).get("headers", []))
+            if sender in senders and "INBOX" in msg.get("labelIds", ["INBOX"]):
+                matching.append({"id": message_id, "threadId": msg.get("threadId"), "internal_ms": int(msg.get("internalDate", 0))})
+
+        matching.sort(key=lambda m: m["internal_ms"])
+        return self._fetch_payloads(messages=matching), latest_history_id
+
+    @staticmethod
+    def _build_service(credentials: Credentials, http: Optional[Any] = None):
+        """
+        Builds the gmail client from the discovery document that ships with googleapiclient, rather than
+        fetching it from the discovery service on every run. The import is done here so that nothing pays
+        for it until a client is actually needed. http is an already authorized transport to use instead
+        of a new httplib2 one.
+        """
+        from googleapiclient.discovery import build
+        if http is not None:
+            return build("gmail", "v1", http=http, static_discovery=True, cache_discovery=False)
+        return build("gmail", "v1", credentials=credentials, static_discovery=True, cache_discovery=False)
 
     @staticmethod
     def _parse_date_from_headers(headers: List[Dict[str, str]]) -> Optional[date]:
@@ -79,6 +233,16 @@ class EmailGrabber:
         except Exception:
             return None
     
+    @staticmethod
+    def _parse_sender_from_headers(headers: List[Dict[str, str]]) -> Optional[str]:
+        """
+        This function gets the bare address out of the From header, i.e., 'U <ticket@u.fr>' -> 'ticket@u.fr'
+        """
+        from_val = next((h['value'] for h in headers if h.get("name")=="From"), None)
+        if not from_val:
+            return None
+        return parseaddr(from_val)[1].lower() or None
+
     @staticmethod
     def _coarse_after_from_ms(ms: int) -> Optional[str]:
         """
@@ -92,62 +256,268 @@ class EmailGrabber:
 
     def _list_message_ids(self, after_date_str: Optional[str] = None) -> List[Dict[str, str]]:
         """
-        This method gets all of the message ids. if an after_date_str is provided, such as in ingest_new_emails, 
-        it only gets messages on/after a certain date. Otherwise it gets everything from the specified senders. 
+        This method gets all of the message ids, newest first. if an after_date_str is provided, such as in 
+        ingest_new_emails, it only gets messages on/after a certain date. Otherwise it gets everything from the 
+        specified senders. The senders are OR'ed into one search (senders_per_query at a time), so a page of 
+        results covers all of them rather than one query per sender.
         """
         out: List[Dict[str, str]] = []
-        # loop through all of the senders you want to track in case there is more than one. 
-        for sender in self.senders:
+        for i in range(0, len(self.senders), self.senders_per_query):
             page_token = None
-            query = f"from:{sender} has:attachment"
-            if after_date_str:
-                query += f" after:{after_date_str}"
+            query = self._sender_query(self.senders[i:i + self.senders_per_query], after_date_str)
             while True:
-                resp = self.service.users().messages().list(
+                resp = self._execute(self.service.users().messages().list(
                     userId="me", 
                     labelIds=["INBOX"], 
                     q=query,
                     pageToken=page_token,
-                    maxResults=100
-                ).execute()
+                    maxResults=self.page_size,
+                    fields=self.fields["list"],
+                ))
                 out.extend(resp.get("messages", []))
                 page_token = resp.get("nextPageToken")
                 if not page_token:
                     break
+        if len(self.senders) > self.senders_per_query:
+            # several searches, each newest first
+            out = self._dedupe(out)
         return out
 
-    def _get_attachment_payload(self, message: Dict[str, Any], internal_ms_hint: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    @staticmethod
+    def _sender_query(senders: List[str], after_date_str: Optional[str] = None) -> str:
         """
-        This method gets the attachment payload for the model, and also grabs the associated date and internal ms or one.
+        i.e., 'from:(a@x.fr OR b@y.fr) has:attachment after:2024/01/31'
+        """
+        query = f"from:({' OR '.join(senders)}) has:attachment"
+        if after_date_str:
+            query += f" after:{after_date_str}"
+        return query
+
+    @staticmethod
+    def _dedupe(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        seen: Set[str] = set()
+        out = []
+        for m in messages:
+            if m["id"] not in seen:
+                seen.add(m["id"])
+                out.append(m)
+        return out
+
+    def _list_history(self, start_history_id: str) -> Tuple[List[str], str]:
+        """
+        This method pages through history.list and returns the ids of the messages added since start_history_id 
+        (oldest first, no duplicates), together with the mailbox's latest historyId.
+        """
+        added: Dict[str, None] = {}
+        latest_history_id = start_history_id
+        page_token = None
+        while True:
+            try:
+                resp = self._execute(self.service.users().history().list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded"],
+                    labelId="INBOX",
+                    pageToken=page_token,
+                    maxResults=500,
+                    fields=self.fields["history"],
+                ))
+            except Exception as e:
+                if error_status(e) == 404:
+                    raise HistoryExpired(f"historyId {start_history_id} is too old to list changes from") from e
+                raise
+            for record in resp.get("history", []):
+                for added_message in record.get("messagesAdded", []):
+                    added[added_message["message"]["id"]] = None
+            latest_history_id = str(resp.get("historyId", latest_history_id))
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                break
+        return list(added), latest_history_id
+
+    def _batch_execute(self, requests: Dict[str, Any]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        This method sends a dict of {request_id: request} through the gmail batch endpoint, BATCH_SIZE calls
+        per round trip. Returns {request_id: response}, where the response is None if that call failed in the batch.
+        """
+        results: Dict[str, Optional[Dict[str, Any]]] = {}
+
+        def _callback(request_id, response, exception):
+            results[request_id] = None if exception is not None else response
+
+        items = list(requests.items())
+        for i in range(0, len(items), BATCH_SIZE):
+            chunk = items[i:i + BATCH_SIZE]
+            batch = self.service.new_batch_http_request(callback=_callback)
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            # each call in the batch counts against the quota on its own
+            self._execute(batch, units=QUOTA_UNITS * len(chunk))
+        return results
+
+    def _execute(self, request: Any, units: int = QUOTA_UNITS) -> Any:
+        """
+        Executes a request (or a batch), through the rate limiter if there is one.
+        """
+        if self.limiter is None:
+            # the limiter records its own calls
+            with metrics.timed("gmail_call"):
+                result = request.execute()
+            metrics.count("api_calls_total", api="gmail")
+            return result
+        return self.limiter.call(request.execute, tokens=units)
+
+    def _batch_get_messages(self, message_ids: List[str], format: str = "full") -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        This method gets the content of several messages, batched. Returns {message_id: message_content}
+        format="metadata" only gets the From header, the labels and internalDate, which is all that's needed to
+        decide whether a message is worth fetching in full.
+        """
+        return self._batch_execute({message_id: self._get_message(message_id, format=format) for message_id in message_ids})
+
+    def _get_message(self, message_id: str, format: str = "full") -> Any:
+        """
+        The messages.get request for one message, asking only for the fields of that format the grabber uses.
+        """
+        extra = {"metadataHeaders": ["From"]} if format == "metadata" else {}
+        return self.service.users().messages().get(
+            userId="me", id=message_id, format=format, fields=self.fields[format], **extra
+        )
+
+    def _batch_get_attachments(self, attachment_ids: Dict[str, str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        This method gets the attachments for several messages, batched. It takes in {message_id: attachment_id}
+        and returns {message_id: attachment_content}
+        """
+        attachments = self.service.users().messages().attachments()
+        return self._batch_execute(
+            {
+                message_id: attachments.get(userId="me", messageId=message_id, id=attachment_id, fields=self.fields["attachment"])
+                for message_id, attachment_id in attachment_ids.items()
+            }
+        )
+
+    def _fetch_payloads(
+            self, 
+            messages: List[Dict[str, Any]], 
+            message_contents: Optional[Dict[str, Optional[Dict[str, Any]]]] = None
+        ) -> List[Dict[str, Any]]:
+        """
+        This method is the batched version of _get_attachment_payload. It takes in the listed messages, and optionally 
+        the full message contents if they were already fetched, and returns the payloads in the same order.
+        Anything that fails inside a batch goes through _get_attachment_payload on its own instead.
+        Receipts that are in the blob store come from there, without asking gmail for anything.
+        """
+        stored = self.blobs.payloads([m["id"] for m in messages]) if self.blobs is not None else {}
+        if stored:
+            metrics.count("blob_store_hits_total", len(stored))
+
+        message_contents = dict(message_contents or {})
+        missing = [m["id"] for m in messages if m["id"] not in stored and message_contents.get(m["id"]) is None]
+        if missing:
+            message_contents.update(self._batch_get_messages(message_ids=missing))
+
+        attachment_ids: Dict[str, str] = {}
+        for m in messages:
+            message_content = message_contents.get(m["id"])
+            if m["id"] in stored or message_content is None:
+                continue
+            attachment_id = self._find_pdf_attachment_id(message_content)
+            if attachment_id:
+                attachment_ids[m["id"]] = attachment_id
+
+        attachment_contents = self._batch_get_attachments(attachment_ids=attachment_ids) if attachment_ids else {}
+
+        payloads: List[Dict[str, Any]] = []
+        # to keep in the blob store, all at once (the single fetches below keep their own)
+        downloaded: List[Dict[str, Any]] = []
+        for m in messages:
+            message_content = message_contents.get(m["id"])
+            if m["id"] in stored:
+                payload = stored[m["id"]]
+            elif message_content is None:
+                payload = self._get_attachment_payload(message=m)
+            elif m["id"] not in attachment_ids:
+                # no pdf, skip
+                payload = None
+            elif attachment_contents.get(m["id"]) is None:
+                payload = self._get_attachment_payload(message=m, message_content=message_content)
+            else:
+                payload = self._build_payload(message_content, attachment_contents[m["id"]])
+                if payload is not None:
+                    downloaded.append(payload)
+            if payload is not None:
+                payloads.append(payload)
+        if self.blobs is not None and downloaded:
+            self.blobs.put_payloads(downloaded, attachment_ids=attachment_ids)
+        return payloads
+
+    @staticmethod
+    def _find_pdf_attachment_id(message_content: Dict[str, Any]) -> Optional[str]:
+        """
+        This method finds the attachment id of the receipt pdf. It's always the first one in the uexpress case.
         """
-        message_id = message["id"]
-        message_content = self.service.users().messages().get(userId="me", id=message_id, format="full").execute()
-        
-        # Get the PDF, it's always the first one in the uexpress case.
         payload = message_content.get("payload", {})
         parts = payload.get("parts", []) or []
 
-        attachment_id = None
         for part in parts:
             mime = part.get("mimeType", "")
             filename = part.get("filename", "")
             body = part.get("body", {})
             if (mime == "application/pdf" or filename.lower().endswith(".pdf")) and "attachmentId" in body:
-                attachment_id = body["attachmentId"]
-                break
+                return body["attachmentId"]
+        return None
 
+    def _get_attachment_payload(
+            self, 
+            message: Dict[str, Any], 
+            internal_ms_hint: Optional[int] = None, 
+            message_content: Optional[Dict[str, Any]] = None
+        ) -> Optional[Dict[str, Any]]:
+        """
+        This method gets the attachment payload for the model, and also grabs the associated date and internal ms or one.
+        If the full message content was already fetched it can be passed in so it is not fetched again.
+        """
+        message_id = message["id"]
+        if message_content is None:
+            message_content = self._execute(self._get_message(message_id, format="full"))
+        
+        attachment_id = self._find_pdf_attachment_id(message_content)
         if not attachment_id:
             # no pdf, skip
             return None
         
-        attachment_content = self.service.users().messages().attachments().get(userId="me", messageId=message_id, id=attachment_id).execute()
+        attachment_content = self._execute(
+            self.service.users().messages().attachments().get(
+                userId="me", messageId=message_id, id=attachment_id, fields=self.fields["attachment"]
+            )
+        )
+        payload = self._build_payload(message_content, attachment_content, internal_ms_hint=internal_ms_hint)
+        if self.blobs is not None and payload is not None:
+            self.blobs.put(
+                message_id, attachment_id, payload["file_data"], sha256=payload["pdf_sha256"], internal_ms=payload["internal_ms"],
+                date=payload["date"], sender=payload["sender"], account=payload["account"],
+            )
+        return payload
+
+    def _build_payload(
+            self, 
+            message_content: Dict[str, Any], 
+            attachment_content: Dict[str, Any], 
+            internal_ms_hint: Optional[int] = None
+        ) -> Optional[Dict[str, Any]]:
+        """
+        This method decodes the attachment and puts it together with the date and internal ms of the message.
+        """
         data = attachment_content.get("data")
         if not data:
             return None
         
         file_data = base64.urlsafe_b64decode(data.encode("UTF-8"))
+        metrics.count("bytes_downloaded_total", len(file_data), api="gmail")
         
         # now the date stuff
+        payload = message_content.get("payload", {})
         internal_ms = internal_ms_hint if internal_ms_hint is not None else int(message_content.get("internalDate", 0))
         date_val: Optional[date] = (
             datetime.fromtimestamp(internal_ms / 1000.0, tz=timezone.utc).date()
@@ -155,4 +525,12 @@ class EmailGrabber:
             else self._parse_date_from_headers(payload.get("headers", []))
         )
 
-        return {"file_data": file_data, "date": date_val, "internal_ms": internal_ms}
+        return {
+            "file_data": file_data, 
+            "date": date_val, 
+            "internal_ms": internal_ms, 
+            "message_id": message_content.get("id"),
+            "pdf_sha256": hashlib.sha256(file_data).hexdigest(),
+            "sender": self._parse_sender_from_headers(payload.get("headers", [])),
+            "account": self.account,
+        }
@@ -0,0 +1,68 @@
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from email_service.email_grabber import EmailGrabber, HistoryExpired
+from utils import metrics
+from utils.utils import read_checkpoint, read_history_id, read_seen, write_checkpoint
+
+
+# This module holds the history sync, which works out what is new in the mailbox from the gmail history api
+# instead of searching by day. It keeps its place as a historyId in the checkpoint next to last_internal_ms.
+
+class HistorySync:
+    """
+    This class hands back the receipts that arrived since the last sync. poll() returns them together with
+    where the next sync should start from, and commit() saves that once they have been written.
+
+    Without a stored historyId (the first run), or with one gmail has forgotten, it falls back to the day
+    search from last_internal_ms, having noted the current historyId first so that nothing arriving in
+    between is missed. The messages the day search has already looked at are kept in the checkpoint as well,
+    so that they aren't fetched again when it has to fall back another time.
+
+    The checkpoint keeps a place per gmail account, and this uses the one of the grabber's account.
+    """
+    def __init__(self, grabber: EmailGrabber, checkpoint_path: str):
+        self.grabber = grabber
+        self.checkpoint_path = checkpoint_path
+        self._seen: Optional[Dict[str, int]] = None
+
+    def poll(self, skip_ids: Optional[Set[str]] = None) -> Tuple[List[Dict[str, Any]], str, int]:
+        """
+        Returns (payloads oldest first, historyId to commit, internal ms to commit)
+        """
+        with metrics.timed("gmail_sync"):
+            return self._poll(skip_ids)
+
+    def _poll(self, skip_ids: Optional[Set[str]]) -> Tuple[List[Dict[str, Any]], str, int]:
+        account = self.grabber.account
+        last_internal_ms = read_checkpoint(self.checkpoint_path, account=account)
+        seen = read_seen(self.checkpoint_path, account=account)
+        history_id = read_history_id(self.checkpoint_path, account=account)
+        if history_id is not None:
+            try:
+                payloads, latest_history_id = self.grabber.ingest_history(history_id, skip_ids=skip_ids)
+                max_ms = max([last_internal_ms] + [p["internal_ms"] for p in payloads])
+                if payloads:
+                    seen.update({p["message_id"]: p["internal_ms"] for p in payloads})
+                    self._seen = self.grabber.seen_on_last_day(seen, max_ms)
+                else:
+                    self._seen = None
+                return payloads, latest_history_id, max_ms
+            except HistoryExpired as e:
+                print(f"{e}, searching by date instead")
+
+        latest_history_id = self.grabber.current_history_id()
+        payloads, max_ms, self._seen = self.grabber.ingest_new_messages(
+            last_internal_ms=last_internal_ms, skip_ids=skip_ids, seen=seen
+        )
+        return payloads, latest_history_id, max_ms
+
+    def commit(self, history_id: Optional[str], max_ms: int):
+        account = self.grabber.account
+        write_checkpoint(
+            self.checkpoint_path, 
+            max(max_ms, read_checkpoint(self.checkpoint_path, account=account)), 
+            history_id=history_id, 
+            seen=self._seen,
+            account=account,
+        )
+        self._seen = None
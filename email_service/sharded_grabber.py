@@ -0,0 +1,220 @@
+import heapq
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from email_service.blob_store import BlobStore
+from email_service.email_grabber import EmailGrabber, BATCH_SIZE
+from email_service.history_sync import HistorySync
+from utils.http_pool import HttpPool
+from utils.rate_limiter import RateLimiter
+
+
+# This module spreads the mailbox work over several gmail accounts and senders. Every (account, sender) pair is
+# a shard, listed and downloaded on its own thread with its own gmail client, and the shards' payloads are merged
+# back into one stream ordered by internal_ms, so the rest of the pipeline sees what a single grabber would hand it.
+# Each account has its own token and its own rate limiter, since gmail's quota is per user. On the shared http pool
+# (utils/http_pool.py) the shards of an account share one client, and every shard its open connections.
+
+# payloads a shard can get ahead of the merge by, on top of the batch it is downloading
+SHARD_QUEUE_SIZE = BATCH_SIZE
+
+
+@dataclass
+class Account:
+    """
+    One gmail account from config.toml. name None is the account from before there could be several, with its
+    token in token.json and its place at the top of checkpoint.json.
+    """
+    name: Optional[str]
+    token_path: str
+    senders: List[str]
+    # [gmail_rate_limit] settings that are different for this account
+    rate_limit: Dict[str, Any] = field(default_factory=dict)
+
+
+def accounts_from_config(cfg: Dict[str, Any]) -> List[Account]:
+    """
+    The [[accounts]] of config.toml, or the one account in token.json with the top level senders if there are none.
+    An account without a name is the token.json one, an account without senders reads the top level ones.
+    """
+    entries = cfg.get("accounts") or [{}]
+    accounts = []
+    for entry in entries:
+        name = entry.get("name")
+        accounts.append(Account(
+            name=name,
+            token_path=entry.get("token", "token.json" if name is None else f"token-{name}.json"),
+            senders=entry.get("senders", cfg["senders"]),
+            rate_limit={k: entry[k] for k in ("requests_per_minute", "tokens_per_minute") if k in entry},
+        ))
+    names = [a.name for a in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError("Every account in config.toml needs its own name (at most one can leave it out)")
+    return accounts
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+_DONE = object()
+
+
+class ShardedGrabber:
+    """
+    This class holds one EmailGrabber per account, and hands out the receipts of all of them.
+
+    iter_historical_messages() runs every (account, sender) shard at once, so a backfill takes about as long as
+    the biggest shard rather than all of them one after the other. The shards of an account share its rate limiter,
+    and the payloads come out oldest first across all of them, with "account" set to the mailbox they came from.
+    """
+    def __init__(self, grabbers: List[EmailGrabber]):
+        self.grabbers = grabbers
+
+    @classmethod
+    def from_config(
+            cls,
+            cfg: Dict[str, Any],
+            credentials_for: Callable[[Account], Any],
+            service_for: Optional[Callable[[Account], Any]] = None,
+            http: Optional[HttpPool] = None,
+            blobs: Optional[BlobStore] = None
+        ) -> "ShardedGrabber":
+        """
+        Builds a grabber per account of config.toml (see accounts_from_config). credentials_for authorizes an
+        account, i.e., setup() with its token_path. service_for can hand in the gmail service, for benchmarking.
+        With the shared http pool, every account and shard makes its calls through it. With the blob store, the pdfs
+        of every account are kept in it, and read from it instead of gmail.
+        """
+        grabbers = []
+        for account in accounts_from_config(cfg):
+            credentials = credentials_for(account) if service_for is None else None
+            limiter = RateLimiter.from_config(
+                "Gmail" if account.name is None else f"Gmail ({account.name})",
+                cfg,
+                table="gmail_rate_limit",
+                overrides=account.rate_limit,
+                api="gmail",
+            )
+            grabbers.append(EmailGrabber(
+                credentials=credentials,
+                senders=account.senders,
+                service=service_for(account) if service_for is not None else None,
+                limiter=limiter,
+                account=account.name,
+                http=http.gmail_http(credentials) if http is not None and credentials is not None else None,
+                blobs=blobs,
+            ))
+        return cls(grabbers)
+
+    @property
+    def limiters(self) -> List[RateLimiter]:
+        return [g.limiter for g in self.grabbers if g.limiter is not None]
+
+    def current_history_ids(self) -> Dict[Optional[str], str]:
+        """
+        {account: the mailbox's latest historyId}, see EmailGrabber.current_history_id
+        """
+        return {g.account: g.current_history_id() for g in self.grabbers}
+
+    def iter_historical_messages(self, skip_ids: Optional[Set[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Same as EmailGrabber.iter_historical_messages, over every shard at once. Each shard downloads into a
+        small queue of its own, and the queues are merged by internal_ms as the pipeline asks for payloads, so
+        memory follows the number of shards and not the size of the mailboxes.
+        """
+        shards = [
+            grabber if len(grabber.senders) == 1 else grabber.shard([sender])
+            for grabber in self.grabbers for sender in grabber.senders
+        ]
+        if len(shards) == 1:
+            yield from shards[0].iter_historical_messages(skip_ids=skip_ids)
+            return
+
+        stop = threading.Event()
+        queues: List[queue.Queue] = [queue.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in shards]
+        # a thread per shard rather than a pool: the merge needs the oldest payload of every shard before it can
+        # hand any out, so a shard waiting for a free worker would hold up the others. The limiters set the pace.
+        threads = [
+            threading.Thread(target=self._produce, args=(shard, q, skip_ids, stop), daemon=True)
+            for shard, q in zip(shards, queues)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            yield from heapq.merge(*(self._drain(q) for q in queues), key=lambda p: p["internal_ms"])
+        finally:
+            # the consumer stopped early or something failed, the shards don't have to finish
+            stop.set()
+
+# Helpers
+
+    @staticmethod
+    def _produce(shard: EmailGrabber, q: queue.Queue, skip_ids: Optional[Set[str]], stop: threading.Event):
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for payload in shard.iter_historical_messages(skip_ids=skip_ids):
+                if not put(payload):
+                    return
+        except Exception as e:
+            put(_Failed(e))
+            return
+        put(_DONE)
+
+    @staticmethod
+    def _drain(q: queue.Queue) -> Iterator[Dict[str, Any]]:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+
+
+class ShardedHistorySync:
+    """
+    This class is HistorySync over every account: poll() asks each mailbox for its changes at the same time, and
+    hands back the receipts of all of them oldest first, with where each account's next sync should start from.
+    commit() saves every account's place in its own part of the checkpoint.
+    """
+    def __init__(self, grabber: ShardedGrabber, checkpoint_path: str):
+        self.syncs = [HistorySync(grabber=g, checkpoint_path=checkpoint_path) for g in grabber.grabbers]
+
+    def poll(self, skip_ids: Optional[Set[str]] = None) -> Tuple[List[Dict[str, Any]], Dict[Optional[str], str], Dict[Optional[str], int]]:
+        """
+        Returns (payloads oldest first, {account: historyId to commit}, {account: internal ms to commit})
+        """
+        if len(self.syncs) == 1:
+            results = [self.syncs[0].poll(skip_ids=skip_ids)]
+        else:
+            with ThreadPoolExecutor(max_workers=len(self.syncs)) as executor:
+                results = list(executor.map(lambda sync: sync.poll(skip_ids=skip_ids), self.syncs))
+
+        payloads: List[Dict[str, Any]] = []
+        history_ids: Dict[Optional[str], str] = {}
+        max_ms: Dict[Optional[str], int] = {}
+        for sync, (account_payloads, history_id, account_ms) in zip(self.syncs, results):
+            payloads.extend(account_payloads)
+            history_ids[sync.grabber.account] = history_id
+            max_ms[sync.grabber.account] = account_ms
+        payloads.sort(key=lambda p: p["internal_ms"])
+        return payloads, history_ids, max_ms
+
+    def commit(self, history_id: Dict[Optional[str], str], max_ms: Dict[Optional[str], int]):
+        for sync in self.syncs:
+            account = sync.grabber.account
+            if account in history_id:
+                sync.commit(history_id=history_id[account], max_ms=max_ms[account])
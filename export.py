@@ -0,0 +1,42 @@
+import os
+import argparse
+
+from writers.excel_writer import ExcelWriter
+from writers.sqlite_writer import SQLiteWriter
+
+# The local store (receipt-buddy.db) is the system of record. This script regenerates the
+# Itemized table in receipt-buddy.xlsx from it, i.e., after a spreadsheet restore or if the two have drifted.
+# With --summaries it also writes the monthly and per item spending rollups to the Monthly and Items sheets.
+
+cwd = os.getcwd()
+
+def main(summaries: bool = False, force: bool = False):
+  store = SQLiteWriter(app_directory=cwd)
+  excel_writer = ExcelWriter(app_directory=cwd)
+
+  number_of_rows = store.count()
+  if not number_of_rows:
+    print("Nothing in the local store yet. Run setup.py first.")
+    return
+
+  if excel_writer.holds_rows_from_before_store() and not force:
+    # the rebuild would move them out of the table, and the store may not have all of them
+    print("The spreadsheet has rows from before the local store, run setup.py first to get them into the store")
+    print("(or pass --force to rebuild anyway, they are kept in the 'Before store' sheet)")
+    store.close()
+    return
+
+  print(f"Exporting {number_of_rows} rows")
+  excel_writer.rebuild(store)
+  if summaries:
+    excel_writer.write_summaries(store.rollups)
+  store.close()
+
+  print("🤖: Done!")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Regenerate the spreadsheet from the local store")
+  parser.add_argument("--summaries", action="store_true", help="also write the Monthly and Items summary sheets")
+  parser.add_argument("--force", action="store_true", help="rebuild even if the spreadsheet has rows from before the local store")
+  args = parser.parse_args()
+  main(summaries=args.summaries, force=args.force)
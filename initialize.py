@@ -5,10 +5,12 @@ import subprocess
 from pathlib import Path
 import plistlib
 import sys
+import argparse
 
 ####
 # NB! this script makes it such that the update is run every 4 hours.
 # it does so by writing an info.plist to your mac, and then making an executable on your machine.
+# with --daemon, it instead keeps daemon.py running in the background, which picks up receipts within seconds.
 # proceed with caution...
 ###
 
@@ -18,16 +20,17 @@ INTERVAL_SECONDS = 240 * 60            # every 4 hours - 3 times a day
 def project_root() -> Path:
     return Path(__file__).resolve().parent
 
-def write_run_update_sh(proj: Path) -> Path:
+def write_run_update_sh(proj: Path, daemon: bool = False) -> Path:
     logs = proj / "logs"
     logs.mkdir(exist_ok=True)
-    script = proj / "run_update.sh"
+    name = "daemon" if daemon else "update"
+    script = proj / f"run_{name}.sh"
     venv_activate = proj / ".venv" / "bin" / "activate"
     script.write_text(
         "#!/bin/zsh\n"
         f"cd {proj}\n"
         f"source {venv_activate}\n"
-        "python update.py >> logs/update.log 2>&1\n"
+        f"python {name}.py >> logs/{name}.log 2>&1\n"
     )
     # chmod +x
     st = os.stat(script)
@@ -35,7 +38,7 @@ def write_run_update_sh(proj: Path) -> Path:
     print(f"Wrote and chmod +x {script}")
     return script
 
-def write_launchd_plist(script_path: Path) -> Path:
+def write_launchd_plist(script_path: Path, daemon: bool = False) -> Path:
     launch_agents = Path.home() / "Library" / "LaunchAgents"
     launch_agents.mkdir(parents=True, exist_ok=True)
 
@@ -43,12 +46,17 @@ def write_launchd_plist(script_path: Path) -> Path:
     plist_dict = {
         "Label": LABEL,
         "ProgramArguments": ["/bin/zsh", str(script_path)],
-        "StartInterval": INTERVAL_SECONDS,                      # run every N seconds
         "WorkingDirectory": str(script_path.parent),
         "StandardOutPath": str(script_path.parent / "logs" / "launchd.out"),
         "StandardErrorPath": str(script_path.parent / "logs" / "launchd.err"),
         "EnvironmentVariables": {"PYTHONUNBUFFERED": "1"},
     }
+    if daemon:
+        # start at login and restart it if it ever exits
+        plist_dict["RunAtLoad"] = True
+        plist_dict["KeepAlive"] = True
+    else:
+        plist_dict["StartInterval"] = INTERVAL_SECONDS            # run every N seconds
     with plist_path.open("wb") as f:
         plistlib.dump(plist_dict, f)
     print(f"Wrote LaunchAgent: {plist_path}")
@@ -78,13 +86,22 @@ def run_initial_setup(proj: Path):
     else:
         print("setup.py exited with non-zero status; check logs/ or console output.")
 
-def main():
+def main(daemon: bool = False):
     proj = project_root()
-    script = write_run_update_sh(proj)
-    plist_path = write_launchd_plist(script)
+    script = write_run_update_sh(proj, daemon=daemon)
+    plist_path = write_launchd_plist(script, daemon=daemon)
+    # the historical setup goes first, so the daemon doesn't start out doing the backfill itself
+    if daemon:
+        run_initial_setup(proj)
+        load_launch_agent(plist_path)
+        print("All set. The daemon is now watching for new receipts.")
+        return
     load_launch_agent(plist_path)
     run_initial_setup(proj)
     print("All set. Your updater will now run on a schedule.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--daemon", action="store_true", help="keep daemon.py running instead of running update.py every 4 hours")
+    args = parser.parse_args()
+    main(daemon=args.daemon)
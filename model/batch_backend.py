@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import base64
+import tempfile
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from model.model_output import ModelOutput
+from utils import metrics
+
+
+# This module holds the batch backend for the gemini wrapper. Instead of one generate_content call per receipt,
+# every receipt goes into a single batch job, which is slower to come back but isn't held to the per-minute
+# quota and costs less. It's meant for the one-off historical backfill in setup.py.
+
+DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+class GeminiBatch:
+    """
+    This class submits receipts to the gemini batch api and turns the results back into ModelOutputs.
+
+    run() has the same shape as ExtractionPipeline.run: it yields (payload, model_output) in the order the
+    payloads came in, with model_output None for the receipts the model failed on. The yielded payloads don't
+    carry file_data anymore, the pdfs only ever live in the request file on disk.
+    """
+    def __init__(self, gemini, client: Optional[Any] = None, poll_interval: float = 30.0, local=None,
+                 job_path: Optional[str] = None):
+        self.gemini = gemini
+        self.local = local
+        # the batch and file apis live on the genai client, which Gemini is. A fake can be handed in instead.
+        self.client = client if client is not None else gemini
+        self.poll_interval = poll_interval
+        # the submitted job is noted here until its results are through, so a run stopped while it is polling
+        # picks the same job up again instead of paying for a second one
+        self.job_path = job_path
+
+    @classmethod
+    def from_config(cls, gemini, cfg: Dict[str, Any], local=None, app_directory: Optional[str] = None) -> "GeminiBatch":
+        """
+        Builds the backend from the [batch] table of config.toml, noting the running job in app_directory's cache/
+        """
+        return cls(
+            gemini=gemini,
+            poll_interval=cfg.get("batch", {}).get("poll_interval", 30.0),
+            local=local,
+            job_path=os.path.join(app_directory, "cache", "batch_job.json") if app_directory else None,
+        )
+
+    def run(self, payloads: Iterable[Dict[str, Any]]) -> Iterator[Tuple[Dict[str, Any], Optional[ModelOutput]]]:
+        ordered: List[Dict[str, Any]] = []
+        results: Dict[str, Optional[ModelOutput]] = {}
+        cache_keys: Dict[str, str] = {}
+
+        fd, request_path = tempfile.mkstemp(prefix="receipt-buddy-batch-", suffix=".jsonl")
+        try:
+            submitted: List[str] = []
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for payload in payloads:
+                    if "local_output" in payload:
+                        local = payload["local_output"]
+                    else:
+                        local = self.local.extract(payload) if self.local is not None else None
+                    # after the local extractor, which can note the receipt's total in the payload (items_total)
+                    meta = {k: v for k, v in payload.items() if k != "file_data"}
+                    ordered.append(meta)
+                    key = meta["message_id"]
+                    if local is not None:
+                        results[key] = local
+                        continue
+                    cached = self.gemini.from_cache(payload)
+                    if cached is not None:
+                        results[key] = cached if isinstance(cached, ModelOutput) else None
+                        continue
+                    if self.gemini.cache is not None:
+                        cache_keys[key] = self.gemini._cache_key(payload)
+                    f.write(json.dumps({"key": key, "request": self._build_request(payload)}) + "\n")
+                    submitted.append(key)
+
+            if submitted:
+                print(f"Submitting {len(submitted)} receipts as one batch job ({len(ordered) - len(submitted)} were read locally or cached)")
+                by_id = {m["message_id"]: m for m in ordered}
+                for key, text in self._run_job(request_path, submitted).items():
+                    meta = by_id.get(key)
+                    if meta is None:
+                        continue
+                    results[key] = self._to_model_output(text, meta, cache_key=cache_keys.get(key))
+        finally:
+            os.remove(request_path)
+
+        for meta in ordered:
+            yield meta, results.get(meta["message_id"])
+        # everything was handed on, the next run submits a job of its own
+        self._forget_job()
+
+    def _build_request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        One GenerateContentRequest, the same as what Gemini.respond sends.
+        """
+        return {
+            "contents": [{
+                "role": "user",
+                "parts": [{
+                    "inline_data": {
+                        "mime_type": "application/pdf",
+                        "data": base64.b64encode(payload["file_data"]).decode("ascii"),
+                    }
+                }],
+            }],
+            "system_instruction": {"parts": [{"text": self.gemini.system_instruction}]},
+            "generation_config": {"temperature": self.gemini.temperature},
+        }
+
+    def _run_job(self, request_path: str, keys: List[str]) -> Dict[str, Optional[str]]:
+        """
+        Uploads the requests, submits the job, and polls until it is done. Returns {key: raw model text},
+        with None for the requests that came back with an error. If a job from an earlier run that covers
+        every key is still noted in job_path, that one is polled instead of submitting the requests again.
+        """
+        start = time.perf_counter()
+        job_name = self._noted_job(keys)
+        if job_name is not None:
+            job = self.client.batches.get(name=job_name)
+            print(f"Picking up batch job {job.name} from an earlier run")
+            calls = 1
+        else:
+            uploaded = self.client.files.upload(
+                file=request_path,
+                config={"display_name": os.path.basename(request_path), "mime_type": "jsonl"},
+            )
+            job = self.client.batches.create(
+                model=self.gemini.model_name,
+                src=uploaded.name,
+                config={"display_name": "receipt-buddy-backfill"},
+            )
+            self._note_job(job.name, keys)
+            print(f"Batch job {job.name} submitted")
+            calls = 2
+
+        while job.state.name not in DONE_STATES:
+            time.sleep(self.poll_interval)
+            job = self.client.batches.get(name=job.name)
+            calls += 1
+            print(f"Batch job {job.state.name}")
+
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            self._forget_job()
+            raise RuntimeError(f"Batch job {job.name} ended in {job.state.name}: {getattr(job, 'error', None)}")
+
+        out: Dict[str, Optional[str]] = {}
+        content = self.client.files.download(file=job.dest.file_name)
+        metrics.count("api_calls_total", calls + 1, api="gemini_batch")
+        metrics.count("bytes_downloaded_total", len(content), api="gemini_batch")
+        # the whole job, from the upload to the results being back
+        metrics.observe("gemini_batch_job", time.perf_counter() - start)
+        for line in content.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            out[result.get("key")] = self._response_text(result.get("response")) if "error" not in result else None
+        return out
+
+    @staticmethod
+    def _response_text(response: Optional[Dict[str, Any]]) -> Optional[str]:
+        if not response:
+            return None
+        candidates = response.get("candidates") or []
+        if not candidates:
+            return None
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(p.get("text", "") for p in parts)
+
+    def _to_model_output(self, text: Optional[str], meta: Dict[str, Any], cache_key: Optional[str]) -> Optional[ModelOutput]:
+        if not text:
+            print(f"Model failed on one payload: {meta['message_id']} came back without a response")
+            return None
+        try:
+            model_output = ModelOutput.from_raw(raw_model_text=text, date=meta["date"])
+        except (ValueError, TypeError, AttributeError) as e:
+            # i.e., a json list, or an item that isn't an object. It only costs this receipt, not the paid job
+            print(f"Model failed on one payload: {e}")
+            return None
+        if not isinstance(model_output, ModelOutput):
+            print(f"Model failed on one payload: {model_output}")
+            return None
+        if cache_key is not None:
+            self.gemini.cache.put(cache_key, text)
+        return model_output
+
+    def _noted_job(self, keys: List[str]) -> Optional[str]:
+        if self.job_path is None:
+            return None
+        try:
+            with open(self.job_path) as f:
+                noted = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # a job for other receipts is no use, its results would leave some of these out. Nor is one sent with another
+        # model, temperature or prompt, as its answers are cached under the current configuration's keys
+        if not isinstance(noted, dict) or noted.get("config") != self.gemini.fingerprint() or not set(keys) <= set(noted.get("keys", [])):
+            return None
+        return noted.get("name")
+
+    def _note_job(self, name: str, keys: List[str]):
+        if self.job_path is None:
+            return
+        os.makedirs(os.path.dirname(self.job_path), exist_ok=True)
+        tmp_path = self.job_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"name": name, "config": self.gemini.fingerprint(), "keys": keys}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.job_path)
+
+    def _forget_job(self):
+        if self.job_path is not None and os.path.exists(self.job_path):
+            os.remove(self.job_path)
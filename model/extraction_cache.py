@@ -0,0 +1,108 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from typing import Any, Dict, Optional
+
+
+# This module holds the on-disk cache of raw model outputs. Receipts are keyed by the contents of the pdf
+# and everything that changes what the model would say about it, so re-running over the same mailbox
+# doesn't call the api again.
+
+class ExtractionCache:
+    """
+    This class is a size bounded, content addressed store of raw model text, backed by sqlite.
+    When the cache grows past max_bytes the least recently used entries are evicted.
+    """
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # the pipeline calls in from several threads, so the connection is shared behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extractions ("
+            "key TEXT PRIMARY KEY, raw TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS extractions_last_used ON extractions (last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+
+    @classmethod
+    def from_config(cls, app_directory: str, cfg: Dict[str, Any]) -> Optional["ExtractionCache"]:
+        """
+        Builds the cache from the [cache] table of config.toml. Returns None if the cache is turned off.
+        """
+        cache_cfg = cfg.get("cache", {})
+        if not cache_cfg.get("enabled", True):
+            return None
+        path = cache_cfg.get("path", os.path.join("cache", "extractions.sqlite3"))
+        return cls(
+            path=os.path.join(app_directory, path),
+            max_bytes=int(cache_cfg.get("max_mb", 256)) * 1024 * 1024,
+        )
+
+    @staticmethod
+    def make_key(file_data: bytes, model_name: str, temperature: float, system_instruction: str) -> str:
+        """
+        The key is the sha256 of the pdf, together with the model name, temperature, and a hash of the system prompt.
+        """
+        pdf_hash = hashlib.sha256(file_data).hexdigest()
+        prompt_hash = hashlib.sha256(system_instruction.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{pdf_hash}|{model_name}|{temperature!r}|{prompt_hash}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT raw FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE extractions SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key: str, raw: str):
+        size = len(raw.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM extractions WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, raw, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, raw, size, time.time()),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": self._total_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _evict(self):
+        """
+        Drops the least recently used entries until the cache fits in max_bytes again. Expects the lock to be held.
+        """
+        while self._total_bytes > self.max_bytes:
+            oldest = self._conn.execute(
+                "SELECT key, size FROM extractions ORDER BY last_used ASC LIMIT 64"
+            ).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                self._conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+                self._total_bytes -= size
+                if self._total_bytes <= self.max_bytes:
+                    break
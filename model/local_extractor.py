@@ -0,0 +1,249 @@
+import io
+import re
+import json
+import threading
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from model.model_output import ModelOutput, Row
+from utils import metrics
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # a dependency, but an environment from before it was added still runs, with every receipt going to the model
+    PdfReader = None
+
+
+# This module holds the local extractor, which reads the rows straight out of the text layer of receipts
+# from senders whose layout we know, instead of sending them to the model. The e-tickets are generated by the
+# till, so the layout never changes, and a regex does the job in milliseconds without touching the quota.
+# Anything that doesn't match the template, or doesn't add up, goes to the model as before.
+
+_PRICE = r"-?\d+[.,]\d{2}"
+# "ITEM NAME      2,50 €   A" (the trailing letter/digit is the vat code)
+_ITEM_LINE = re.compile(rf"^(?P<item>\S.*?)\s+(?P<price>{_PRICE})\s*€?(?:\s+[A-Z0-9]{{1,2}})?\s*$")
+# "   3 x 1,20 €" on the line under an item
+_QUANTITY_LINE = re.compile(rf"^\s*(?P<quantity>\d+)\s*[xX*]\s*(?P<unit>{_PRICE})\s*€?.*$")
+_TOTAL_LINE = re.compile(rf"^\s*(?:TOTAL|MONTANT|A PAYER)\b.*?(?P<total>{_PRICE})\s*€?\s*$", re.IGNORECASE)
+# lines after which nothing is an item anymore
+_END_MARKERS = re.compile(r"^\s*(?:SOUS[- ]TOTAL|TOTAL|MONTANT|A PAYER|NB\.? ?ARTICLES|TVA|CB\b|CARTE)", re.IGNORECASE)
+
+
+def _to_float(s: str) -> float:
+    return float(s.replace(",", "."))
+
+
+def items_total(text: str) -> Optional[float]:
+    """
+    What the items on a receipt should add up to, from its text layer: the printed total (the first TOTAL /
+    MONTANT / A PAYER line with an amount) with the discounts above it added back, since the model leaves the
+    discount lines out. None if there is no total. It doesn't need a template, so it works for any sender.
+    """
+    discounts = 0.0
+    for line in text.splitlines():
+        m = _TOTAL_LINE.match(line)
+        if m:
+            return _to_float(m.group("total")) - discounts
+        m = _ITEM_LINE.match(line)
+        if m and _to_float(m.group("price")) < 0:
+            discounts += _to_float(m.group("price"))
+    return None
+
+
+def adds_up(rows: List[Row], total: float) -> bool:
+    """
+    The sanity check on the model's rows: whether their prices come to the receipt's items_total, to the cent.
+    """
+    return abs(sum(r.price for r in rows) - total) <= 0.011
+
+
+@dataclass
+class ReceiptTemplate:
+    """
+    The layout of one sender's receipts. Lines before the first item line are header, lines from the first
+    end marker on are totals and payment. A receipt only counts as matched if its items (and discounts) add up
+    to the total printed on it.
+    """
+    name: str
+    senders: Tuple[str, ...]
+
+    def parse(self, text: str) -> Optional[List[Tuple[str, int, float]]]:
+        """
+        Returns (item, quantity, price) for every item on the receipt, or None if it doesn't fit the template.
+        """
+        items: List[Tuple[str, int, float]] = []
+        discounts = 0.0
+        total: Optional[float] = None
+        in_items = True
+
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if in_items and _END_MARKERS.match(line):
+                in_items = False
+            if not in_items:
+                m = _TOTAL_LINE.match(line)
+                if m and total is None:
+                    total = _to_float(m.group("total"))
+                continue
+
+            m = _QUANTITY_LINE.match(line)
+            if m:
+                if not items:
+                    return None
+                item, _, price = items[-1]
+                quantity = int(m.group("quantity"))
+                if quantity <= 0 or abs(quantity * _to_float(m.group("unit")) - price) > 0.011:
+                    return None
+                items[-1] = (item, quantity, price)
+                continue
+
+            m = _ITEM_LINE.match(line)
+            if m:
+                price = _to_float(m.group("price"))
+                if price < 0:
+                    discounts += price
+                else:
+                    items.append((m.group("item").strip(), 1, price))
+
+        # the validation: without a total to check against we can't tell a header line from an item
+        if not items or total is None:
+            return None
+        if abs(sum(price for _, _, price in items) + discounts - total) > 0.011:
+            return None
+        return items
+
+
+# the receipt layouts we know, matched by sender address
+TEMPLATES: List[ReceiptTemplate] = [
+    ReceiptTemplate(name="uexpress", senders=("ticket-caisse@e-ticket.cooperative-u.fr",)),
+]
+
+
+class LocalExtractor:
+    """
+    This class tries the known templates on a payload before it goes to the model. extract() returns a
+    ModelOutput on a match and None otherwise, and keeps hit/miss counts per sender.
+
+    It's safe to call from the pipeline's worker threads.
+    """
+    def __init__(self, templates: Optional[List[ReceiptTemplate]] = None):
+        self.templates = {s: t for t in (templates if templates is not None else TEMPLATES) for s in t.senders}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["LocalExtractor"]:
+        """
+        Builds the extractor from the [local_extraction] table of config.toml. Returns None unless it's
+        turned on, or when pypdf isn't installed.
+        """
+        if not cfg.get("local_extraction", {}).get("enabled", False):
+            return None
+        if PdfReader is None:
+            print("pypdf is not installed, every receipt goes to the model (uv sync --locked installs it)")
+            return None
+        return cls()
+
+    def extract(self, payload: Dict[str, Any]) -> Optional[ModelOutput]:
+        """
+        Returns the receipt's ModelOutput if its sender's template reads it, and None otherwise. For a receipt the
+        template didn't take, what its items should add up to goes in the payload's "items_total" (see items_total),
+        to check the model's rows against.
+        """
+        sender = payload.get("sender")
+        if sender not in self.templates:
+            return None
+        with metrics.timed("local_extract"):
+            parsed, total = self.read(sender, payload["file_data"])
+        self.count(sender, hit=parsed is not None)
+        if parsed is None:
+            payload["items_total"] = total
+            return None
+        return self.to_output(parsed, payload["date"])
+
+    def read(self, sender: Optional[str], file_data) -> Tuple[Optional[List[Tuple[str, int, float]]], Optional[float]]:
+        """
+        The cpu heavy half of extract(): reads the text layer once, for (the sender's template rows or None,
+        items_total or None). Receipts without a template are only read for their total. Doesn't touch the counts,
+        so it can run in another process.
+        """
+        template = self.templates.get(sender)
+        try:
+            text = self._text(file_data)
+            return (template.parse(text) if template is not None else None), items_total(text)
+        except Exception:
+            # a broken or encrypted pdf is the model's problem
+            return None, None
+
+    @staticmethod
+    def to_output(parsed: List[Tuple[str, int, float]], date) -> ModelOutput:
+        rows = [
+            Row(
+                item=item,
+                quantity=quantity,
+                price=price,
+                price_per_unit=price / quantity if quantity else 0.0,
+                date=date,
+            )
+            for item, quantity, price in parsed
+        ]
+        # raw in the same shape the model answers in, so it reads the same anywhere it ends up
+        raw = json.dumps({item: {"quantity": quantity, "price": price} for item, quantity, price in parsed}, ensure_ascii=False)
+        return ModelOutput(raw=raw, rows=rows)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        {sender: {"hits": n, "misses": n}} for every sender with a template that was seen
+        """
+        with self._lock:
+            return {sender: dict(counts) for sender, counts in self._stats.items()}
+
+    def count(self, sender: str, hit: bool):
+        with self._lock:
+            counts = self._stats.setdefault(sender, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    @staticmethod
+    def _text(file_data) -> str:
+        # file_data can be bytes, or a memoryview into shared memory, which is read in place rather than copied whole
+        # into a BytesIO first
+        stream = _BufferStream(file_data) if isinstance(file_data, memoryview) else io.BytesIO(file_data)
+        reader = PdfReader(stream)
+        return "\n".join(page.extract_text(extraction_mode="layout") or "" for page in reader.pages)
+
+
+class _BufferStream(io.RawIOBase):
+    """
+    A read only, seekable file over a memoryview. pypdf seeks around the file and reads a piece at a time,
+    and each read copies just that piece.
+    """
+    def __init__(self, view: memoryview):
+        self._view = view.cast("B") if view.format != "B" else view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        out = self._view[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return out
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
@@ -1,10 +1,8 @@
 import json
 import re
 
-from typing import List, Tuple, Any
+from typing import Dict, List, Sequence, Tuple, Any
 from datetime import datetime
-from google import genai
-from google.genai import types
 from pydantic import BaseModel
 
 
@@ -21,9 +19,200 @@ class Row(BaseModel):
     date: datetime
 
 
+class RowTable:
+    """
+    This class holds many rows as columns instead of a Row object each: the item names, and numpy arrays of
+    quantities, prices, prices per unit and dates. Building one from thousands of raw model outputs (from_raws)
+    or stored rows (from_records) coerces and divides whole columns at once, and values() hands the rows to the
+    spreadsheet writer without going through pydantic. Row objects are only made when asked for, see row()/rows().
+    """
+    __slots__ = ("item", "quantity", "price", "price_per_unit", "date")
+
+    def __init__(self, item: List[str], quantity, price, price_per_unit, date):
+        self.item = item
+        self.quantity = quantity              # int64
+        self.price = price                    # float64
+        self.price_per_unit = price_per_unit  # float64
+        self.date = date                      # datetime64[us]
+
+    def __len__(self) -> int:
+        return len(self.item)
+
+    def row(self, i: int) -> Row:
+        return Row(
+            item=self.item[i],
+            quantity=int(self.quantity[i]),
+            price=float(self.price[i]),
+            price_per_unit=float(self.price_per_unit[i]),
+            date=self.date[i].astype(object),
+        )
+
+    def rows(self) -> List[Row]:
+        return [self.row(i) for i in range(len(self))]
+
+    def values(self) -> List[Tuple[Any, ...]]:
+        """
+        (item, quantity, price, price_per_unit, date) per row, as python values, i.e., what ExcelWriter writes.
+        """
+        return list(zip(
+            self.item, self.quantity.tolist(), self.price.tolist(), self.price_per_unit.tolist(), self.date.astype(object).tolist()
+        ))
+
+    def take(self, index) -> "RowTable":
+        """
+        The rows at index (an array of positions, or a boolean mask).
+        """
+        import numpy as np
+
+        positions = np.flatnonzero(index) if np.asarray(index).dtype == bool else np.asarray(index)
+        return RowTable(
+            item=[self.item[i] for i in positions.tolist()],
+            quantity=self.quantity[positions],
+            price=self.price[positions],
+            price_per_unit=self.price_per_unit[positions],
+            date=self.date[positions],
+        )
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Row]) -> "RowTable":
+        import numpy as np
+
+        return cls(
+            item=[r.item for r in rows],
+            quantity=np.fromiter((r.quantity for r in rows), dtype=np.int64, count=len(rows)),
+            price=np.fromiter((r.price for r in rows), dtype=np.float64, count=len(rows)),
+            price_per_unit=np.fromiter((r.price_per_unit for r in rows), dtype=np.float64, count=len(rows)),
+            date=np.array([r.date.replace(tzinfo=None) for r in rows], dtype="datetime64[us]"),
+        )
+
+    @classmethod
+    def from_records(cls, records: Sequence[Tuple[str, int, float, float, str]]) -> "RowTable":
+        """
+        From (item, quantity, price, price_per_unit, iso date) tuples, the way SQLiteWriter stores them.
+        """
+        import numpy as np
+
+        if not records:
+            return cls.empty()
+        item, quantity, price, price_per_unit, date = zip(*records)
+        return cls(
+            item=list(item),
+            quantity=np.asarray(quantity, dtype=np.int64),
+            price=np.asarray(price, dtype=np.float64),
+            price_per_unit=np.asarray(price_per_unit, dtype=np.float64),
+            date=np.asarray(date, dtype="datetime64[us]"),
+        )
+
+    @classmethod
+    def empty(cls) -> "RowTable":
+        import numpy as np
+
+        return cls([], np.empty(0, np.int64), np.empty(0, np.float64), np.empty(0, np.float64), np.empty(0, "datetime64[us]"))
+
+    @classmethod
+    def from_raws(cls, raws: Sequence[str], dates: Sequence[datetime]) -> Tuple["RowTable", Any, Dict[int, str]]:
+        """
+        The bulk version of ModelOutput.from_raw: parses many raw model outputs into one table. Only the json
+        parsing is done per output; the quantities and prices are coerced a column at a time (ints, floats, or
+        strings with a decimal comma, quantities truncated like int() does), and the prices per unit divided in one go.
+
+        Returns (table, receipt, errors): receipt is the index in raws each row came from, and errors holds the
+        message for every output that couldn't be read (no rows of it are in the table), like from_raw returns.
+        """
+        import numpy as np
+
+        items: List[str] = []
+        quantities: List[Any] = []
+        prices: List[Any] = []
+        counts: List[int] = []  # rows per output
+        errors: Dict[int, str] = {}
+        loads = json.loads
+        for i, raw in enumerate(raws):
+            try:
+                # the fence regex is most of the cost of a small output, and most outputs have no fences
+                json_obj = loads(ModelOutput._strip_fences(raw) if "`" in raw else raw)
+            except ValueError as e:
+                errors[i] = f"Model output is not valid json: {e}"
+                counts.append(0)
+                continue
+            if not isinstance(json_obj, dict):
+                errors[i] = "Model output is not a json object"
+                counts.append(0)
+                continue
+            values = json_obj.values()
+            try:
+                q = [v["quantity"] for v in values]
+                p = [v["price"] for v in values]
+            except (KeyError, TypeError):
+                errors[i] = cls._missing_key(json_obj)
+                counts.append(0)
+                continue
+            items.extend(json_obj)
+            quantities.extend(q)
+            prices.extend(p)
+            counts.append(len(q))
+
+        receipt = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        quantity = np.trunc(_to_numbers(quantities))
+        price = _to_numbers(prices)
+        bad = np.isnan(quantity) | np.isnan(price)
+        if bad.any():
+            for i in np.unique(receipt[bad]).tolist():
+                errors[i] = "Quantity or price is not a number. Try again"
+            keep = ~np.isin(receipt, list(errors))
+            items = [item for item, k in zip(items, keep.tolist()) if k]
+            receipt, quantity, price = receipt[keep], quantity[keep], price[keep]
+
+        price_per_unit = np.divide(price, quantity, out=np.zeros_like(price), where=quantity != 0)
+        all_dates = np.asarray(
+            [d.replace(tzinfo=None) if isinstance(d, datetime) else d for d in dates], dtype="datetime64[us]"
+        )
+        table = cls(
+            item=items,
+            quantity=quantity.astype(np.int64),
+            price=price,
+            price_per_unit=price_per_unit,
+            date=all_dates[receipt],
+        )
+        return table, receipt, errors
+
+    @staticmethod
+    def _missing_key(json_obj: Dict[str, Any]) -> str:
+        for item, quant_price in json_obj.items():
+            for key in ("quantity", "price"):
+                if not isinstance(quant_price, dict) or key not in quant_price:
+                    return f"Key '{key}' not found for {item} in json object. Try again"
+        return "Model output could not be read"
+
+
+def _to_numbers(values: List[Any]):
+    """
+    A float64 array of values, with NaN for anything that isn't a number. The common case (all ints or floats)
+    is a single conversion; strings get their decimal commas swapped a whole column at a time.
+    """
+    import numpy as np
+
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    text = np.char.replace(np.char.strip(np.asarray([str(v) for v in values], dtype=str)), ",", ".")
+    try:
+        return text.astype(np.float64)
+    except ValueError:
+        out = np.full(len(values), np.nan)
+        for i, t in enumerate(text.tolist()):
+            try:
+                out[i] = float(t)
+            except ValueError:
+                pass
+        return out
+
+
 class ModelOutput(BaseModel):
     raw: str
     rows: List[Row]
+    total_tokens: int = 0 # as reported by the api, used to keep the token bucket honest
 
     @staticmethod
     def _strip_fences(s: str) -> str:
@@ -69,4 +258,30 @@ class ModelOutput(BaseModel):
             ))
         return cls(raw=raw_model_text, rows=rows)
 
+    @classmethod
+    def split_packed(cls, raw_model_text: str, dates: Dict[str, datetime]) -> Dict[str, Any]:
+        """
+        This function splits the answer to a packed request (several receipts in one call) back into one output
+        per receipt. The model is asked for a json object keyed by receipt, so each section goes through from_raw
+        on its own. Sections that are missing or don't parse get an error message instead, like from_raw does.
+        """
+        try:
+            json_obj = json.loads(cls._strip_fences(raw_model_text))
+        except ValueError as e:
+            return {key: f"Packed response is not valid json: {e}" for key in dates}
+        if not isinstance(json_obj, dict):
+            return {key: "Packed response is not a json object" for key in dates}
+
+        outputs: Dict[str, Any] = {}
+        for key, date in dates.items():
+            section = json_obj.get(key)
+            if not isinstance(section, dict):
+                outputs[key] = f"Section '{key}' not found in packed response"
+                continue
+            try:
+                outputs[key] = cls.from_raw(raw_model_text=json.dumps(section, ensure_ascii=False), date=date)
+            except (ValueError, TypeError) as e:
+                outputs[key] = f"Section '{key}' could not be parsed: {e}"
+        return outputs
+
 #TODO: ModelOutputError
\ No newline at end of file
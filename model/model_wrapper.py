@@ -1,17 +1,33 @@
 import os
 import base64
+import hashlib
+
+from typing import Any, Dict, List, Optional
 
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
 from model.model_output import ModelOutput
+from model.extraction_cache import ExtractionCache
 
 
 # this module wraps the llm api to make it easier to use
 
+# added to the system prompt when several receipts go out in one request
+PACKING_INSTRUCTION = """
+
+You may be given several receipts at once. Each one is introduced by a line "Receipt <key>:" followed by its pdf.
+Apply the rules above to each receipt on its own, and answer with a single JSON object whose keys are the receipt
+keys and whose values are the JSON object described above for that receipt:
+{
+  "<key>": {"Item name": {"quantity": int, "price": float}},
+  "<another key>": {"Item name": {"quantity": int, "price": float}}
+}
+"""
+
 class Gemini(genai.Client):
-    def __init__(self, model_name, temperature):
+    def __init__(self, model_name, temperature, cache: Optional[ExtractionCache] = None, http: Optional[Any] = None):
 
         load_dotenv()
         api_key = os.getenv("GEMINI_API_KEY")
@@ -20,17 +36,40 @@ class Gemini(genai.Client):
                 "Missing Gemini Api key. Please set it in .env (GEMINI_API_KEY=...)"
             )
 
-        super().__init__(api_key=api_key)
+        # http is the shared connection pool (utils/http_pool.py), so the model calls from every worker thread
+        # reuse open connections instead of each making its own
+        super().__init__(api_key=api_key, http_options=http.genai_options() if http is not None else None)
 
         self.model_name = model_name
         self.temperature = temperature
         self.system_instruction = self._get_system_prompt()
+        self.cache = cache
 
         if not self.system_instruction.strip():
             print("[Gemini] WARNING: system_prompt.txt empty or not found")
 
 
-    def respond(self, file_payload):
+    def from_cache(self, file_payload) -> Optional[ModelOutput]:
+        """
+        Rebuilds the model output from the extraction cache if this exact pdf has been through this exact 
+        model configuration before. Returns None on a miss, or if there is no cache.
+        """
+        if self.cache is None:
+            return None
+        raw = self.cache.get(self._cache_key(file_payload))
+        if raw is None:
+            return None
+        return ModelOutput.from_raw(raw_model_text=raw, date=file_payload['date'])
+
+    def respond(self, file_payload, use_cache: bool = True):
+        """
+        Runs the receipt through the model. use_cache=False skips the cache lookup, for callers that already 
+        checked it with from_cache. The output is still written to the cache either way.
+        """
+        if use_cache:
+            cached = self.from_cache(file_payload)
+            if cached is not None:
+                return cached
         
         response = self.models.generate_content(
             model=self.model_name,
@@ -48,7 +87,72 @@ class Gemini(genai.Client):
         text_out = getattr(response, "text", None) or ""
         date_out = file_payload['date']
 
-        return ModelOutput.from_raw(raw_model_text=text_out, date=date_out)
+        model_output = ModelOutput.from_raw(raw_model_text=text_out, date=date_out)
+        usage = getattr(response, "usage_metadata", None)
+        if isinstance(model_output, ModelOutput) and usage is not None:
+            model_output.total_tokens = getattr(usage, "total_token_count", None) or 0
+        if self.cache is not None and isinstance(model_output, ModelOutput):
+            # only outputs that parsed are worth keeping
+            self.cache.put(self._cache_key(file_payload), text_out)
+        return model_output
+
+    def respond_packed(self, file_payloads: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Runs several receipts through the model in one request, so that they only use up one request of the 
+        per-minute quota. Returns one output per payload, in order: a ModelOutput, or an error message for the
+        receipts whose section of the answer didn't parse, which the caller can retry on their own.
+
+        Does not look in the cache, callers are expected to only pack receipts that missed it.
+        """
+        keys = [f"r{i + 1}" for i in range(len(file_payloads))]
+        contents = []
+        for key, file_payload in zip(keys, file_payloads):
+            contents.append(types.Part.from_text(text=f"Receipt {key}:"))
+            contents.append(types.Part.from_bytes(data=file_payload['file_data'], mime_type="application/pdf"))
+
+        response = self.models.generate_content(
+            model=self.model_name,
+            config=types.GenerateContentConfig(
+                system_instruction=self.system_instruction + PACKING_INSTRUCTION,
+                temperature=self.temperature,
+            ),
+            contents=contents,
+        )
+        text_out = getattr(response, "text", None) or ""
+        outputs = ModelOutput.split_packed(
+            raw_model_text=text_out, 
+            dates={key: file_payload['date'] for key, file_payload in zip(keys, file_payloads)}
+        )
+
+        usage = getattr(response, "usage_metadata", None)
+        total_tokens = (getattr(usage, "total_token_count", None) or 0) if usage is not None else 0
+        out = []
+        for key, file_payload in zip(keys, file_payloads):
+            model_output = outputs[key]
+            if isinstance(model_output, ModelOutput):
+                # the request is shared, so is the token count
+                model_output.total_tokens = total_tokens // len(file_payloads)
+                if self.cache is not None:
+                    # cached under the single receipt key: the section is exactly what a single call would answer
+                    self.cache.put(self._cache_key(file_payload), model_output.raw)
+            out.append(model_output)
+        return out
+
+    def fingerprint(self) -> str:
+        """
+        The model configuration the outputs come from, i.e., "gemini-2.5-flash-lite t=0.2 prompt=3f2a9c01d4e7".
+        Anything that changes it (model_name, temperature or system_prompt.txt) can change the rows of a receipt.
+        """
+        prompt_hash = hashlib.sha256(self.system_instruction.encode("utf-8")).hexdigest()[:12]
+        return f"{self.model_name} t={self.temperature!r} prompt={prompt_hash}"
+
+    def _cache_key(self, file_payload) -> str:
+        return ExtractionCache.make_key(
+            file_data=file_payload['file_data'],
+            model_name=self.model_name,
+            temperature=self.temperature,
+            system_instruction=self.system_instruction,
+        )
 
     def _get_system_prompt(self) -> str:
         here = os.path.dirname(os.path.abspath(__file__)) # this file's dir
@@ -0,0 +1,125 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from model.local_extractor import adds_up
+from model.model_output import ModelOutput, Row
+from utils import metrics
+from utils.journal import PROCESSED, FAILED
+from utils.utils import read_checkpoint, write_checkpoint
+
+
+# This module holds the batch committer, the last stage of the pipeline. It writes rows out in small batches
+# as the model outputs come in, instead of holding everything until the end of the run.
+
+class BatchCommitter:
+    """
+    This class collects model outputs and writes their rows out every batch_size receipts, moving the 
+    checkpoint along with each batch. Only the rows of the current batch are ever held, so memory
+    doesn't grow with the size of the mailbox, and a crash loses at most one batch.
+
+    Every receipt goes through the progress journal: processed once the model has read it, failed if it couldn't,
+    and written in the same transaction as its rows go into the local store. The processed and failed marks wait
+    for that transaction too, so a batch costs one commit (and one fsync) rather than one per receipt. A crash
+    before it loses nothing that matters: processed receipts are tried again anyway, their output coming back
+    from the extraction cache. The spreadsheet is then synced from
+    the store, so a kill at any point never loses or duplicates rows in either one.
+
+    Outputs have to be added in the order the receipts came in (oldest first), which ExtractionPipeline.run does.
+    With several gmail accounts, each one's checkpoint moves with its own receipts (the payload's "account").
+
+    sync_spreadsheet=False only moves the spreadsheet's export mark past the rows written, for a backfill into a
+    spreadsheet that already holds those receipts from before the local store, and is rebuilt afterwards.
+    """
+    def __init__(self, store, excel_writer, checkpoint_path: str, batch_size: int = 20, checkpoint_ms: int = 0,
+                 sync_spreadsheet: bool = True):
+        self.store = store
+        self.excel_writer = excel_writer
+        self.sync_spreadsheet = sync_spreadsheet
+        self.journal = store.journal
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        # {account: internal ms}, None being the token.json account (see utils.utils.write_checkpoint)
+        self.checkpoint_ms: Dict[Optional[str], int] = {None: checkpoint_ms}
+
+        self.receipts_seen = 0
+        self.receipts_processed = 0
+        self.rows_written = 0
+        self.receipts_skipped = 0
+        # receipts whose rows don't add up to the total printed on them, see add()
+        self.totals_mismatched = 0
+        self._pending: List[Tuple[str, str, List[Row]]] = []
+        self._pending_receipts = 0
+        self._pending_ms: Dict[Optional[str], int] = {None: checkpoint_ms}
+
+    @classmethod
+    def from_config(cls, store, excel_writer, checkpoint_path: str, cfg: Dict[str, Any], checkpoint_ms: int = 0,
+                    sync_spreadsheet: bool = True) -> "BatchCommitter":
+        """
+        Builds the committer from the [pipeline] table of config.toml
+        """
+        return cls(
+            store=store,
+            excel_writer=excel_writer,
+            checkpoint_path=checkpoint_path,
+            batch_size=cfg.get("pipeline", {}).get("write_batch_size", 20),
+            checkpoint_ms=checkpoint_ms,
+            sync_spreadsheet=sync_spreadsheet,
+        )
+
+    def add(self, payload: Dict[str, Any], model_output: Optional[ModelOutput]):
+        message_id = payload["message_id"]
+        self.receipts_seen += 1
+        self._pending_receipts += 1
+        account = payload.get("account")
+        self._pending_ms[account] = max(self._pending_ms.get(account, 0), payload["internal_ms"])
+        if model_output and getattr(model_output, "rows", None):
+            total = payload.get("items_total")
+            if total is not None and not adds_up(model_output.rows, total):
+                # kept as the model read it, but worth a look: a line was missed, misread or made up
+                print(f"Receipt {message_id}: the model's items come to {sum(r.price for r in model_output.rows):.2f}, "
+                      f"the items on the receipt come to {total:.2f}")
+                self.totals_mismatched += 1
+                metrics.count("total_checks_total", outcome="mismatch")
+            elif total is not None:
+                metrics.count("total_checks_total", outcome="ok")
+            self.journal.mark([message_id], PROCESSED, internal_ms=payload["internal_ms"], commit=False)
+            self._pending.append((message_id, payload["pdf_sha256"], model_output.rows))
+            self.receipts_processed += 1
+            metrics.count("receipts_total", outcome="processed")
+            print(f"Receipt {self.receipts_seen} Processed")
+        else:
+            self.journal.mark([message_id], FAILED, internal_ms=payload["internal_ms"], error="no rows parsed", commit=False)
+            metrics.count("receipts_total", outcome="failed")
+        if self._pending_receipts >= self.batch_size:
+            self.flush()
+
+    def flush(self, checkpoint_ms: Optional[int] = None, account: Optional[str] = None):
+        """
+        Writes whatever is pending, then moves the checkpoint past it. checkpoint_ms can push account's checkpoint
+        further, i.e., past messages that turned out not to have a receipt.
+        """
+        if self._pending:
+            with metrics.timed("store_write"):
+                written, skipped = self.store.write_receipts(self._pending)
+            if skipped:
+                print(f"Skipped {skipped} receipts that were already written")
+            self.rows_written += written
+            self.receipts_skipped += skipped
+            with metrics.timed("xlsx_sync"):
+                if self.sync_spreadsheet:
+                    self.excel_writer.sync(self.store)
+                else:
+                    # already in the spreadsheet, see sync_spreadsheet
+                    self.excel_writer.write_rows([], exported_through=self.store.max_id())
+        elif self._pending_receipts:
+            # a batch of failures only, their marks go in before the checkpoint moves past them
+            self.journal.commit()
+        if checkpoint_ms is not None:
+            self._pending_ms[account] = max(self._pending_ms.get(account, 0), checkpoint_ms)
+        for pending_account, ms in self._pending_ms.items():
+            if pending_account not in self.checkpoint_ms:
+                self.checkpoint_ms[pending_account] = read_checkpoint(self.checkpoint_path, account=pending_account)
+            if ms > self.checkpoint_ms[pending_account]:
+                write_checkpoint(self.checkpoint_path, ms, account=pending_account)
+                self.checkpoint_ms[pending_account] = ms
+        self._pending = []
+        self._pending_receipts = 0
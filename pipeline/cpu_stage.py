@@ -0,0 +1,136 @@
+import os
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from model.local_extractor import LocalExtractor
+
+
+# This module holds the cpu stage of the pipeline, which sits between the email grabber and the model. Reading
+# the pdf text layer and checking it against the receipt template is the only real cpu work per receipt, so it
+# runs in a process pool to use every core, instead of on one core under the gil. Receipts of any sender are
+# read for their total too, which the model's rows are checked against (see BatchCommitter.add).
+# The pdf bytes aren't pickled to the workers: each window of payloads is copied once into a shared memory
+# block, and the workers parse their pdf straight out of it through a memoryview.
+
+class CpuStage:
+    """
+    This class runs the local extractor over the payloads in worker processes. run() yields the same payloads
+    in the same order, each with a "local_output" key: the ModelOutput read from the text layer, or None if it
+    has to go to the model, in which case "items_total" holds what its items should add up to (None if there is
+    no text layer to read it from, see local_extractor.items_total). The hit/miss counts end up in the local extractor, as if it had run inline.
+    """
+    def __init__(self, local: LocalExtractor, workers: int = 0, window: int = 0):
+        self.local = local
+        self.workers = workers or os.cpu_count() or 1
+        # payloads per shared memory block; two blocks are in flight so the workers never wait on the grabber
+        self.window = window or self.workers * 8
+
+    @classmethod
+    def from_config(cls, local: Optional[LocalExtractor], cfg: Dict[str, Any]) -> Optional["CpuStage"]:
+        """
+        Builds the stage from the [pipeline] table of config.toml. Returns None if there is nothing for it to do,
+        i.e., no local extractor, or a single worker (cpu_workers = 1, or 0 on a one core machine), where the
+        extraction is cheaper inline in the model threads.
+        """
+        workers = cfg.get("pipeline", {}).get("cpu_workers", 0) or os.cpu_count() or 1
+        if local is None or workers <= 1:
+            return None
+        return cls(local=local, workers=workers)
+
+    def run(self, payloads: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        # spawn rather than fork, the pipeline has threads running by the time this starts
+        context = multiprocessing.get_context("spawn")
+        in_flight: Deque[Tuple[shared_memory.SharedMemory, List[Dict[str, Any]], List[Future]]] = deque()
+        with ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(list(self.local.templates.values()),)
+            ) as pool:
+            try:
+                window: List[Dict[str, Any]] = []
+                for payload in payloads:
+                    window.append(payload)
+                    if len(window) >= self.window:
+                        in_flight.append(self._submit(pool, window))
+                        window = []
+                        while len(in_flight) > 1:
+                            yield from self._collect(*in_flight.popleft())
+                if window:
+                    in_flight.append(self._submit(pool, window))
+                while in_flight:
+                    yield from self._collect(*in_flight.popleft())
+            finally:
+                for shm, _, _ in in_flight:
+                    shm.close()
+                    shm.unlink()
+
+    def _submit(self, pool: ProcessPoolExecutor, window: List[Dict[str, Any]]):
+        """
+        Copies the window's pdfs into one shared memory block, and hands each worker an offset into it.
+        """
+        size = sum(len(p["file_data"]) for p in window)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        futures = []
+        offset = 0
+        for payload in window:
+            n = len(payload["file_data"])
+            shm.buf[offset:offset + n] = payload["file_data"]
+            futures.append(pool.submit(_parse_in_worker, shm.name, offset, n, payload.get("sender")))
+            offset += n
+        return shm, window, futures
+
+    def _collect(self, shm: shared_memory.SharedMemory, window: List[Dict[str, Any]], futures: List[Future]) -> Iterator[Dict[str, Any]]:
+        try:
+            parsed = [f.result() for f in futures]
+        finally:
+            shm.close()
+            shm.unlink()
+        for payload, (result, total) in zip(window, parsed):
+            sender = payload.get("sender")
+            if sender in self.local.templates:
+                self.local.count(sender, hit=result is not None)
+            payload["local_output"] = self.local.to_output(result, payload["date"]) if result is not None else None
+            if result is None:
+                payload["items_total"] = total
+            yield payload
+
+
+# Worker side. Each worker process keeps its own extractor, and attaches to each shared memory block once.
+
+_worker_local: Optional[LocalExtractor] = None
+_worker_blocks: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _init_worker(templates):
+    global _worker_local
+    _worker_local = LocalExtractor(templates=templates)
+
+
+def _parse_in_worker(shm_name: str, offset: int, size: int, sender: Optional[str]):
+    shm = _worker_blocks.get(shm_name)
+    if shm is None:
+        # blocks are used once and in order, so only the current one is worth keeping open
+        for old in _worker_blocks.values():
+            old.close()
+        _worker_blocks.clear()
+        shm = _attach(shm_name)
+        _worker_blocks[shm_name] = shm
+    view = shm.buf[offset:offset + size]
+    try:
+        return _worker_local.read(sender, view)
+    finally:
+        view.release()
+
+
+def _attach(shm_name: str) -> shared_memory.SharedMemory:
+    # the parent owns the block and unlinks it. Before 3.13 there is no opting out of tracking, but spawned
+    # workers share the parent's resource tracker, so the block is still only cleaned up once.
+    try:
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+    except TypeError:  # python < 3.13
+        return shared_memory.SharedMemory(name=shm_name)
@@ -0,0 +1,193 @@
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from model.model_output import ModelOutput
+from utils import metrics
+from utils.rate_limiter import RateLimiter
+
+
+# This module holds the extraction pipeline. Downloads from gmail, model calls and row parsing all
+# overlap: a producer thread pulls payloads from the email grabber, a thread pool makes the model calls
+# (which also parse the rows), and the rate limiter keeps the whole thing under quota.
+
+_DONE = object()
+
+
+class ExtractionPipeline:
+    """
+    This class runs the payloads through the model concurrently.
+
+    run() yields (payload, model_output) in the same order the payloads came in, where model_output is None
+    if the model failed on that payload.
+
+    With pack_size > 1, up to that many receipts go out in a single model request (see Gemini.respond_packed),
+    so a requests-per-minute quota goes pack_size times further. Receipts whose part of a packed answer doesn't
+    parse are retried on their own.
+
+    Receipts the local extractor can read (see model/local_extractor.py) never reach the model at all.
+    """
+    def __init__(
+            self, 
+            gemini, 
+            limiter: RateLimiter, 
+            max_workers: int = 4, 
+            tokens_per_receipt: int = 2000,
+            pack_size: int = 1,
+            local=None,
+        ):
+        self.gemini = gemini
+        self.limiter = limiter
+        self.max_workers = max_workers
+        self.tokens_per_receipt = tokens_per_receipt
+        self.pack_size = max(1, pack_size)
+        self.local = local
+
+    @classmethod
+    def from_config(cls, gemini, cfg: Dict[str, Any], local=None) -> "ExtractionPipeline":
+        """
+        Builds the pipeline from the [rate_limit] table of config.toml
+        """
+        rl = cfg.get("rate_limit", {})
+        return cls(
+            gemini=gemini,
+            limiter=RateLimiter.from_config("Gemini", cfg),
+            max_workers=rl.get("max_workers", 4),
+            tokens_per_receipt=rl.get("tokens_per_receipt", 2000),
+            pack_size=rl.get("pack_size", 1),
+            local=local,
+        )
+
+    def run(self, payloads: Iterable[Dict[str, Any]]) -> Iterator[Tuple[Dict[str, Any], Optional[ModelOutput]]]:
+        downloaded: "queue.Queue[Any]" = queue.Queue(maxsize=self.max_workers * 2 * self.pack_size)
+        producer = threading.Thread(target=self._produce, args=(payloads, downloaded), daemon=True)
+        producer.start()
+
+        in_flight: Deque[Tuple[List[Dict[str, Any]], Future]] = deque()
+        pack: List[Dict[str, Any]] = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                try:
+                    payload = downloaded.get(timeout=0.1)
+                except queue.Empty:
+                    # downloads are the slow part right now, send off what we have and hand back whatever the model has finished
+                    if pack:
+                        in_flight.append((pack, pool.submit(self._extract_pack, pack)))
+                        pack = []
+                    while in_flight and in_flight[0][1].done():
+                        yield from self._pop(in_flight)
+                    continue
+                if payload is _DONE:
+                    break
+                if isinstance(payload, BaseException):
+                    raise payload
+                pack.append(payload)
+                if len(pack) < self.pack_size:
+                    continue
+                in_flight.append((pack, pool.submit(self._extract_pack, pack)))
+                pack = []
+                # keep at most two rounds of work in flight, and hand results back in order
+                while len(in_flight) > self.max_workers * 2 or (in_flight and in_flight[0][1].done()):
+                    yield from self._pop(in_flight)
+
+            if pack:
+                in_flight.append((pack, pool.submit(self._extract_pack, pack)))
+            while in_flight:
+                yield from self._pop(in_flight)
+
+    @staticmethod
+    def _pop(in_flight: Deque[Tuple[List[Dict[str, Any]], Future]]) -> Iterator[Tuple[Dict[str, Any], Optional[ModelOutput]]]:
+        done_pack, future = in_flight.popleft()
+        yield from zip(done_pack, future.result())
+
+    def _produce(self, payloads: Iterable[Dict[str, Any]], downloaded: "queue.Queue[Any]"):
+        """
+        Runs in its own thread so that gmail downloads keep going while the model works.
+        """
+        try:
+            for payload in payloads:
+                downloaded.put(payload)
+        except BaseException as e:
+            downloaded.put(e)
+        finally:
+            downloaded.put(_DONE)
+
+    def _extract_pack(self, pack: List[Dict[str, Any]]) -> List[Optional[ModelOutput]]:
+        """
+        Extracts a pack of receipts: known layouts are read locally, cached ones come straight from the cache,
+        and the rest go out in one request.
+        """
+        outputs: List[Optional[ModelOutput]] = [None] * len(pack)
+        misses = []
+        for i, payload in enumerate(pack):
+            if "local_output" in payload:
+                # already read by the cpu stage
+                local = payload["local_output"]
+            else:
+                local = self.local.extract(payload) if self.local is not None else None
+            if local is not None:
+                outputs[i] = local
+                metrics.count("extractions_total", source="local")
+                continue
+            cached = self.gemini.from_cache(payload)
+            if cached is not None:
+                outputs[i] = cached if isinstance(cached, ModelOutput) else None
+                metrics.count("extractions_total", source="cache")
+            else:
+                misses.append(i)
+
+        if len(misses) == 1:
+            outputs[misses[0]] = self._extract(pack[misses[0]], check_cache=False)
+        elif misses:
+            estimated = self.tokens_per_receipt * len(misses)
+            packed = self._call(lambda: self.gemini.respond_packed([pack[i] for i in misses]), tokens=estimated)
+            if packed is None:
+                packed = [None] * len(misses)
+            else:
+                # every receipt in the pack carries an equal share of the request's tokens
+                shares = [mo.total_tokens for mo in packed if isinstance(mo, ModelOutput)]
+                if shares:
+                    self.limiter.bucket.reconcile(estimated=estimated, actual=shares[0] * len(misses))
+            for i, mo in zip(misses, packed):
+                if isinstance(mo, ModelOutput):
+                    outputs[i] = mo
+                else:
+                    # fall back to a call of its own for anything the packed answer got wrong
+                    print(f"Packed extraction failed for one receipt ({mo}), retrying it on its own")
+                    metrics.count("pack_fallbacks_total")
+                    outputs[i] = self._extract(pack[i], check_cache=False)
+        return outputs
+
+    def _extract(self, payload: Dict[str, Any], check_cache: bool = True) -> Optional[ModelOutput]:
+        """
+        Makes one model call for a single receipt. Receipts that are already in the extraction cache don't count 
+        against the quota.
+        """
+        if check_cache:
+            cached = self.gemini.from_cache(payload)
+            if cached is not None:
+                return cached if isinstance(cached, ModelOutput) else None
+        metrics.count("extractions_total", source="model")
+        mo = self._call(lambda: self.gemini.respond(payload, use_cache=False), tokens=self.tokens_per_receipt)
+        if mo is None:
+            return None
+        if not isinstance(mo, ModelOutput):
+            # from_raw hands back an error message when the json is missing keys
+            print(f"Model failed on one payload: {mo}")
+            return None
+        self.limiter.bucket.reconcile(estimated=self.tokens_per_receipt, actual=mo.total_tokens)
+        return mo
+
+    def _call(self, fn: Callable[[], Any], tokens: int) -> Any:
+        """
+        Makes one model request through the rate limiter, which retries it for as long as the api says we are
+        rate limited. Returns None if it fails for any other reason.
+        """
+        try:
+            return self.limiter.call(fn, tokens=tokens)
+        except Exception as e:
+            print(f"Model failed on one payload: {e}")
+            return None
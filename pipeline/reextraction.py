@@ -0,0 +1,152 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from model.model_output import ModelOutput, Row
+from utils import metrics
+
+
+# This module holds the re-extraction engine. After a change of model_name, temperature or system_prompt.txt, it
+# replays the receipts kept in the local pdf store (email_service/blob_store.py) through the extraction pipeline,
+# concurrently and under the same quota as a normal run, without downloading anything. Each receipt's new rows are
+# compared with the ones in the local store, and only the receipts whose rows changed are rewritten.
+
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+class Reextractor:
+    """
+    This class runs every stored receipt that wasn't extracted with the current model configuration yet through
+    the pipeline, and writes the results every batch_size receipts: the changed receipts' rows are swapped in one
+    transaction (see SQLiteWriter.replace_receipts), and every receipt is noted as done with this configuration.
+    A run can be stopped at any point (or limited to a number of receipts) and picks up where it left off, and the
+    outputs of a batch that didn't get written are in the extraction cache for the next run.
+
+    Receipts the model gives no rows for keep their old rows, and are tried again on the next run. The spreadsheet
+    is rebuilt from the store once the run is through, if any receipt changed (or by the next sync, from any script,
+    if the run was stopped before that).
+    """
+    def __init__(self, store, blobs, pipeline, excel_writer, config: str, batch_size: int = 20):
+        self.store = store
+        self.blobs = blobs
+        self.pipeline = pipeline
+        self.excel_writer = excel_writer
+        # what the receipts are extracted with, see Gemini.fingerprint
+        self.config = config
+        self.batch_size = batch_size
+
+        self.counts = {CHANGED: 0, UNCHANGED: 0, FAILED: 0}
+        self.rows_removed = 0
+        self.rows_written = 0
+        self._pending: List[Tuple[str, Dict[str, Any], Optional[ModelOutput]]] = []
+
+    @classmethod
+    def from_config(cls, store, blobs, pipeline, excel_writer, config: str, cfg: Dict[str, Any]) -> "Reextractor":
+        """
+        Builds the engine, writing in batches of the [pipeline] table's write_batch_size
+        """
+        return cls(
+            store=store,
+            blobs=blobs,
+            pipeline=pipeline,
+            excel_writer=excel_writer,
+            config=config,
+            batch_size=cfg.get("pipeline", {}).get("write_batch_size", 20),
+        )
+
+    def plan(self, limit: Optional[int] = None) -> Tuple[List[Tuple[str, str]], Dict[str, int]]:
+        """
+        Returns the (message id, receipt id) of the receipts to extract again, oldest first (at most limit of them),
+        and {stored: receipts in the local store, done: already extracted with this configuration, no_pdf: receipts
+        whose pdf isn't in the pdf store}.
+        """
+        messages = self.blobs.messages()
+        receipt_ids = self.store.receipt_ids(messages)
+        done = self.store.extracted_with(list(receipt_ids.values()))
+        todo = [
+            (message_id, receipt_ids[message_id]) for message_id, _ in messages
+            if message_id in receipt_ids and done.get(receipt_ids[message_id]) != self.config
+        ]
+        stored = self.store.receipt_count()
+        plan = {
+            "stored": stored,
+            "done": sum(1 for config in done.values() if config == self.config),
+            "no_pdf": stored - len(set(receipt_ids.values())),
+        }
+        return todo[:limit] if limit else todo, plan
+
+    def run(self, limit: Optional[int] = None, dry_run: bool = False) -> Dict[str, int]:
+        """
+        Extracts the receipts of plan() again. dry_run only compares, i.e., to see how much a new prompt would change
+        before committing to it, and writes nothing (the model outputs still go to the extraction cache).
+        Returns the counts of changed, unchanged and failed receipts, and the rows removed and written.
+        """
+        todo, _ = self.plan(limit=limit)
+        receipt_of = dict(todo)
+        for payload, model_output in self.pipeline.run(self._payloads([message_id for message_id, _ in todo])):
+            self._pending.append((receipt_of[payload["message_id"]], payload, model_output))
+            if len(self._pending) >= self.batch_size:
+                self._flush(dry_run=dry_run)
+        self._flush(dry_run=dry_run)
+
+        if not dry_run:
+            # the rewritten rows are new rows in the store, sync regenerates the spreadsheet to match
+            with metrics.timed("xlsx_sync"):
+                self.excel_writer.sync(self.store)
+        return {**self.counts, "rows_removed": self.rows_removed, "rows_written": self.rows_written}
+
+# Helpers
+
+    def _payloads(self, message_ids: List[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Reads the pdfs from the pdf store a chunk at a time, in the pipeline's producer thread.
+        """
+        for i in range(0, len(message_ids), self.batch_size):
+            chunk = message_ids[i:i + self.batch_size]
+            payloads = self.blobs.payloads(chunk)
+            for message_id in chunk:
+                if message_id in payloads:
+                    yield payloads[message_id]
+
+    def _flush(self, dry_run: bool = False):
+        if not self._pending:
+            return
+        old = self.store.receipt_rows([receipt_id for receipt_id, _, _ in self._pending])
+        changed: List[Tuple[str, str, List[Row]]] = []
+        unchanged: List[str] = []
+        failed = 0
+        for receipt_id, payload, model_output in self._pending:
+            rows = getattr(model_output, "rows", None) if isinstance(model_output, ModelOutput) else None
+            if not rows:
+                failed += 1
+            elif self.same_rows(old[receipt_id], rows):
+                unchanged.append(receipt_id)
+            else:
+                changed.append((receipt_id, payload["message_id"], rows))
+                self.rows_removed += len(old[receipt_id])
+                self.rows_written += len(rows)
+
+        if not dry_run:
+            with metrics.timed("store_write"):
+                if changed:
+                    self.store.replace_receipts(changed, extracted_with=self.config)
+                if unchanged:
+                    self.store.mark_extracted(unchanged, self.config, UNCHANGED)
+
+        for outcome, n in ((CHANGED, len(changed)), (UNCHANGED, len(unchanged)), (FAILED, failed)):
+            self.counts[outcome] += n
+            if n:
+                metrics.count("reextractions_total", n, outcome=outcome)
+        print(f"{sum(self.counts.values())} receipts extracted again, {self.counts[CHANGED]} changed")
+        self._pending = []
+
+    @staticmethod
+    def same_rows(old: List[Row], new: List[Row]) -> bool:
+        """
+        Whether two extractions of a receipt come to the same rows, in any order. Prices are compared to the
+        precision they are stored at, not to the last bit of the division.
+        """
+        def key(r: Row):
+            return (r.item, r.quantity, round(r.price, 6), round(r.price_per_unit, 6), r.date.replace(tzinfo=None))
+
+        return len(old) == len(new) and sorted(map(key, old)) == sorted(map(key, new))
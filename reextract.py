@@ -0,0 +1,86 @@
+import os
+import argparse
+
+from email_service.blob_store import BlobStore
+from model.model_wrapper import Gemini
+from model.extraction_cache import ExtractionCache
+from model.local_extractor import LocalExtractor
+from model.batch_backend import GeminiBatch
+from pipeline.extraction import ExtractionPipeline
+from pipeline.reextraction import Reextractor
+from writers.excel_writer import ExcelWriter
+from writers.sqlite_writer import SQLiteWriter
+from utils import metrics
+from utils.http_pool import HttpPool
+from utils.utils import load_config
+
+# After changing model_name in config.toml or model/system_prompt.txt, this script extracts the receipts already in
+# the local store again with the new configuration, reading the pdfs from the local pdf store (see [blobs] in
+# config.toml) instead of gmail, and rewrites only the receipts whose rows came out different. It can be stopped and
+# started again, and --limit migrates a big history a bit at a time.
+
+cwd = os.getcwd()
+cfg = load_config()
+
+def main(model_name: str = None, limit: int = 0, batch: bool = False, dry_run: bool = False):
+  blobs = BlobStore.from_config(cwd, cfg)
+  if blobs is None:
+    print("The pdf store is turned off in config.toml ([blobs] enabled = false), there is nothing to extract from")
+    return
+
+  http_pool = HttpPool.from_config(cfg)
+  extraction_cache = ExtractionCache.from_config(cwd, cfg)
+  local_extractor = LocalExtractor.from_config(cfg)
+  gemini = Gemini(
+    model_name=model_name or cfg["model_name"], temperature=cfg["temperature"], cache=extraction_cache, http=http_pool
+  )
+  store = SQLiteWriter(app_directory=cwd)
+  excel_writer = ExcelWriter(app_directory=cwd)
+  if excel_writer.holds_rows_from_before_store():
+    # rebuilding it from the store would drop them
+    print("The spreadsheet has rows from before the local store, run setup.py first to get them into the store")
+    return
+  if not dry_run:
+    if store.needs_export():
+      # an earlier run rewrote receipts and was stopped before it rebuilt the spreadsheet
+      print("Rebuilding the spreadsheet with the receipts an earlier run rewrote")
+    # finish anything an earlier, interrupted run left between the store and the spreadsheet
+    excel_writer.sync(store)
+  if batch:
+    pipeline = GeminiBatch.from_config(gemini=gemini, cfg=cfg, local=local_extractor, app_directory=cwd)
+  else:
+    pipeline = ExtractionPipeline.from_config(gemini=gemini, cfg=cfg, local=local_extractor)
+  reextractor = Reextractor.from_config(
+    store=store, blobs=blobs, pipeline=pipeline, excel_writer=excel_writer, config=gemini.fingerprint(), cfg=cfg
+  )
+
+  todo, plan = reextractor.plan(limit=limit)
+  print(f"Extracting with {gemini.fingerprint()}")
+  print(f"{plan['stored']} receipts in the store: {plan['done']} already done, {len(todo)} to go"
+        + (f" (limited to {limit})" if limit else ""))
+  if plan["no_pdf"]:
+    # from before the pdf store, or evicted from it. setup.py downloads them again
+    print(f"{plan['no_pdf']} receipts have no pdf in the local pdf store and are left as they are")
+  if not todo:
+    print("🤖: Nothing to do!")
+    return
+
+  result = reextractor.run(limit=limit, dry_run=dry_run)
+  print(f"{result['changed']} receipts changed, {result['unchanged']} unchanged, {result['failed']} failed (kept as they were)")
+  print(f"{result['rows_removed']} rows replaced by {result['rows_written']}" + (" (dry run, nothing written)" if dry_run else ""))
+  if not batch:
+    print(pipeline.limiter.summary())
+  store.close()
+  print("🤖: Done!")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Extract the stored receipts again after a model or prompt change")
+  parser.add_argument("--model", help="the model to extract with, instead of model_name in config.toml")
+  parser.add_argument("--limit", type=int, default=0, help="extract at most this many receipts in this run")
+  parser.add_argument("--batch", action="store_true", help="extract with the gemini batch api instead of one call per receipt")
+  parser.add_argument("--dry-run", action="store_true", help="only count what would change, write nothing")
+  args = parser.parse_args()
+  try:
+    main(model_name=args.model, limit=args.limit, batch=args.batch, dry_run=args.dry_run)
+  finally:
+    metrics.write_summary(os.path.join(cwd, "logs"), run="reextract", dry_run=args.dry_run)
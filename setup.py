@@ -1,86 +1,132 @@
 import os
-import time
-import re
+import argparse
 
-from email_service.email_grabber import EmailGrabber
+from email_service.blob_store import BlobStore
+from email_service.sharded_grabber import ShardedGrabber
 from model.model_wrapper import Gemini
+from model.extraction_cache import ExtractionCache
+from model.local_extractor import LocalExtractor
+from model.batch_backend import GeminiBatch
+from pipeline.extraction import ExtractionPipeline
+from pipeline.cpu_stage import CpuStage
+from pipeline.committer import BatchCommitter
 from writers.excel_writer import ExcelWriter
-from utils.utils import write_checkpoint, setup, rate_limit, load_config
+from writers.sqlite_writer import SQLiteWriter
+from utils import metrics
+from utils.http_pool import HttpPool
+from utils.utils import read_checkpoint, write_checkpoint, setup, load_config
 
 
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 cwd = os.getcwd()
 cfg = load_config()
-senders = cfg["senders"]
 model_name = cfg["model_name"]
 temperature = cfg["temperature"]
 checkpoint_file_path = os.path.join(cwd, "checkpoint.json")
 
-def main():
+def main(batch: bool = False):
 
-    credentials = setup(SCOPES=SCOPES)
-    print("Credentials validated")
+    def authorize(account):
+      if account.name:
+        print(f"Authorizing {account.name}")
+      return setup(SCOPES=SCOPES, token_path=account.token_path)
 
-    mail_grabber = EmailGrabber(credentials=credentials, senders=senders)
-    gemini = Gemini(model_name=model_name, temperature=temperature)
+    # one keep-alive connection pool for every gmail and gemini call, see [http] in config.toml
+    http_pool = HttpPool.from_config(cfg)
+    # every downloaded pdf is kept on disk, so a second run reads them from there instead of gmail
+    blobs = BlobStore.from_config(cwd, cfg)
+    # one grabber per gmail account in config.toml, each with its own token and quota
+    mail_grabber = ShardedGrabber.from_config(cfg, credentials_for=authorize, http=http_pool, blobs=blobs)
+    print("Credentials validated")
+    extraction_cache = ExtractionCache.from_config(cwd, cfg)
+    # receipts with a known layout are read from their text layer without the model
+    local_extractor = LocalExtractor.from_config(cfg)
+    gemini = Gemini(model_name=model_name, temperature=temperature, cache=extraction_cache, http=http_pool)
     # print(gemini.system_instruction)
+    store = SQLiteWriter(app_directory=cwd)
     excel_writer = ExcelWriter(app_directory=cwd)
-
-    # get emails
+    if batch:
+      # one batch job for the whole backfill: slower to come back, but off the per-minute quota and cheaper
+      pipeline = GeminiBatch.from_config(gemini=gemini, cfg=cfg, local=local_extractor, app_directory=cwd)
+    else:
+      pipeline = ExtractionPipeline.from_config(gemini=gemini, cfg=cfg, local=local_extractor)
+    # finish anything a previous, interrupted run left between the store and the spreadsheet
+    excel_writer.sync(store)
+    # a spreadsheet filled before the local store already has these receipts, so appending them would write them twice
+    rebuild_spreadsheet = excel_writer.holds_rows_from_before_store()
+    if rebuild_spreadsheet:
+      print("The spreadsheet has rows from before the local store, it is rebuilt from the store once every email is in")
+    # the rows are written out in batches as they come in, and the checkpoint moves along with them
+    committer = BatchCommitter.from_config(
+      store=store, excel_writer=excel_writer, checkpoint_path=checkpoint_file_path, cfg=cfg,
+      sync_spreadsheet=not rebuild_spreadsheet
+    )
+    done_ids = store.journal.done_ids()
+    if done_ids:
+      print(f"Resuming: {len(done_ids)} emails already done")
+
+    # get emails and run the model on them as they come in
     print("Getting emails")
-    payloads = mail_grabber.ingest_historical_messages()
-    if not payloads:
-      print("No emails found. Try a different sender.")
+    # noted before listing, so that update.py picks up from here with the history api and misses nothing in between
+    history_ids = mail_grabber.current_history_ids()
+    # every (account, sender) is listed and downloaded at once, and merged back oldest first
+    payloads = mail_grabber.iter_historical_messages(skip_ids=done_ids)
+    cpu_stage = CpuStage.from_config(local=local_extractor, cfg=cfg)
+    if cpu_stage is not None:
+      # read the text layers on every core while the model works on the rest
+      payloads = cpu_stage.run(payloads)
+    for payload, mo in pipeline.run(payloads):
+      committer.add(payload, mo)
+    committer.flush()
+    if rebuild_spreadsheet:
+      excel_writer.rebuild(store)
+    for account, history_id in history_ids.items():
+      write_checkpoint(
+        checkpoint_file_path, read_checkpoint(checkpoint_file_path, account=account), history_id=history_id, account=account
+      )
+
+    if not committer.receipts_seen:
+      if done_ids:
+        print("No new emails found. Everything is up to date.")
+      else:
+        print("No emails found. Try a different sender.")
       return 
-
-    print("Emails found")
-
-    # run model on the payloads
-    model_outputs = []
-    number_of_receipts = len(payloads)
-    receipts_processed = 1
-    for payload in payloads:
-      while True:
-        rate_limit()
-        try:
-          mo = gemini.respond(payload)
-          if mo and getattr(mo, "rows", None):
-            model_outputs.append(mo)
-            print(f"Receipt {receipts_processed}/{number_of_receipts} Processed")
-            receipts_processed += 1
-          break
-        except Exception as e:
-          msg = str(e)
-          if "RESOURCE_EXHAUSTED" in msg or "429" in msg:
-            # extract suggested wait time.
-            m = re.search(r"retry in ([\d\.]+)s", msg)
-            delay = float(m.group(1)) if m else 25.0
-            print(f"Rate limit hit. Sleeping {delay:.1f}s, retrying same receipt…")
-            time.sleep(delay)
-            continue  # retry SAME payload
-          else:
-            print(f"Model failed on one payload: {e}")
-            break
-        
-    rows_to_write = []
-    for mo in model_outputs:
-      rows_to_write.extend(mo.rows)
     
-    if not rows_to_write:
+    if not committer.rows_written:
       print("No valid rows parsed from model outputs")
       return
 
-    excel_writer.write_rows(rows_to_write)
-
-    last_ms = max(p["internal_ms"] for p in payloads)
-
-    write_checkpoint(checkpoint_file_path, last_ms)
-
+    if committer.totals_mismatched:
+      print(f"{committer.totals_mismatched} receipts don't add up to the total printed on them (kept as read, see above)")
+    if extraction_cache is not None:
+      stats = extraction_cache.stats()
+      print(f"Extraction cache: {stats['hits']} hits, {stats['misses']} misses")
+    if blobs is not None:
+      stats = blobs.stats()
+      print(f"Local pdfs: {stats['hits']} read from disk, {stats['misses']} not stored yet ({stats['bytes'] / 2**20:.0f} MB kept)")
+    if local_extractor is not None:
+      for sender, stats in local_extractor.stats().items():
+        read = stats['hits'] + stats['misses']
+        print(f"Read locally from {sender}: {stats['hits']} of {read} ({stats['hits'] / read:.0%})")
+
+    for limiter in mail_grabber.limiters:
+      print(limiter.summary())
+    if not batch:
+      print(pipeline.limiter.summary())
+    if http_pool is not None:
+      print(http_pool.summary())
     print("🤖: Done!")
 
 if __name__ == "__main__":
-  main()
+  parser = argparse.ArgumentParser(description="Backfill the spreadsheet with every receipt in the mailbox")
+  parser.add_argument("--batch", action="store_true", help="extract with the gemini batch api instead of one call per receipt")
+  args = parser.parse_args()
+  try:
+    main(batch=args.batch)
+  finally:
+    # where the time went (gmail, gemini, rate limit waits, the spreadsheet), see utils/metrics.py
+    metrics.write_summary(os.path.join(cwd, "logs"), run="setup", batch=args.batch)
 
       
       
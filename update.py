@@ -1,94 +1,115 @@
 import os
-import time
-import re
 
 from google.auth.exceptions import RefreshError
 
-from email_service.email_grabber import EmailGrabber
-from model.model_wrapper import Gemini
+from email_service.blob_store import BlobStore
+from email_service.sharded_grabber import ShardedGrabber, ShardedHistorySync
 from writers.excel_writer import ExcelWriter
-from utils.utils import write_checkpoint, read_checkpoint, setup, rate_limit, load_config
+from writers.sqlite_writer import SQLiteWriter
+from utils import metrics
+from utils.http_pool import HttpPool
+from utils.utils import read_checkpoint, setup, load_config
 
 
+# Most scheduled runs find no new mail, so this only imports what checking the mailbox needs. The model, the
+# pdf reader and the pipeline are imported once there are receipts to process (see benchmarks/bench_startup.py).
+
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
-cwd = os.getcwd()
-cfg = load_config()
-senders = cfg["senders"]
-model_name = cfg["model_name"]
-temperature = cfg["temperature"]
-checkpoint_file_path = os.path.join(cwd, "checkpoint.json")
 
 def main():
 
-  try:
-    credentials = setup(SCOPES=SCOPES)
-    print("Credentials validated")
-  except RefreshError:
-    print("Token expired or revoked, re-authorizing...")
-    token_path = "token.json"
-    if os.path.exists(token_path):
-      os.remove(token_path)
-      print("Deleted expired/revoked token file")
-
-    credentials = setup(SCOPES=SCOPES)
-    print("Credentials re-created and validated")
-
-  mail_grabber = EmailGrabber(credentials=credentials, senders=senders)
-  gemini = Gemini(model_name=model_name, temperature=temperature)
+  cwd = os.getcwd()
+  cfg = load_config()
+  checkpoint_file_path = os.path.join(cwd, "checkpoint.json")
+
+  def authorize(account):
+    label = f" for {account.name}" if account.name else ""
+    try:
+      credentials = setup(SCOPES=SCOPES, token_path=account.token_path)
+      print(f"Credentials{label} validated")
+    except RefreshError:
+      print(f"Token{label} expired or revoked, re-authorizing...")
+      if os.path.exists(account.token_path):
+        os.remove(account.token_path)
+        print("Deleted expired/revoked token file")
+
+      credentials = setup(SCOPES=SCOPES, token_path=account.token_path)
+      print(f"Credentials{label} re-created and validated")
+    return credentials
+
+  # one keep-alive connection pool for every gmail and gemini call, see [http] in config.toml
+  http_pool = HttpPool.from_config(cfg)
+  # every downloaded pdf is kept on disk, see [blobs] in config.toml
+  blobs = BlobStore.from_config(cwd, cfg)
+  # one grabber per gmail account in config.toml, each with its own token and quota
+  mail_grabber = ShardedGrabber.from_config(cfg, credentials_for=authorize, http=http_pool, blobs=blobs)
+  store = SQLiteWriter(app_directory=cwd)
   excel_writer = ExcelWriter(app_directory=cwd)
 
+  # finish anything a previous, interrupted run left between the store and the spreadsheet
+  excel_writer.sync(store)
+
   print("Getting emails")
   last_internal_ms = read_checkpoint(checkpoint_file_path)
-  # get emails
-  payloads, max_ms = mail_grabber.ingest_new_messages(last_internal_ms=last_internal_ms)
+  # only what changed since the last run (one request per account if nothing did), skipping any that an interrupted
+  # run already wrote
+  history_sync = ShardedHistorySync(grabber=mail_grabber, checkpoint_path=checkpoint_file_path)
+  payloads, history_id, max_ms = history_sync.poll(skip_ids=store.journal.done_ids())
   if not payloads:
+    history_sync.commit(history_id=history_id, max_ms=max_ms)
     print("No emails found. No updates.")
     return 
 
   print("Emails found")
 
-  # run model on the payloads
-  model_outputs = []
-  number_of_receipts = len(payloads)
-  receipts_processed = 1
-  for payload in payloads:
-    while True:
-      rate_limit()
-      try:
-        mo = gemini.respond(payload)
-        if mo and getattr(mo, "rows", None):
-          model_outputs.append(mo)
-          print(f"Receipt {receipts_processed}/{number_of_receipts} Processed")
-          receipts_processed += 1
-        break
-      except Exception as e:
-        msg = str(e)
-        if "RESOURCE_EXHAUSTED" in msg or "429" in msg:
-          # extract suggested wait time.
-          m = re.search(r"retry in ([\d\.]+)s", msg)
-          delay = float(m.group(1)) if m else 25.0
-          print(f"Rate limit hit. Sleeping {delay:.1f}s, retrying same receipt…")
-          time.sleep(delay)
-          continue  # retry SAME payload
-        else:
-          print(f"Model failed on one payload: {e}")
-          break
-      
-  rows_to_write = []
-  for mo in model_outputs:
-    rows_to_write.extend(mo.rows)
+  from model.model_wrapper import Gemini
+  from model.extraction_cache import ExtractionCache
+  from model.local_extractor import LocalExtractor
+  from pipeline.extraction import ExtractionPipeline
+  from pipeline.committer import BatchCommitter
+
+  extraction_cache = ExtractionCache.from_config(cwd, cfg)
+  # receipts with a known layout are read from their text layer without the model
+  local_extractor = LocalExtractor.from_config(cfg)
+  gemini = Gemini(model_name=cfg["model_name"], temperature=cfg["temperature"], cache=extraction_cache, http=http_pool)
+
+  # run model on the payloads, writing the rows out in batches as they come in
+  pipeline = ExtractionPipeline.from_config(gemini=gemini, cfg=cfg, local=local_extractor)
+  committer = BatchCommitter.from_config(
+    store=store, excel_writer=excel_writer, checkpoint_path=checkpoint_file_path, cfg=cfg, checkpoint_ms=last_internal_ms
+  )
+  for payload, mo in pipeline.run(payloads):
+    committer.add(payload, mo)
+  committer.flush()
+  # moves every account's checkpoint past what was listed, receipt or not
+  history_sync.commit(history_id=history_id, max_ms=max_ms)
   
-  if not rows_to_write:
+  if not committer.rows_written:
     print("No valid rows parsed from model outputs")
     return
-  
-  excel_writer.write_rows(rows_to_write)
 
-  write_checkpoint(checkpoint_file_path, max_ms)
+  if committer.totals_mismatched:
+    print(f"{committer.totals_mismatched} receipts don't add up to the total printed on them (kept as read, see above)")
+  if extraction_cache is not None:
+    stats = extraction_cache.stats()
+    print(f"Extraction cache: {stats['hits']} hits, {stats['misses']} misses")
+  if local_extractor is not None:
+    for sender, stats in local_extractor.stats().items():
+      read = stats['hits'] + stats['misses']
+      print(f"Read locally from {sender}: {stats['hits']} of {read} ({stats['hits'] / read:.0%})")
 
+  for limiter in mail_grabber.limiters:
+    print(limiter.summary())
+  print(pipeline.limiter.summary())
+  if http_pool is not None:
+    print(http_pool.summary())
   print("🤖: Done!")
 
 if __name__ == "__main__":
-  main()
+  try:
+    main()
+  finally:
+    # where the time went (gmail, gemini, rate limit waits, the spreadsheet), see utils/metrics.py
+    metrics.write_summary(os.path.join(os.getcwd(), "logs"), run="update")
 
     
\ No newline at end of file
@@ -0,0 +1,239 @@
+import re
+import threading
+import importlib.util
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from utils import metrics
+
+
+# This module holds the http transport the gmail and gemini clients share: one httpx connection pool per process,
+# safe to use from every thread, keeping connections alive between calls (and on HTTP/2 when the h2 package is
+# installed, several calls on one connection). googleapiclient's default httplib2 transport is one connection that
+# can't be shared between threads, so concurrent fetching either queued up on it or opened a new TLS session for
+# every client.
+#
+# Every request is traced, so stats() shows how many connections were opened for how many requests, i.e., whether
+# the concurrent shards and model calls really run over parallel, reused sockets.
+
+_REQUEST_COUNT = re.compile(r"Request Count: (\d+)")
+
+
+class HttpPool:
+    """
+    This class owns the pooled httpx client. gmail_http() wraps it for googleapiclient (which expects an
+    httplib2-like object), and genai_options() hands it to the genai client.
+
+    max_connections is the most sockets open at once (per process, across hosts), keepalive_connections how
+    many of them stay open when idle, for keepalive_seconds.
+    """
+    def __init__(
+            self,
+            max_connections: int = 20,
+            keepalive_connections: int = 20,
+            keepalive_seconds: float = 60.0,
+            http2: bool = True,
+            timeout_seconds: float = 120.0
+        ):
+        # HTTP/2 needs the optional h2 package (uv pip install "httpx[http2]"), HTTP/1.1 keep-alive otherwise
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.timeout_seconds = timeout_seconds
+        self._lock = threading.Lock()
+        self._requests: Dict[str, int] = {}
+        self._opened: Dict[str, int] = {}
+        self._transport = _TracedTransport(
+            self,
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=keepalive_connections,
+                keepalive_expiry=keepalive_seconds,
+            ),
+        )
+        self.client = httpx.Client(transport=self._transport, timeout=timeout_seconds, follow_redirects=True)
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["HttpPool"]:
+        """
+        Builds the pool from the [http] table of config.toml, or None if it is turned off there (the clients
+        then use their own default transports).
+        """
+        http = cfg.get("http", {})
+        if not http.get("enabled", True):
+            return None
+        return cls(
+            max_connections=http.get("max_connections", 20),
+            keepalive_connections=http.get("keepalive_connections", 20),
+            keepalive_seconds=http.get("keepalive_seconds", 60.0),
+            http2=http.get("http2", True),
+            timeout_seconds=http.get("timeout_seconds", 120.0),
+        )
+
+    def gmail_http(self, credentials: Any) -> "AuthorizedHttpx":
+        """
+        An httplib2 stand in for googleapiclient.discovery.build(http=...), authorized with credentials.
+        """
+        return AuthorizedHttpx(self.client, credentials)
+
+    def genai_options(self) -> Any:
+        """
+        http_options for genai.Client that put its calls on this pool.
+        """
+        from google.genai import types
+
+        if "httpx_client" in types.HttpOptions.model_fields:
+            return types.HttpOptions(httpx_client=self.client)
+        # older google-genai can't take a client, only the settings to build its own pool with
+        return types.HttpOptions(client_args={"limits": self._transport.limits, "http2": self.http2})
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        {host: {requests, connections_opened, reused_share}} since the pool was made, plus the connections open
+        right now with how many requests each has carried.
+        """
+        with self._lock:
+            hosts = {
+                host: {
+                    "requests": n,
+                    "connections_opened": self._opened.get(host, 0),
+                    "reused_share": round(1 - self._opened.get(host, 0) / n, 3) if n else 0.0,
+                }
+                for host, n in self._requests.items()
+            }
+        return {"http2": self.http2, "hosts": hosts, "open_connections": self._transport.open_connections()}
+
+    def summary(self) -> str:
+        stats = self.stats()
+        parts = [
+            f"{host}: {s['requests']} requests on {s['connections_opened']} connections ({s['reused_share']:.0%} reused)"
+            for host, s in sorted(stats["hosts"].items())
+        ]
+        return f"HTTP{'/2' if stats['http2'] else '/1.1'}: " + ("; ".join(parts) if parts else "no requests")
+
+    def close(self):
+        self.client.close()
+
+    def _record(self, host: str, opened: bool):
+        metrics.count("http_requests_total", host=host)
+        if opened:
+            metrics.count("http_connections_opened_total", host=host)
+        with self._lock:
+            self._requests[host] = self._requests.get(host, 0) + 1
+            if opened:
+                self._opened[host] = self._opened.get(host, 0) + 1
+
+
+class _TracedTransport(httpx.HTTPTransport):
+    """
+    httpx's transport, noting for every request whether it had to open a connection or reused one.
+    """
+    def __init__(self, pool: HttpPool, limits: httpx.Limits, http2: bool):
+        super().__init__(limits=limits, http2=http2)
+        self.pool = pool
+        self.limits = limits
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        opened = []
+
+        def trace(event: str, info: Dict[str, Any]):
+            if event == "connection.connect_tcp.complete":
+                opened.append(True)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        try:
+            return super().handle_request(request)
+        finally:
+            self.pool._record(request.url.host, bool(opened))
+
+    def open_connections(self) -> List[Dict[str, Any]]:
+        """
+        The connections in the pool right now, i.e., [{origin, state, requests carried so far}]
+        """
+        out = []
+        for connection in list(self._pool.connections):
+            # i.e., "'https://gmail.googleapis.com:443', HTTP/1.1, IDLE, Request Count: 12"
+            info = connection.info()
+            count = _REQUEST_COUNT.search(info)
+            fields = [f.strip() for f in info.split(",")]
+            out.append({
+                "origin": str(getattr(connection, "_origin", "")),
+                "state": fields[-2] if count and len(fields) > 2 else info,
+                "requests": int(count.group(1)) if count else 0,
+            })
+        return out
+
+
+class AuthorizedHttpx:
+    """
+    The part of httplib2.Http that googleapiclient uses (request() returning (response, content)), on the shared
+    httpx client, adding the google-auth credentials to every request like google_auth_httplib2.AuthorizedHttp.
+    Unlike httplib2.Http, one of these can be used from several threads at once.
+    """
+    def __init__(self, client: Any, credentials: Any):
+        self.client = client
+        # googleapiclient looks for .credentials to authorize the calls inside a batch
+        self.credentials = credentials
+        self._refresh_request = None
+        # the credentials and the httplib2 connection refreshing them are shared by every thread, so only one
+        # refreshes at a time, and the others use the token it got
+        self._auth_lock = threading.Lock()
+
+    def request(
+            self,
+            uri: str,
+            method: str = "GET",
+            body: Optional[Any] = None,
+            headers: Optional[Dict[str, str]] = None,
+            **kwargs: Any
+        ) -> Tuple[Any, bytes]:
+        headers = dict(headers or {})
+        sent_token = None
+        if self.credentials is not None:
+            with self._auth_lock:
+                # refreshes first if the token ran out, which another thread may have done while this one waited
+                self.credentials.before_request(self._auth_request(), method, uri, headers)
+                sent_token = self.credentials.token
+        try:
+            response = self.client.request(method, uri, content=body, headers=headers)
+            if response.status_code == 401 and getattr(self.credentials, "refresh_token", None):
+                # the token ran out between the check and the call, once more with a fresh one
+                with self._auth_lock:
+                    # unless another thread got the same 401 and refreshed it already
+                    if self.credentials.token == sent_token or not self.credentials.valid:
+                        self.credentials.refresh(self._auth_request())
+                    self.credentials.apply(headers)
+                response = self.client.request(method, uri, content=body, headers=headers)
+        except httpx.TimeoutException as e:
+            # what the rate limiter and googleapiclient retry on
+            raise TimeoutError(str(e)) from e
+        except httpx.TransportError as e:
+            raise ConnectionError(str(e)) from e
+        return self._to_httplib2(response), response.content
+
+    def close(self):
+        # the pool outlives the clients built on it
+        pass
+
+    def _auth_request(self):
+        # only used to refresh the token, which is rare enough for httplib2
+        if self._refresh_request is None:
+            import httplib2
+            import google_auth_httplib2
+
+            self._refresh_request = google_auth_httplib2.Request(httplib2.Http())
+        return self._refresh_request
+
+    @staticmethod
+    def _to_httplib2(response: httpx.Response) -> Any:
+        import httplib2
+
+        info = {k.lower(): v for k, v in response.headers.items()}
+        # httpx already undid the compression
+        info.pop("content-encoding", None)
+        info.pop("content-length", None)
+        info["status"] = str(response.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = response.reason_phrase
+        return resp
@@ -0,0 +1,84 @@
+import time
+import sqlite3
+
+from typing import Iterable, Optional, Set
+
+
+# This module holds the progress journal, which remembers what happened to every gmail message so that
+# setup.py and update.py can pick up where they left off. It lives in the same sqlite database as the rows
+# (receipt-buddy.db), so marking a receipt as written happens in the same transaction as writing its rows.
+
+PROCESSED = "processed"  # the model has read the receipt (and its output is in the extraction cache)
+WRITTEN = "written"      # the rows are in the local store
+FAILED = "failed"        # the model couldn't make sense of it
+
+
+class ProgressJournal:
+    """
+    This class records the state of each message id. It shares the connection of the SQLiteWriter,
+    and only commits when asked to, so that the writer can fold journal updates into its own transactions.
+    """
+    def __init__(self, conn: sqlite3.Connection, max_attempts: int = 3):
+        self.conn = conn
+        self.max_attempts = max_attempts
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS progress ("
+                "message_id TEXT PRIMARY KEY, "
+                "state TEXT NOT NULL, "
+                "internal_ms INTEGER, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "error TEXT, "
+                "updated_at REAL NOT NULL)"
+            )
+
+    def mark(
+            self,
+            message_ids: Iterable[str],
+            state: str,
+            internal_ms: Optional[int] = None,
+            error: Optional[str] = None,
+            commit: bool = True
+        ):
+        """
+        Moves the given messages to state. A failure counts as an attempt. With commit=False the change
+        becomes part of whatever transaction the caller has open.
+        """
+        now = time.time()
+        attempt = 1 if state == FAILED else 0
+        self.conn.executemany(
+            "INSERT INTO progress (message_id, state, internal_ms, attempts, error, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(message_id) DO UPDATE SET "
+            "state = excluded.state, "
+            "internal_ms = COALESCE(excluded.internal_ms, progress.internal_ms), "
+            "attempts = progress.attempts + excluded.attempts, "
+            "error = excluded.error, "
+            "updated_at = excluded.updated_at",
+            [(message_id, state, internal_ms, attempt, error, now) for message_id in message_ids],
+        )
+        if commit:
+            self.conn.commit()
+
+    def commit(self):
+        """
+        Commits the marks made with commit=False, for when no transaction of the writer's comes along to take them.
+        """
+        self.conn.commit()
+
+    def done_ids(self) -> Set[str]:
+        """
+        The messages a run can skip: anything already written, and anything that has failed too many times.
+        """
+        cursor = self.conn.execute(
+            "SELECT message_id FROM progress WHERE state = ? OR (state = ? AND attempts >= ?)",
+            (WRITTEN, FAILED, self.max_attempts),
+        )
+        return {row[0] for row in cursor}
+
+    def state(self, message_id: str) -> Optional[str]:
+        row = self.conn.execute("SELECT state FROM progress WHERE message_id = ?", (message_id,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self) -> dict:
+        return dict(self.conn.execute("SELECT state, COUNT(*) FROM progress GROUP BY state").fetchall())
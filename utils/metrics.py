@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+# This module holds the run metrics: how long each stage of the pipeline took (as latency histograms), how many
+# api calls were made and retried, how much was downloaded, and how long was spent sleeping on rate limits.
+# The code being measured records into a single registry through the module level functions, i.e.,
+#
+#   with metrics.timed("xlsx_sync"):
+#       ...
+#   metrics.count("bytes_downloaded_total", len(data), api="gmail")
+#
+# and the entry points write it out as a json summary per run in logs/, or serve it to prometheus (daemon.py).
+
+PREFIX = "receipt_buddy_"
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Histogram:
+    """
+    Counts of observations per latency bucket, plus their sum. Not thread-safe on its own, the registry locks.
+    """
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def copy(self) -> "Histogram":
+        h = Histogram()
+        h.counts = list(self.counts)
+        h.total = self.total
+        return h
+
+    def minus(self, other: Optional["Histogram"]) -> "Histogram":
+        h = self.copy()
+        if other is not None:
+            h.counts = [a - b for a, b in zip(self.counts, other.counts)]
+            h.total -= other.total
+        return h
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimated from the buckets, interpolating inside the one the quantile falls in (like prometheus'
+        histogram_quantile). Anything past the last finite bound is reported as that bound.
+        """
+        n = self.count
+        if not n:
+            return 0.0
+        rank = q * n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if seen + c >= rank and c:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i]
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / c
+            seen += c
+        return BUCKETS[-2]
+
+    def to_dict(self) -> Dict[str, Any]:
+        n = self.count
+        return {
+            "count": n,
+            "total_s": round(self.total, 4),
+            "mean_s": round(self.total / n, 4) if n else 0.0,
+            "p50_s": round(self.quantile(0.5), 4),
+            "p90_s": round(self.quantile(0.9), 4),
+            "p99_s": round(self.quantile(0.99), 4),
+            "buckets": {_le(b): c for b, c in zip(BUCKETS, self.counts) if c},
+        }
+
+
+class Registry:
+    """
+    This class holds every counter and stage histogram of the process. Safe to record into from several threads.
+    summary(since=snapshot()) only covers what happened after the snapshot, which is how the daemon writes one
+    summary per batch while prometheus still sees the totals.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[_Key, float] = {}
+        self._stages: Dict[str, Histogram] = {}
+        self._started = time.time()
+
+    def count(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            hist = self._stages.get(stage)
+            if hist is None:
+                hist = self._stages[stage] = Histogram()
+            hist.observe(seconds)
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "time": time.time(),
+                "counters": dict(self._counters),
+                "stages": {stage: hist.copy() for stage, hist in self._stages.items()},
+            }
+
+    def summary(self, since: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        now = self.snapshot()
+        before = since or {"time": self._started, "counters": {}, "stages": {}}
+        counters = {}
+        for key, value in sorted(now["counters"].items()):
+            value -= before["counters"].get(key, 0)
+            if value:
+                counters[_flat_name(key)] = round(value, 4) if isinstance(value, float) else value
+        stages = {}
+        for stage, hist in sorted(now["stages"].items()):
+            diff = hist.minus(before["stages"].get(stage))
+            if diff.count:
+                stages[stage] = diff.to_dict()
+        return {
+            "started": datetime.fromtimestamp(before["time"]).isoformat(timespec="seconds"),
+            "finished": datetime.fromtimestamp(now["time"]).isoformat(timespec="seconds"),
+            "seconds": round(now["time"] - before["time"], 3),
+            "counters": counters,
+            "stages": stages,
+        }
+
+    def write_summary(self, directory: str, run: str, since: Optional[Dict[str, Any]] = None, **extra: Any) -> str:
+        """
+        Writes summary(since) to directory/<run>-<timestamp>.json, with anything in extra added on top.
+        Returns the path.
+        """
+        summary = {"run": run, **extra, **self.summary(since=since)}
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(directory, f"{run}-{stamp}.json")
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        return path
+
+    def prometheus_text(self) -> str:
+        """
+        Everything recorded so far, in the prometheus text exposition format.
+        """
+        now = self.snapshot()
+        lines: List[str] = []
+        typed = set()
+        for (name, labels), value in sorted(now["counters"].items()):
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+
+        if now["stages"]:
+            name = f"{PREFIX}stage_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for stage, hist in sorted(now["stages"].items()):
+                cumulative = 0
+                for bound, c in zip(BUCKETS, hist.counts):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{_labels((('stage', stage), ('le', _le(bound))))} {cumulative}")
+                lines.append(f"{name}_sum{_labels((('stage', stage),))} {hist.total}")
+                lines.append(f"{name}_count{_labels((('stage', stage),))} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """
+        Serves prometheus_text() at http://host:port/metrics from a background thread. Local only by default.
+        Returns the server, shutdown() stops it.
+        """
+        # only the daemon serves, no point in the scheduled runs importing this
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # no line on stdout per scrape
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _le(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def _flat_name(key: _Key) -> str:
+    name, labels = key
+    return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+
+
+# the registry of the process, and the functions to record into it
+REGISTRY = Registry()
+
+count = REGISTRY.count
+observe = REGISTRY.observe
+timed = REGISTRY.timed
+snapshot = REGISTRY.snapshot
+summary = REGISTRY.summary
+write_summary = REGISTRY.write_summary
+prometheus_text = REGISTRY.prometheus_text
+serve = REGISTRY.serve
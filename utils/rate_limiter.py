@@ -0,0 +1,267 @@
+import re
+import time
+import random
+import asyncio
+import threading
+
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from utils import metrics
+from utils.token_bucket import TokenBucket
+
+
+# This module holds the adaptive rate limiter that every gemini and gmail call goes through. It sits on top of
+# a token bucket and moves its rate AIMD style: a little faster after every success, half as fast after the
+# server says to slow down. Retry delays from the server are honored to the millisecond instead of being guessed,
+# 5xx errors get a jittered exponential backoff, and the time spent waiting is recorded.
+
+_RETRY_IN = re.compile(r"retry in ([\d\.]+)\s*s", re.IGNORECASE)
+_RETRY_DELAY = re.compile(r"^([\d\.]+)s$")
+
+
+class RateLimiter:
+    """
+    This class runs calls under a quota. call() and call_async() acquire from the bucket, make the call, and
+    retry it when it was rate limited (as long as it takes) or failed on the server's side (up to max_retries).
+    Anything else is raised to the caller. Safe to use from several threads, and from asyncio.
+
+    requests_per_minute is the ceiling: the rate starts there and never goes above it.
+    """
+    def __init__(
+            self,
+            name: str,
+            bucket: TokenBucket,
+            min_requests_per_minute: float = 1.0,
+            increase: float = 1.0,
+            decrease: float = 0.5,
+            max_retries: int = 5,
+            base_backoff: float = 1.0,
+            max_backoff: float = 60.0,
+            default_retry_delay: float = 25.0,
+            api: Optional[str] = None,
+        ):
+        self.name = name
+        self.bucket = bucket
+        self.max_rate = bucket.requests_per_minute
+        self.min_rate = min(min_requests_per_minute, self.max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.default_retry_delay = default_retry_delay
+        # label of this limiter's calls in utils/metrics.py. Limiters of the same api (one per gmail account)
+        # share it, so their calls add up
+        self.api = api or name.lower()
+
+        self._lock = threading.Lock()
+        self._metrics = {
+            "calls": 0,
+            "throttled": 0,       # rate limited by the server
+            "server_errors": 0,   # 5xx and dropped connections
+            "quota_wait_s": 0.0,  # waiting on the bucket, i.e., on our own pacing and server retry delays
+            "backoff_s": 0.0,     # waiting after server errors
+        }
+
+    @classmethod
+    def from_config(
+            cls,
+            name: str,
+            cfg: Dict[str, Any],
+            table: str = "rate_limit",
+            overrides: Optional[Dict[str, Any]] = None,
+            api: Optional[str] = None
+        ) -> "RateLimiter":
+        """
+        Builds the limiter from a table of config.toml, [rate_limit] for gemini and [gmail_rate_limit] for gmail.
+        Anything in overrides wins over the table, i.e., the quota of one of several gmail accounts.
+        """
+        rl = {**cfg.get(table, {}), **(overrides or {})}
+        return cls(
+            name=name,
+            bucket=TokenBucket(
+                requests_per_minute=rl.get("requests_per_minute", 15),
+                tokens_per_minute=rl.get("tokens_per_minute"),
+            ),
+            min_requests_per_minute=rl.get("min_requests_per_minute", 1.0),
+            api=api,
+        )
+
+    def call(self, fn: Callable[[], Any], tokens: int = 0) -> Any:
+        attempt = 0
+        while True:
+            self._add("quota_wait_s", self.bucket.acquire(tokens=tokens))
+            start = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                metrics.observe(f"{self.api}_call", time.perf_counter() - start)
+                attempt, delay = self._on_error(e, attempt)
+                if delay:
+                    time.sleep(delay)
+                continue
+            metrics.observe(f"{self.api}_call", time.perf_counter() - start)
+            self._on_success()
+            return result
+
+    async def call_async(self, fn: Callable[[], Awaitable[Any]], tokens: int = 0) -> Any:
+        attempt = 0
+        while True:
+            await self.acquire_async(tokens=tokens)
+            start = time.perf_counter()
+            try:
+                result = await fn()
+            except Exception as e:
+                metrics.observe(f"{self.api}_call", time.perf_counter() - start)
+                attempt, delay = self._on_error(e, attempt)
+                if delay:
+                    await asyncio.sleep(delay)
+                continue
+            metrics.observe(f"{self.api}_call", time.perf_counter() - start)
+            self._on_success()
+            return result
+
+    async def acquire_async(self, tokens: int = 0):
+        start = time.monotonic()
+        while True:
+            wait = self.bucket.try_acquire(tokens=tokens)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._add("quota_wait_s", time.monotonic() - start)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._metrics)
+        out["requests_per_minute"] = round(self.bucket.requests_per_minute, 2)
+        return out
+
+    def summary(self) -> str:
+        m = self.metrics()
+        return (
+            f"{self.name}: {m['calls']} calls, {m['throttled']} throttled, {m['server_errors']} server errors, "
+            f"{m['quota_wait_s'] + m['backoff_s']:.1f}s waiting ({m['backoff_s']:.1f}s of it backing off)"
+        )
+
+
+# Helpers
+
+    def _on_success(self):
+        metrics.count("api_calls_total", api=self.api)
+        with self._lock:
+            self._metrics["calls"] += 1
+            rate = self.bucket.requests_per_minute
+            if rate < self.max_rate:
+                # +increase per minute's worth of successful requests
+                self.bucket.set_rate(min(self.max_rate, rate + self.increase / max(rate, 1.0)))
+
+    def _on_error(self, e: Exception, attempt: int):
+        """
+        Decides what to do about a failed call. Returns (attempts so far, seconds to sleep before the retry),
+        or raises if the call shouldn't be retried.
+        """
+        status = error_status(e)
+        if status == 429 or is_rate_limit(e):
+            delay = retry_after(e)
+            metrics.count("api_calls_total", api=self.api)
+            metrics.count("api_retries_total", api=self.api, reason="rate_limit")
+            with self._lock:
+                self._metrics["calls"] += 1
+                self._metrics["throttled"] += 1
+                self.bucket.set_rate(max(self.min_rate, self.bucket.requests_per_minute * self.decrease))
+            delay = delay if delay is not None else self.default_retry_delay
+            print(f"{self.name} rate limit hit. Retrying in {delay:.1f}s")
+            # the bucket holds everyone back, not just this caller, and the wait is counted when acquiring
+            self.bucket.pause(delay)
+            return attempt, 0.0
+
+        if (status is not None and status >= 500) or isinstance(e, (ConnectionError, TimeoutError)):
+            if attempt >= self.max_retries:
+                metrics.count("api_calls_total", api=self.api)
+                metrics.count("api_failures_total", api=self.api)
+                raise e
+            # full jitter, so that the threads that failed together don't all come back together
+            delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+            metrics.count("api_calls_total", api=self.api)
+            metrics.count("api_retries_total", api=self.api, reason="server_error")
+            metrics.count("backoff_seconds_total", delay, api=self.api)
+            with self._lock:
+                self._metrics["calls"] += 1
+                self._metrics["server_errors"] += 1
+                self._metrics["backoff_s"] += delay
+            print(f"{self.name} server error ({status or type(e).__name__}). Retrying in {delay:.1f}s")
+            return attempt + 1, delay
+
+        metrics.count("api_calls_total", api=self.api)
+        metrics.count("api_failures_total", api=self.api)
+        raise e
+
+    def _add(self, key: str, value: float):
+        if key == "quota_wait_s" and value:
+            # our own pacing plus the retry delays the server asked for
+            metrics.count("rate_limit_sleep_seconds_total", value, api=self.api)
+        with self._lock:
+            self._metrics[key] += value
+
+
+def error_status(e: Exception) -> Optional[int]:
+    """
+    The http status of an api error: google.genai errors carry it as .code, googleapiclient's HttpError
+    as .resp.status.
+    """
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        return code
+    resp = getattr(e, "resp", None)
+    status = getattr(resp, "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limit(e: Exception) -> bool:
+    msg = str(e)
+    # gmail answers 403 with one of these reasons when the per-user quota runs out
+    return "RESOURCE_EXHAUSTED" in msg or "rateLimitExceeded" in msg or "userRateLimitExceeded" in msg
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """
+    The delay the server asked for, in seconds: a Retry-After header, a google.rpc.RetryInfo detail
+    (retryDelay: "23.5s"), or failing both, the "retry in Xs" in the message. None if it didn't say.
+    """
+    resp = getattr(e, "resp", None)
+    if resp is not None and hasattr(resp, "get"):
+        header = resp.get("retry-after")
+        if header:
+            try:
+                return float(header)
+            except ValueError:
+                pass
+
+    delay = _find_retry_delay(getattr(e, "details", None))
+    if delay is not None:
+        return delay
+
+    m = _RETRY_IN.search(str(e))
+    return float(m.group(1)) if m else None
+
+
+def _find_retry_delay(obj: Any) -> Optional[float]:
+    if isinstance(obj, dict):
+        value = obj.get("retryDelay")
+        if isinstance(value, str):
+            m = _RETRY_DELAY.match(value.strip())
+            if m:
+                return float(m.group(1))
+        for v in obj.values():
+            found = _find_retry_delay(v)
+            if found is not None:
+                return found
+    elif isinstance(obj, list):
+        for v in obj:
+            found = _find_retry_delay(v)
+            if found is not None:
+                return found
+    return None
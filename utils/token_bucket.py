@@ -0,0 +1,122 @@
+import time
+import threading
+
+from typing import Any, Dict, Optional
+
+
+# This module holds the token bucket that schedules the gemini calls. It replaces the fixed spacing
+# between requests, so that throughput follows whatever quota the api key actually has.
+
+class TokenBucket:
+    """
+    This class caps both requests per minute and tokens per minute. Each bucket holds at most a minute's worth
+    of quota and refills continuously. acquire() blocks until there is room for one request of the estimated 
+    size, and is safe to call from several threads at once.
+    """
+    def __init__(self, requests_per_minute: float, tokens_per_minute: Optional[float] = None):
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+        self.requests_per_minute = float(requests_per_minute)
+        self.tokens_per_minute = float(tokens_per_minute) if tokens_per_minute else None
+
+        self._requests = self.requests_per_minute
+        self._tokens = self.tokens_per_minute or 0.0
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "TokenBucket":
+        """
+        Builds the bucket from the [rate_limit] table of config.toml. Defaults to the free tier quota.
+        """
+        rl = cfg.get("rate_limit", {})
+        return cls(
+            requests_per_minute=rl.get("requests_per_minute", 15),
+            tokens_per_minute=rl.get("tokens_per_minute"),
+        )
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        Blocks until one request using the estimated number of tokens can be made. Returns the seconds waited.
+        """
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                wait = self._try_acquire(tokens)
+                if wait <= 0:
+                    return time.monotonic() - start
+                self._cond.wait(timeout=wait)
+
+    def try_acquire(self, tokens: int = 0) -> float:
+        """
+        Takes one request if it can be made right now and returns 0, otherwise returns the seconds until it
+        could be. Never blocks, so asyncio code can sleep on the answer instead of holding up the event loop.
+        """
+        with self._cond:
+            return self._try_acquire(tokens)
+
+    def set_rate(self, requests_per_minute: float):
+        """
+        Changes the request rate on the fly, i.e., for the adaptive rate limiter.
+        """
+        with self._cond:
+            self._refill(time.monotonic())
+            self.requests_per_minute = float(requests_per_minute)
+            self._requests = min(self._requests, self.requests_per_minute)
+            self._cond.notify_all()
+
+    def reconcile(self, estimated: int, actual: int):
+        """
+        Corrects the token bucket once the real token count of a request is known. The bucket can go 
+        negative, which holds back the next requests until the debt is paid off.
+        """
+        if not self.tokens_per_minute or not actual:
+            return
+        with self._cond:
+            self._tokens -= (actual - estimated)
+            self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        """
+        Holds back every caller for the given number of seconds, i.e., after the server says to slow down.
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            self._paused_until = max(self._paused_until, now + seconds)
+            # the requests already granted in this window clearly didn't all fit: when the pause is over exactly
+            # one request goes out, and the rest follow at the normal pace
+            self._requests = min(self._requests, 1.0)
+            self._cond.notify_all()
+
+    def _try_acquire(self, tokens: int) -> float:
+        if self.tokens_per_minute:
+            # a single request larger than the whole minute's budget would never go through otherwise
+            tokens = min(tokens, self.tokens_per_minute)
+        now = time.monotonic()
+        self._refill(now)
+        wait = self._paused_until - now
+        if wait <= 0:
+            wait = self._time_until_available(tokens)
+        if wait <= 0:
+            self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+        return wait
+
+    def _refill(self, now: float):
+        # nothing builds up while paused, so the end of a pause is not followed by a burst
+        elapsed = now - max(self._last_refill, min(self._paused_until, now))
+        self._last_refill = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60.0)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60.0)
+
+    def _time_until_available(self, tokens: int) -> float:
+        wait = 0.0
+        if self._requests < 1:
+            wait = (1 - self._requests) * 60.0 / self.requests_per_minute
+        if self.tokens_per_minute and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60.0 / self.tokens_per_minute)
+        return wait
@@ -1,78 +1,116 @@
 import os
 import re
 import json
-import time
 import tomllib
+from typing import Dict, Optional
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
 
 
-def write_checkpoint(path: str, ms: int):
+def write_checkpoint(
+        path: str,
+        ms: int,
+        history_id: Optional[str] = None,
+        seen: Optional[Dict[str, int]] = None,
+        account: Optional[str] = None
+    ):
     """
     This function writes a checkpoint file st. only emails after that timestamp are read in. 
+    history_id is the gmail historyId the mailbox was synced up to, and seen is {message_id: internal ms} for
+    the messages on the checkpoint day that were already looked at. When they're not given, the ones already 
+    in the file are kept.
+
+    Every mailbox has its own place: account None is the one from token.json, kept at the top of the file
+    like before there were several, and the others (the [[accounts]] in config.toml) under "accounts".
     """
-    state = {"last_internal_ms": ms}
-    with open(path, "w") as f:
+    state = _read_state(path)
+    section = _section(state, account)
+    section["last_internal_ms"] = ms
+    if history_id is not None:
+        section["history_id"] = str(history_id)
+    if seen is not None:
+        section["seen"] = seen
+    # write next to it and swap it in, so a crash mid-write can't leave a broken file that reads back as 0
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
         json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
     
-def read_checkpoint(path: str):
+def read_checkpoint(path: str, account: Optional[str] = None):
     """
     This funciton reads in the the checkpoint file to hand off the right query string to the EmailGrabber
     """
+    try:
+        return int(_section(_read_state(path), account).get("last_internal_ms", 0))
+    except (TypeError, ValueError):
+        return 0
+
+def read_history_id(path: str, account: Optional[str] = None) -> Optional[str]:
+    """
+    The gmail historyId stored in the checkpoint, or None if there isn't one yet.
+    """
+    history_id = _section(_read_state(path), account).get("history_id")
+    return str(history_id) if history_id else None
+
+def read_seen(path: str, account: Optional[str] = None) -> Dict[str, int]:
+    """
+    The {message_id: internal ms} stored in the checkpoint, see write_checkpoint.
+    """
+    seen = _section(_read_state(path), account).get("seen")
+    return {str(k): int(v) for k, v in seen.items()} if isinstance(seen, dict) else {}
+
+def _read_state(path: str) -> dict:
     try:
         with open(path) as f:
             state = json.load(f)
-            return int(state.get("last_internal_ms", 0))
     except FileNotFoundError:
-        return 0
+        return {}
     except (json.JSONDecodeError, ValueError):
-        return 0
+        return {}
+    return state if isinstance(state, dict) else {}
+
+def _section(state: dict, account: Optional[str]) -> dict:
+    if account is None:
+        return state
+    accounts = state.get("accounts")
+    if not isinstance(accounts, dict):
+        accounts = state["accounts"] = {}
+    section = accounts.get(account)
+    if not isinstance(section, dict):
+        section = accounts[account] = {}
+    return section
 
 def load_config(path="config.toml"):
     with open(path, "rb") as f:
         return tomllib.load(f)
 
-def setup(SCOPES: str):
+def setup(SCOPES: str, token_path: str = "token.json"):
   """
   This funciton is copied from Google quickstart.py file to make sure that the API 
-  works for the user.
+  works for the user. token_path is where the account's token is kept, one per account.
   """
   creds = None
   # The file token.json stores the user's access and refresh tokens, and is
   # created automatically when the authorization flow completes for the first
   # time.
-  if os.path.exists("token.json"):
-    creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+  if os.path.exists(token_path):
+    creds = Credentials.from_authorized_user_file(token_path, SCOPES)
   # If there are no (valid) credentials available, let the user log in.
   if not creds or not creds.valid:
+    # imported here, a run with a valid token doesn't need either
     if creds and creds.expired and creds.refresh_token:
+      from google.auth.transport.requests import Request
       creds.refresh(Request())
     else:
+      from google_auth_oauthlib.flow import InstalledAppFlow
       flow = InstalledAppFlow.from_client_secrets_file(
           "credentials.json", SCOPES
       )
       creds = flow.run_local_server(port=0)
     # Save the credentials for the next run
-    with open("token.json", "w") as token:
+    with open(token_path, "w") as token:
       token.write(creds.to_json())
       
   return creds
-
-####################
-# dealing with free-tier gemini rate limits
-#####################
-
-RATE_LIMIT_RPM = 15
-MIN_SPACING = 60.0 / RATE_LIMIT_RPM
-_last_call_ts = 0.0
-
-def rate_limit():
-    """Ensure spacing between requests to stay under quota."""
-    global _last_call_ts
-    now = time.perf_counter()
-    wait = (_last_call_ts + MIN_SPACING) - now
-    if wait > 0:
-        time.sleep(wait)
-    _last_call_ts = time.perf_counter()
\ No newline at end of file
@@ -1,12 +1,21 @@
 import os
-from model.model_output import ModelOutput
+import zipfile
+from datetime import date, datetime
+from typing import Dict, Optional, Union
+from model.model_output import ModelOutput, RowTable
 from dataclasses import dataclass
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment
+from writers.xlsx_append import XlsxAppender, FastAppendUnavailable, split_ref
 
 # This module holds the excel writer class, which is responsible for writing data to the 
 # accompanying spreadsheet "receipt-buddy"
 
+# hidden defined name in the workbook holding the id of the last local store row that was exported to it
+EXPORT_MARKER = "ReceiptBuddyExported"
+# hidden defined name holding how many rows at the top of the table were written before the local store, and so aren't in it
+BEFORE_STORE_MARKER = "ReceiptBuddyBeforeStore"
+# sheet the rebuild moves those rows to, rather than dropping them
+BEFORE_STORE_SHEET = "Before store"
+
 class ExcelWriter:
     """
     This class takes in the formatted model output, and writes lines to the excel file.
@@ -19,23 +28,116 @@ class ExcelWriter:
         self.worksheet_name = "Itemized"
         self.table_name = "ReceiptTable"
 
-    def write_rows(self, rows: list[ModelOutput]):
+    def write_rows(self, rows: Union[list[ModelOutput], RowTable], exported_through: Optional[int] = None):
         """
         Takes in a list of ModelOutput objects and poplates the workbook table with the data.
+
+        The rows are spliced into the worksheet xml directly, so the cost follows the number of rows written
+        rather than the size of the workbook. openpyxl is only used when that isn't possible, i.e., the very
+        first write into the empty template.
+
+        exported_through is the id of the last local store row in this write. It is saved inside the workbook
+        together with the rows, so the spreadsheet always knows how far it is caught up with the store.
+
+        rows can be Row objects, or a RowTable, which is written straight from its columns.
         """
+        if not len(rows) and exported_through is None:
+            return
         try:
-            workbook = load_workbook(self.write_path)
+            self._append_rows(rows, exported_through=exported_through)
+        except FastAppendUnavailable:
+            self._write_rows_openpyxl(rows, exported_through=exported_through)
+
+    def exported_through(self) -> Optional[int]:
+        """
+        The id of the last local store row that made it into the spreadsheet, or None if it was never exported to.
+        """
+        appender = XlsxAppender(self.write_path, self.worksheet_name, self.table_name)
+        try:
+            value = appender.read_defined_name(EXPORT_MARKER)
         except FileNotFoundError:
             raise FileNotFoundError(f"Workbook 'receipt-buddy.xlsx' not found in the directory. Please check if the workbook name has changed")
+        return int(value) if value is not None else None
+
+    def sync(self, store, chunk_size: int = 50_000):
+        """
+        Appends every row from the local store that isn't in the spreadsheet yet. After a crash this picks up
+        exactly where the last save left off, so rows are never skipped or written twice.
+
+        Receipts rewritten by a re-extraction (see SQLiteWriter.replace_receipts) have new rows next to the old
+        ones in the table, so as long as the store says so the table is rebuilt instead, i.e., after reextract.py
+        was stopped before it got to the rebuild itself.
+        """
+        if store.needs_export():
+            self.rebuild(store, chunk_size=chunk_size)
+            return
+
+        mark = self.exported_through()
+        if mark is None:
+            if self._table_is_empty():
+                mark = 0
+                self.write_rows([], exported_through=mark)
+            else:
+                # a spreadsheet from before the local store is taken to be caught up already. Its rows aren't in the
+                # store (nor in the receipt index), so setup.py rebuilds it from the store once it has backfilled
+                # the store, instead of appending the same receipts again (see holds_rows_from_before_store).
+                # How many there are is kept, so the rebuild can set them aside instead of just dropping them
+                _, start_row, _, end_row = split_ref(
+                    XlsxAppender(self.write_path, self.worksheet_name, self.table_name).read_table_ref()
+                )
+                mark = store.max_id()
+                self._set_defined_names({EXPORT_MARKER: str(mark), BEFORE_STORE_MARKER: str(end_row - start_row)})
+
+        self._append_after(store, mark, chunk_size=chunk_size)
+
+    def holds_rows_from_before_store(self) -> bool:
+        """
+        Whether the table still holds rows written before the local store existed, i.e., until setup.py has
+        backfilled the store and rebuilt the table from it.
+        """
+        appender = XlsxAppender(self.write_path, self.worksheet_name, self.table_name)
+        if appender.read_defined_name(EXPORT_MARKER) is None:
+            # not synced since the upgrade yet
+            return not self._table_is_empty()
+        return int(appender.read_defined_name(BEFORE_STORE_MARKER) or 0) > 0
+
+    def _append_after(self, store, mark: int, chunk_size: int = 50_000):
+        while True:
+            ids, table = store.table_after(mark, limit=chunk_size)
+            if not ids:
+                break
+            mark = ids[-1]
+            self.write_rows(table, exported_through=mark)
+
+    def _append_rows(self, rows: Union[list[ModelOutput], RowTable], exported_through: Optional[int] = None):
+        appender = XlsxAppender(self.write_path, self.worksheet_name, self.table_name)
+        defined_names = {EXPORT_MARKER: str(exported_through)} if exported_through is not None else None
+        if isinstance(rows, RowTable):
+            values = rows.values()
+        else:
+            values = [[r.item, r.quantity, r.price, r.price_per_unit, r.date] for r in rows]
         try:
-            worksheet = workbook[self.worksheet_name]
-        except KeyError:
-            raise ValueError(f"Worksheet '{self.worksheet_name}' not found in the Excel file. Please check if the worksheet name has changed. It should be 'Itemized'")
-        
-        try:
-            table = worksheet.tables[self.table_name]
-        except KeyError:
-            raise ValueError(f"Table '{self.table_name}' not found in Excel file. Please check if the table name has changed. It should be 'ReceiptTable'")
+            appender.append(values, defined_names=defined_names)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Workbook 'receipt-buddy.xlsx' not found in the directory. Please check if the workbook name has changed")
+        except zipfile.BadZipFile:
+            raise FastAppendUnavailable("not a zip file")
+
+        print(f"{len(rows)} rows written")
+        print("Finished writing...")
+        print("Workbook saved!")
+
+    def _write_rows_openpyxl(self, rows: Union[list[ModelOutput], RowTable], exported_through: Optional[int] = None):
+        """
+        Writes the rows by loading the whole workbook with openpyxl. 
+        """
+        from openpyxl.styles import Alignment
+
+        if isinstance(rows, RowTable):
+            # openpyxl goes cell by cell anyway
+            rows = rows.rows()
+
+        workbook, worksheet, table = self._open_table()
 
         tps = self._get_table_parameters(table=table, worksheet=worksheet)
 
@@ -69,18 +171,169 @@ class ExcelWriter:
         end_row = max(tps.end_row, write_row - 1) # account for the increment
 
         table.ref = f"{tps.start_col}{tps.start_row}:{tps.end_col}{end_row}"
+        if exported_through is not None:
+            self._set_export_marker(workbook, exported_through)
 
         print("Finished writing...")
 
-        workbook.save(self.write_path)
+        self._save(workbook)
 
         print("Workbook saved!")
 
 
 
 
+    def rebuild(self, store, chunk_size: int = 50_000):
+        """
+        Empties the table and writes all of the rows from the local store into it again, i.e., to regenerate 
+        the spreadsheet. Anything else in the workbook is left as it is.
+
+        Rows from before the local store (see holds_rows_from_before_store) are moved to the "Before store" sheet
+        first, as some of them may never make it into the store (deleted emails, senders no longer in the config,
+        rows edited by hand).
+        """
+        workbook, worksheet, table = self._open_table()
+        tps = self._get_table_parameters(table=table, worksheet=worksheet)
+
+        if BEFORE_STORE_MARKER in workbook.defined_names:
+            count = int(workbook.defined_names[BEFORE_STORE_MARKER].attr_text or 0)
+            self._keep_rows_before_store(store, workbook, worksheet, tps, count)
+
+        for r in range(tps.first_data_row, tps.end_row + 1):
+            for c in range(2, 7):
+                worksheet.cell(row=r, column=c).value = None
+        table.ref = f"{tps.start_col}{tps.start_row}:{tps.end_col}{tps.first_data_row}"
+        self._set_export_marker(workbook, 0)
+        # every row in the table comes from the store from here on
+        if BEFORE_STORE_MARKER in workbook.defined_names:
+            del workbook.defined_names[BEFORE_STORE_MARKER]
+        self._save(workbook)
+        print("Table cleared")
+
+        self._append_after(store, 0, chunk_size=chunk_size)
+        # the table holds the store's rows as they are now, rewritten receipts included
+        store.mark_exported()
+
+    def write_summaries(self, rollups):
+        """
+        Writes the monthly and per item rollups of the local store (see writers/rollups.py) to their own sheets,
+        replacing what was there. Both are one line per month or item, so this doesn't grow with the receipts.
+        """
+        from openpyxl import load_workbook
+
+        try:
+            workbook = load_workbook(self.write_path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Workbook 'receipt-buddy.xlsx' not found in the directory. Please check if the workbook name has changed")
+
+        sheets = {
+            "Monthly": (["Month", "Rows", "Quantity", "Spend"], [
+                [r["month"], r["rows"], r["quantity"], r["spend"]] for r in rollups.monthly()
+            ]),
+            "Items": (["Item", "Rows", "Quantity", "Spend", "Min unit price", "Max unit price", "Mean unit price", "First bought", "Last bought"], [
+                [r["item"], r["rows"], r["quantity"], r["spend"], r["unit_min"], r["unit_max"], r["unit_mean"], r["first_date"], r["last_date"]]
+                for r in rollups.items()
+            ]),
+        }
+        for name, (header, lines) in sheets.items():
+            if name in workbook.sheetnames:
+                del workbook[name]
+            worksheet = workbook.create_sheet(name)
+            worksheet.append(header)
+            for line in lines:
+                worksheet.append(line)
+            print(f"{len(lines)} lines written to {name}")
+
+        self._save(workbook)
+
+
 # Helpers
 
+    def _open_table(self):
+        # openpyxl takes a good part of a second to import, and most runs never get here
+        from openpyxl import load_workbook
+
+        try:
+            workbook = load_workbook(self.write_path)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Workbook 'receipt-buddy.xlsx' not found in the directory. Please check if the workbook name has changed")
+        try:
+            worksheet = workbook[self.worksheet_name]
+        except KeyError:
+            raise ValueError(f"Worksheet '{self.worksheet_name}' not found in the Excel file. Please check if the worksheet name has changed. It should be 'Itemized'")
+        
+        try:
+            table = worksheet.tables[self.table_name]
+        except KeyError:
+            raise ValueError(f"Table '{self.table_name}' not found in Excel file. Please check if the table name has changed. It should be 'ReceiptTable'")
+
+        return workbook, worksheet, table
+
+    def _keep_rows_before_store(self, store, workbook, worksheet, tps, count: int):
+        rows = [
+            [worksheet.cell(row=r, column=c).value for c in range(2, 7)]
+            for r in range(tps.first_data_row, min(tps.first_data_row + count, tps.end_row + 1))
+        ]
+        if not rows:
+            return
+        if BEFORE_STORE_SHEET in workbook.sheetnames:
+            backup = workbook[BEFORE_STORE_SHEET]
+        else:
+            backup = workbook.create_sheet(BEFORE_STORE_SHEET)
+            backup.append([worksheet.cell(row=tps.start_row, column=c).value for c in range(2, 7)])
+        for row in rows:
+            backup.append(row)
+            backup.cell(row=backup.max_row, column=5).number_format = "DD/MM/YYYY"
+        print(f"{len(rows)} rows from before the local store kept in the '{BEFORE_STORE_SHEET}' sheet")
+
+        # the store should have at least as many rows over the same days, otherwise some receipts didn't come back
+        dates = [r[4].date() if isinstance(r[4], datetime) else r[4] for r in rows if isinstance(r[4], date)]
+        in_store = len(store.query_rows(end=max(dates) if dates else None))
+        if in_store < len(rows):
+            print(
+                f"Warning: the local store has {in_store} rows up to the last of them, {len(rows) - in_store} fewer. "
+                f"Compare the '{BEFORE_STORE_SHEET}' sheet with the table before deleting it"
+            )
+
+    def _save(self, workbook):
+        # save next to the workbook and swap it in, so a crash mid-save never leaves half a file
+        tmp_path = self.write_path + ".tmp"
+        workbook.save(tmp_path)
+        os.replace(tmp_path, self.write_path)
+
+    def _set_defined_names(self, names: Dict[str, str]):
+        # all in one save, so a crash never leaves one of them without the other
+        try:
+            XlsxAppender(self.write_path, self.worksheet_name, self.table_name).append([], defined_names=names)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Workbook 'receipt-buddy.xlsx' not found in the directory. Please check if the workbook name has changed")
+        except (zipfile.BadZipFile, FastAppendUnavailable):
+            from openpyxl.workbook.defined_name import DefinedName
+
+            workbook, _, _ = self._open_table()
+            for name, value in names.items():
+                if name in workbook.defined_names:
+                    del workbook.defined_names[name]
+                workbook.defined_names[name] = DefinedName(name, attr_text=value, hidden=True)
+            self._save(workbook)
+
+    @staticmethod
+    def _set_export_marker(workbook, exported_through: int):
+        from openpyxl.workbook.defined_name import DefinedName
+
+        if EXPORT_MARKER in workbook.defined_names:
+            del workbook.defined_names[EXPORT_MARKER]
+        workbook.defined_names[EXPORT_MARKER] = DefinedName(EXPORT_MARKER, attr_text=str(exported_through), hidden=True)
+
+    def _table_is_empty(self) -> bool:
+        start_col, start_row, end_col, end_row = split_ref(
+            XlsxAppender(self.write_path, self.worksheet_name, self.table_name).read_table_ref()
+        )
+        if end_row > start_row + 1:
+            return False
+        workbook, worksheet, _ = self._open_table()
+        return not self._row_has_values(r=start_row + 1, worksheet=worksheet)
+
     def _get_table_parameters(self, table, worksheet):
         start, end = table.ref.split(":")
         
@@ -0,0 +1,217 @@
+import sqlite3
+
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# This module holds the spending rollups: totals per day, per month and per item (with the min/max/mean unit price
+# of each item), kept next to the rows in receipt-buddy.db. They are updated from the rows each write adds, in the
+# same transaction, so reading monthly spend or an item's price history costs one row per period or item instead
+# of a scan over every receipt.
+
+# the rollups are sums over the rows, grouped by these keys. Dates are stored as iso strings, so a day is
+# the first 10 characters and a month the first 7.
+_PERIODS = {
+    "rollup_daily": ("day", "substr(date, 1, 10)"),
+    "rollup_monthly": ("month", "substr(date, 1, 7)"),
+}
+
+# unit prices only mean something for rows with a quantity, the others have a price per unit of 0
+_ITEMS_SELECT = (
+    "SELECT item, COUNT(*), SUM(quantity), SUM(price), "
+    "SUM(quantity > 0), "
+    "MIN(CASE WHEN quantity > 0 THEN price_per_unit END), "
+    "MAX(CASE WHEN quantity > 0 THEN price_per_unit END), "
+    "TOTAL(CASE WHEN quantity > 0 THEN price_per_unit END), "
+    "MIN(date), MAX(date) "
+    "FROM rows WHERE {where} GROUP BY item"
+)
+
+
+class Rollups:
+    """
+    This class maintains the rollup tables. It shares the connection of the SQLiteWriter, and like the
+    progress journal only commits when asked to, so the writer folds catch_up() into the transaction
+    that writes the rows.
+
+    The rollups remember the id of the last row they include, so catch_up() only ever reads the rows written
+    since, and a store that had rows before the rollups existed is caught up the first time it is opened.
+    """
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        with self.conn:
+            for table, (key, _) in _PERIODS.items():
+                self.conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} ("
+                    f"{key} TEXT PRIMARY KEY, "
+                    "rows INTEGER NOT NULL, "
+                    "quantity INTEGER NOT NULL, "
+                    "spend REAL NOT NULL)"
+                )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollup_items ("
+                "item TEXT PRIMARY KEY, "
+                "rows INTEGER NOT NULL, "
+                "quantity INTEGER NOT NULL, "
+                "spend REAL NOT NULL, "
+                "priced_rows INTEGER NOT NULL, "
+                "unit_min REAL, "
+                "unit_max REAL, "
+                "unit_sum REAL NOT NULL, "
+                "first_date TEXT NOT NULL, "
+                "last_date TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rollup_state ("
+                "id INTEGER PRIMARY KEY CHECK (id = 0), "
+                "rolled_through INTEGER NOT NULL)"
+            )
+            self.conn.execute("INSERT OR IGNORE INTO rollup_state (id, rolled_through) VALUES (0, 0)")
+        self.catch_up()
+
+    def catch_up(self, commit: bool = True) -> int:
+        """
+        Adds the rows written since the last call to the rollups. With commit=False the change becomes part of
+        whatever transaction the caller has open. Returns the number of rows added.
+        """
+        through = self.rolled_through()
+        upto, added = self.conn.execute("SELECT COALESCE(MAX(id), 0), COUNT(*) FROM rows WHERE id > ?", (through,)).fetchone()
+        if not added:
+            return 0
+
+        for table, (key, expression) in _PERIODS.items():
+            self.conn.execute(
+                f"INSERT INTO {table} ({key}, rows, quantity, spend) "
+                f"SELECT {expression}, COUNT(*), SUM(quantity), SUM(price) FROM rows WHERE id > ? AND id <= ? GROUP BY 1 "
+                f"ON CONFLICT({key}) DO UPDATE SET "
+                f"rows = {table}.rows + excluded.rows, "
+                f"quantity = {table}.quantity + excluded.quantity, "
+                f"spend = {table}.spend + excluded.spend",
+                (through, upto),
+            )
+        self.conn.execute(
+            "INSERT INTO rollup_items "
+            "(item, rows, quantity, spend, priced_rows, unit_min, unit_max, unit_sum, first_date, last_date) "
+            f"{_ITEMS_SELECT.format(where='id > ? AND id <= ?')} "
+            "ON CONFLICT(item) DO UPDATE SET "
+            "rows = rollup_items.rows + excluded.rows, "
+            "quantity = rollup_items.quantity + excluded.quantity, "
+            "spend = rollup_items.spend + excluded.spend, "
+            "priced_rows = rollup_items.priced_rows + excluded.priced_rows, "
+            # sqlite's two argument min/max are NULL if either side is, i.e., for an item never bought by the unit
+            "unit_min = COALESCE(MIN(rollup_items.unit_min, excluded.unit_min), rollup_items.unit_min, excluded.unit_min), "
+            "unit_max = COALESCE(MAX(rollup_items.unit_max, excluded.unit_max), rollup_items.unit_max, excluded.unit_max), "
+            "unit_sum = rollup_items.unit_sum + excluded.unit_sum, "
+            "first_date = MIN(rollup_items.first_date, excluded.first_date), "
+            "last_date = MAX(rollup_items.last_date, excluded.last_date)",
+            (through, upto),
+        )
+        self.conn.execute("UPDATE rollup_state SET rolled_through = ? WHERE id = 0", (upto,))
+        if commit:
+            self.conn.commit()
+        return added
+
+    def rebuild(self, commit: bool = True) -> int:
+        """
+        Recomputes every rollup from the rows, i.e., after rows were changed or removed outside of the writer.
+        """
+        for table in list(_PERIODS) + ["rollup_items"]:
+            self.conn.execute(f"DELETE FROM {table}")
+        self.conn.execute("UPDATE rollup_state SET rolled_through = 0 WHERE id = 0")
+        return self.catch_up(commit=commit)
+
+    def recompute(self, rows: List[Tuple[str, str]], commit: bool = True):
+        """
+        Recomputes the days, months and items of rows ((item, iso date) pairs) from what the rows table holds now,
+        i.e., after those rows were deleted or replaced. Only the rows up to rolled_through are counted, so rows
+        added since are still left for catch_up(). With commit=False it joins the caller's transaction.
+        """
+        through = self.rolled_through()
+        for table, (key, expression) in _PERIODS.items():
+            length = 10 if key == "day" else 7
+            for period in sorted({d[:length] for _, d in rows}):
+                self.conn.execute(f"DELETE FROM {table} WHERE {key} = ?", (period,))
+                # every iso date of the period sorts between the period itself and the period followed by "~"
+                self.conn.execute(
+                    f"INSERT INTO {table} ({key}, rows, quantity, spend) "
+                    f"SELECT {expression}, COUNT(*), SUM(quantity), SUM(price) FROM rows "
+                    "WHERE date >= ? AND date < ? AND id <= ? GROUP BY 1",
+                    (period, period + "~", through),
+                )
+        for item in sorted({i for i, _ in rows}):
+            self.conn.execute("DELETE FROM rollup_items WHERE item = ?", (item,))
+            self.conn.execute(
+                "INSERT INTO rollup_items "
+                "(item, rows, quantity, spend, priced_rows, unit_min, unit_max, unit_sum, first_date, last_date) "
+                + _ITEMS_SELECT.format(where="item = ? AND id <= ?"),
+                (item, through),
+            )
+        if commit:
+            self.conn.commit()
+
+    def rolled_through(self) -> int:
+        return self.conn.execute("SELECT rolled_through FROM rollup_state WHERE id = 0").fetchone()[0]
+
+    def daily(self, start: Optional[date] = None, end: Optional[date] = None) -> List[Dict[str, Any]]:
+        """
+        {day, rows, quantity, spend} per day with receipts between start and end (both inclusive), oldest first.
+        """
+        return self._periods("rollup_daily", start=start, end=end, length=10)
+
+    def monthly(self, start: Optional[date] = None, end: Optional[date] = None) -> List[Dict[str, Any]]:
+        """
+        {month, rows, quantity, spend} per month with receipts between the months of start and end, oldest first.
+        """
+        return self._periods("rollup_monthly", start=start, end=end, length=7)
+
+    def items(self, item: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Per item: rows, quantity, spend, the min/max/mean unit price (None if it was never bought by the unit),
+        and the first and last day it was bought. Biggest spend first.
+        """
+        sql = (
+            "SELECT item, rows, quantity, spend, priced_rows, unit_min, unit_max, unit_sum, first_date, last_date "
+            "FROM rollup_items"
+        )
+        params: List[Any] = []
+        if item is not None:
+            sql += " WHERE item = ?"
+            params.append(item)
+        sql += " ORDER BY spend DESC, item"
+        return [
+            {
+                "item": name,
+                "rows": rows,
+                "quantity": quantity,
+                "spend": spend,
+                "unit_min": unit_min,
+                "unit_max": unit_max,
+                "unit_mean": unit_sum / priced_rows if priced_rows else None,
+                "first_date": first_date[:10],
+                "last_date": last_date[:10],
+            }
+            for name, rows, quantity, spend, priced_rows, unit_min, unit_max, unit_sum, first_date, last_date
+            in self.conn.execute(sql, params)
+        ]
+
+
+# Helpers
+
+    def _periods(self, table: str, start: Optional[date], end: Optional[date], length: int) -> List[Dict[str, Any]]:
+        key = _PERIODS[table][0]
+        clauses, params = [], []
+        if start is not None:
+            clauses.append(f"{key} >= ?")
+            params.append(_to_iso(start)[:length])
+        if end is not None:
+            clauses.append(f"{key} <= ?")
+            params.append(_to_iso(end)[:length])
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        cursor = self.conn.execute(f"SELECT {key}, rows, quantity, spend FROM {table}{where} ORDER BY {key}", params)
+        return [{key: period, "rows": rows, "quantity": quantity, "spend": spend} for period, rows, quantity, spend in cursor]
+
+
+def _to_iso(value) -> str:
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    return value.isoformat()
@@ -0,0 +1,343 @@
+import os
+import time
+import sqlite3
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from datetime import date, datetime
+
+from model.model_output import Row, RowTable
+from utils.journal import ProgressJournal, WRITTEN
+from writers.rollups import Rollups
+
+def make_receipt_id(message_id: str, pdf_sha256: str) -> str:
+    """
+    The stable identity of a receipt: the gmail message it came in, and the contents of the pdf.
+    """
+    return f"{message_id}:{pdf_sha256}"
+
+
+# This module holds the sqlite writer, which keeps every extracted row in a local, indexed database
+# "receipt-buddy.db". This is the system of record; the spreadsheet is an export of it.
+
+class SQLiteWriter:
+    """
+    This class stores Row records in sqlite, with indexes on date and item, so that date range and item lookups
+    don't have to scan years of receipts.
+
+    Unlike the ExcelWriter, this class DOES create the file if it isn't there yet.
+    """
+    def __init__(self, app_directory):
+
+        self.db_path = os.path.join(app_directory, "receipt-buddy.db")
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # a committed batch has to survive a crash or power loss, not just the process dying
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self._create_schema()
+        self.journal = ProgressJournal(self.conn)
+        self.rollups = Rollups(self.conn)
+
+    def write_rows(self, rows: List[Row]):
+        """
+        Takes in a list of Row objects and stores them, all in one transaction, together with their
+        day, month and item rollups.
+        """
+        with self.conn:
+            self._insert(rows, message_id=None)
+            self.rollups.catch_up(commit=False)
+
+    def write_receipts(self, receipts: List[Tuple[str, str, List[Row]]]) -> Tuple[int, int]:
+        """
+        Takes in a list of (message id, pdf sha256, rows) and stores the rows, marking each message as written in
+        the progress journal. It all happens in one transaction, so either a receipt's rows and its journal entry
+        are both there after a crash, or neither are. The rollups are updated in the same transaction.
+
+        Each receipt is checked against the receipts index first, and receipts that were already stored
+        are skipped, so re-processing a message never duplicates its rows. 
+        Returns (rows written, receipts skipped)
+        """
+        written, skipped = 0, 0
+        with self.conn:
+            for message_id, pdf_sha256, rows in receipts:
+                if self._is_known(message_id, pdf_sha256):
+                    skipped += 1
+                    continue
+                receipt_id = make_receipt_id(message_id, pdf_sha256)
+                self.conn.execute(
+                    "INSERT INTO receipts (receipt_id, message_id, pdf_sha256) VALUES (?, ?, ?)",
+                    (receipt_id, message_id, pdf_sha256),
+                )
+                self._insert(rows, message_id=message_id, receipt_id=receipt_id)
+                written += len(rows)
+            self.journal.mark([message_id for message_id, _, _ in receipts], WRITTEN, commit=False)
+            self.rollups.catch_up(commit=False)
+        return written, skipped
+
+    def has_receipt(self, message_id: str, pdf_sha256: str) -> bool:
+        return self._is_known(message_id, pdf_sha256)
+
+    def receipt_ids(self, receipts: List[Tuple[str, str]]) -> Dict[str, str]:
+        """
+        Takes in (message id, pdf sha256) pairs and returns {message id: receipt id} for the receipts that are
+        stored, the receipt id being the message id alone for receipts indexed before the pdf hash.
+        """
+        out: Dict[str, str] = {}
+        for i in range(0, len(receipts), 400):
+            chunk = receipts[i:i + 400]
+            candidates = {make_receipt_id(m, sha): m for m, sha in chunk}
+            candidates.update({m: m for m, _ in chunk})
+            keys = list(candidates)
+            for (receipt_id,) in self.conn.execute(
+                f"SELECT receipt_id FROM receipts WHERE receipt_id IN ({','.join('?' * len(keys))})", keys
+            ):
+                out[candidates[receipt_id]] = receipt_id
+        return out
+
+    def receipt_rows(self, receipt_ids: List[str]) -> Dict[str, List[Row]]:
+        """
+        {receipt id: its rows, in the order they were written} for the given receipts.
+        """
+        out: Dict[str, List[Row]] = {receipt_id: [] for receipt_id in receipt_ids}
+        for i in range(0, len(receipt_ids), 400):
+            chunk = receipt_ids[i:i + 400]
+            marks = ",".join("?" * len(chunk))
+            cursor = self.conn.execute(
+                "SELECT COALESCE(receipt_id, message_id), item, quantity, price, price_per_unit, date FROM rows "
+                f"WHERE receipt_id IN ({marks}) OR (receipt_id IS NULL AND message_id IN ({marks})) ORDER BY id",
+                chunk + chunk,
+            )
+            for rec in cursor:
+                if rec[0] in out:
+                    out[rec[0]].append(self._to_row(rec[1:]))
+        return out
+
+    def replace_receipts(self, receipts: List[Tuple[str, str, List[Row]]], extracted_with: str) -> Tuple[int, int]:
+        """
+        Takes in a list of (receipt id, message id, rows) and swaps each receipt's stored rows for these, i.e., after
+        extracting it again with another model. It all happens in one transaction, together with fixing up the
+        rollups the old rows were in and noting extracted_with (see mark_extracted) for each receipt.
+        The new rows get new ids, so the spreadsheet has to be rebuilt from the store afterwards (see needs_export).
+        Returns (rows removed, rows written)
+        """
+        removed, written = 0, 0
+        with self.conn:
+            old: List[Tuple[str, str]] = []
+            for receipt_id, message_id, _ in receipts:
+                # receipts indexed by message id alone have rows without a receipt id
+                where, params = (
+                    ("receipt_id = ? OR (receipt_id IS NULL AND message_id = ?)", (receipt_id, message_id))
+                    if receipt_id == message_id else ("receipt_id = ?", (receipt_id,))
+                )
+                old.extend(self.conn.execute(f"SELECT item, date FROM rows WHERE {where}", params).fetchall())
+                removed += self.conn.execute(f"DELETE FROM rows WHERE {where}", params).rowcount
+            self.rollups.recompute(old, commit=False)
+            for receipt_id, message_id, rows in receipts:
+                self._insert(rows, message_id=message_id, receipt_id=receipt_id)
+                written += len(rows)
+            self.rollups.catch_up(commit=False)
+            self.mark_extracted([receipt_id for receipt_id, _, _ in receipts], extracted_with, "changed", commit=False)
+        return removed, written
+
+    def mark_extracted(self, receipt_ids: Iterable[str], extracted_with: str, outcome: str, commit: bool = True):
+        """
+        Notes which model configuration (see Gemini.fingerprint) the receipts were last extracted with, and whether
+        that changed their rows ("changed") or not ("unchanged"). Re-extraction (pipeline/reextraction.py) skips
+        receipts already extracted with the configuration it runs.
+        """
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO extracted_with (receipt_id, config, outcome, exported, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(receipt_id) DO UPDATE SET "
+            "config = excluded.config, outcome = excluded.outcome, "
+            # a changed receipt stays unexported until the spreadsheet is rebuilt, even if it is extracted again
+            "exported = MIN(extracted_with.exported, excluded.exported), updated_at = excluded.updated_at",
+            [(receipt_id, extracted_with, outcome, 0 if outcome == "changed" else 1, now) for receipt_id in receipt_ids],
+        )
+        if commit:
+            self.conn.commit()
+
+    def extracted_with(self, receipt_ids: List[str]) -> Dict[str, str]:
+        """
+        {receipt id: the model configuration it was last extracted with}, for the receipts that have been re-extracted.
+        """
+        out: Dict[str, str] = {}
+        for i in range(0, len(receipt_ids), 400):
+            chunk = receipt_ids[i:i + 400]
+            out.update(self.conn.execute(
+                f"SELECT receipt_id, config FROM extracted_with WHERE receipt_id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall())
+        return out
+
+    def needs_export(self) -> bool:
+        """
+        Whether receipts were rewritten since the spreadsheet was last rebuilt, see replace_receipts.
+        """
+        return self.conn.execute("SELECT 1 FROM extracted_with WHERE exported = 0 LIMIT 1").fetchone() is not None
+
+    def mark_exported(self):
+        with self.conn:
+            self.conn.execute("UPDATE extracted_with SET exported = 1 WHERE exported = 0")
+
+    def rows_after(self, row_id: int, limit: int = -1) -> List[Tuple[int, Row]]:
+        """
+        Returns (id, row) for the rows stored after row_id (at most limit of them), i.e., the rows the 
+        spreadsheet doesn't have yet.
+        """
+        cursor = self.conn.execute(
+            "SELECT id, item, quantity, price, price_per_unit, date FROM rows WHERE id > ? ORDER BY id LIMIT ?", 
+            (row_id, limit)
+        )
+        return [(rec[0], self._to_row(rec[1:])) for rec in cursor]
+
+    def table_after(self, row_id: int, limit: int = -1) -> Tuple[List[int], RowTable]:
+        """
+        Same as rows_after, but as (ids, RowTable), without making a Row per stored row.
+        """
+        records = self.conn.execute(
+            "SELECT id, item, quantity, price, price_per_unit, date FROM rows WHERE id > ? ORDER BY id LIMIT ?", 
+            (row_id, limit)
+        ).fetchall()
+        return [rec[0] for rec in records], RowTable.from_records([rec[1:] for rec in records])
+
+    def max_id(self) -> int:
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM rows").fetchone()[0]
+
+    def query_rows(
+            self,
+            start: Optional[date] = None,
+            end: Optional[date] = None,
+            item: Optional[str] = None
+        ) -> List[Row]:
+        """
+        Returns the rows between start and end (both inclusive, by day), optionally for a single item, oldest first.
+        """
+        sql, params = self._select(start=start, end=end, item=item)
+        return [self._to_row(rec) for rec in self.conn.execute(sql, params)]
+
+    def query_frame(self, start: Optional[date] = None, end: Optional[date] = None, item: Optional[str] = None):
+        """
+        Same as query_rows, but as a pandas DataFrame for analysis.
+        """
+        import pandas as pd
+
+        sql, params = self._select(start=start, end=end, item=item)
+        return pd.read_sql_query(sql, self.conn, params=params, parse_dates=["date"])
+
+    def iter_rows(self) -> Iterator[Row]:
+        """
+        Yields every stored row in the order it was written, i.e., to regenerate the spreadsheet.
+        """
+        cursor = self.conn.execute("SELECT item, quantity, price, price_per_unit, date FROM rows ORDER BY id")
+        for rec in cursor:
+            yield self._to_row(rec)
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    def receipt_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM receipts").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+# Helpers
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "item TEXT NOT NULL, "
+                "quantity INTEGER NOT NULL, "
+                "price REAL NOT NULL, "
+                "price_per_unit REAL NOT NULL, "
+                "date TEXT NOT NULL)"
+            )
+            columns = {rec[1] for rec in self.conn.execute("PRAGMA table_info(rows)")}
+            if "message_id" not in columns:
+                # stores created before the progress journal existed
+                self.conn.execute("ALTER TABLE rows ADD COLUMN message_id TEXT")
+            if "receipt_id" not in columns:
+                # stores created before the receipts index existed
+                self.conn.execute("ALTER TABLE rows ADD COLUMN receipt_id TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS rows_date ON rows (date)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS rows_item_date ON rows (item, date)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS rows_message_id ON rows (message_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS rows_receipt_id ON rows (receipt_id)")
+
+            # the dedup index: one entry per receipt ever stored
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS receipts ("
+                "receipt_id TEXT PRIMARY KEY, "
+                "message_id TEXT NOT NULL, "
+                "pdf_sha256 TEXT)"
+            )
+            # rows written with a message id but before the index existed are indexed by message id alone
+            self.conn.execute(
+                "INSERT OR IGNORE INTO receipts (receipt_id, message_id, pdf_sha256) "
+                "SELECT DISTINCT message_id, message_id, NULL FROM rows "
+                "WHERE message_id IS NOT NULL AND receipt_id IS NULL"
+            )
+
+            # what each receipt was last extracted with, see mark_extracted
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS extracted_with ("
+                "receipt_id TEXT PRIMARY KEY, "
+                "config TEXT NOT NULL, "
+                "outcome TEXT NOT NULL, "
+                "exported INTEGER NOT NULL, "
+                "updated_at REAL NOT NULL)"
+            )
+
+    def _is_known(self, message_id: str, pdf_sha256: str) -> bool:
+        # two primary key lookups: the full identity, and the message id alone for receipts indexed before the pdf hash
+        row = self.conn.execute(
+            "SELECT 1 FROM receipts WHERE receipt_id IN (?, ?) LIMIT 1",
+            (make_receipt_id(message_id, pdf_sha256), message_id),
+        ).fetchone()
+        return row is not None
+
+    def _insert(self, rows: List[Row], message_id: Optional[str], receipt_id: Optional[str] = None):
+        self.conn.executemany(
+            "INSERT INTO rows (item, quantity, price, price_per_unit, date, message_id, receipt_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(r.item, r.quantity, r.price, r.price_per_unit, self._to_iso(r.date), message_id, receipt_id) for r in rows],
+        )
+
+    def _select(self, start: Optional[date], end: Optional[date], item: Optional[str]):
+        clauses, params = [], []
+        if item is not None:
+            clauses.append("item = ?")
+            params.append(item)
+        if start is not None:
+            clauses.append("date >= ?")
+            params.append(self._to_iso(start))
+        if end is not None:
+            # dates are stored as iso strings, so everything on the end day sorts before the next day
+            clauses.append("date < ?")
+            params.append(self._to_iso(self._day_after(end)))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT item, quantity, price, price_per_unit, date FROM rows{where} ORDER BY date, id"
+        return sql, params
+
+    @staticmethod
+    def _to_iso(value) -> str:
+        if not isinstance(value, datetime):
+            value = datetime(value.year, value.month, value.day)
+        return value.replace(tzinfo=None).isoformat()
+
+    @staticmethod
+    def _day_after(value) -> date:
+        day = value.date() if isinstance(value, datetime) else value
+        return date.fromordinal(day.toordinal() + 1)
+
+    @staticmethod
+    def _to_row(rec) -> Row:
+        item, quantity, price, price_per_unit, date_str = rec
+        return Row(
+            item=item,
+            quantity=quantity,
+            price=price,
+            price_per_unit=price_per_unit,
+            date=datetime.fromisoformat(date_str)
+        )
@@ -0,0 +1,462 @@
+import os
+import re
+import shutil
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+
+# This module appends rows to the table in receipt-buddy.xlsx without loading the workbook into openpyxl.
+# The worksheet xml is streamed through once and the new rows are spliced in as raw xml, so nothing is
+# parsed into python objects except the handful of rows that are actually being written.
+
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+CHUNK_SIZE = 1 << 20
+
+_ROW_R = re.compile(rb'\br="(\d+)"')
+_CELL = re.compile(rb'<c\b[^>]*?\br="([A-Z]+)\d+"[^>]*?(?:/>|>.*?</c>)', re.DOTALL)
+_SPANS = re.compile(rb'\sspans="[^"]*"')
+_STYLE = re.compile(rb'\bs="(\d+)"')
+_DIMENSION = re.compile(rb'<dimension ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"\s*/>')
+_EMPTY_DEFINED_NAMES = re.compile(rb'<definedNames\s*/>|<definedNames>\s*</definedNames>')
+
+
+class FastAppendUnavailable(Exception):
+    """
+    Raised when the workbook is laid out in a way the fast path doesn't handle, i.e., the table has no
+    rows to copy the formatting from yet. The caller should fall back to openpyxl.
+    """
+
+
+def split_ref(ref: str) -> Tuple[str, int, str, int]:
+    """
+    Splits a table ref like 'B4:F5' into ('B', 4, 'F', 5)
+    """
+    start, end = ref.split(":")
+    start_col = ''.join(filter(str.isalpha, start))
+    start_row = int(''.join(filter(str.isdigit, start)))
+    end_col = ''.join(filter(str.isalpha, end))
+    end_row = int(''.join(filter(str.isdigit, end)))
+    return start_col, start_row, end_col, end_row
+
+
+def column_index(col: str) -> int:
+    idx = 0
+    for ch in col:
+        idx = idx * 26 + (ord(ch) - ord("A") + 1)
+    return idx
+
+
+def column_letter(idx: int) -> str:
+    out = ""
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        out = chr(ord("A") + rem) + out
+    return out
+
+
+class XlsxAppender:
+    """
+    This class finds the worksheet and table parts for a named sheet and table inside the xlsx package,
+    and appends rows of values to the end of the table.
+    """
+    def __init__(self, path: str, worksheet_name: str, table_name: str):
+        self.path = path
+        self.worksheet_name = worksheet_name
+        self.table_name = table_name
+
+    def append(self, values: List[List[Any]], defined_names: Optional[Dict[str, str]] = None) -> int:
+        """
+        Writes each list of values into the row after the end of the table, starting at the table's first
+        column, and grows the table to cover them. defined_names are set in the workbook in the same save,
+        so they always agree with the rows that are in it. Returns the new last row of the table.
+        """
+        with zipfile.ZipFile(self.path) as zin:
+            sheet_part, table_part, date1904 = self._locate_parts(zin)
+            table_xml = zin.read(table_part)
+            ref = self._table_ref(table_xml)
+            start_col, start_row, end_col, end_row = split_ref(ref)
+
+            first_data_row = start_row + 1
+            if end_row < first_data_row:
+                raise FastAppendUnavailable("table has no data rows")
+            if not values:
+                # nothing to splice, the sheet is copied as it is
+                sheet_part = None
+
+            write_start = end_row + 1
+            write_end = end_row + len(values)
+            new_ref = f"{start_col}{start_row}:{end_col}{write_end}"
+
+            tmp_path = self.path + ".tmp"
+            try:
+                # the fastest deflate level, the worksheet is most of the time spent here and is only ~10% larger for it
+                with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
+                    for info in zin.infolist():
+                        if info.filename == sheet_part:
+                            with zin.open(info) as src, zout.open(info.filename, "w", force_zip64=True) as dst:
+                                splicer = _SheetSplicer(
+                                    values=values,
+                                    template_row=end_row,
+                                    write_start=write_start,
+                                    first_col=column_index(start_col),
+                                    date1904=date1904,
+                                )
+                                for out in splicer.run(src):
+                                    dst.write(out)
+                        elif info.filename == table_part:
+                            zout.writestr(info.filename, self._set_table_ref(table_xml, new_ref))
+                        elif info.filename == "xl/workbook.xml" and defined_names:
+                            zout.writestr(info.filename, self._set_defined_names(zin.read(info), defined_names))
+                        else:
+                            with zin.open(info) as src, zout.open(info.filename, "w", force_zip64=True) as dst:
+                                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        # swap the finished file in at once, so a crash halfway through never leaves a broken workbook
+        os.replace(tmp_path, self.path)
+        return write_end
+
+    def read_defined_name(self, name: str) -> Optional[str]:
+        """
+        Reads the value of a workbook level defined name, or None if it isn't there.
+        """
+        with zipfile.ZipFile(self.path) as zin:
+            workbook = ET.fromstring(zin.read("xl/workbook.xml"))
+        for defined_name in workbook.iter(f"{{{MAIN_NS}}}definedName"):
+            if defined_name.get("name") == name and defined_name.get("localSheetId") is None:
+                return defined_name.text
+        return None
+
+    def read_table_ref(self) -> str:
+        """
+        Reads the table ref without touching the worksheet at all.
+        """
+        with zipfile.ZipFile(self.path) as zin:
+            _, table_part, _ = self._locate_parts(zin)
+            return self._table_ref(zin.read(table_part))
+
+    # Helpers
+
+    def _locate_parts(self, zin: zipfile.ZipFile) -> Tuple[str, str, bool]:
+        """
+        Follows workbook.xml and the relationship parts to find the worksheet and table xml.
+        Returns (sheet part name, table part name, whether the workbook uses the 1904 date system)
+        """
+        workbook = ET.fromstring(zin.read("xl/workbook.xml"))
+        workbook_pr = workbook.find(f"{{{MAIN_NS}}}workbookPr")
+        date1904 = workbook_pr is not None and workbook_pr.get("date1904") in ("1", "true")
+
+        sheet_rid = None
+        for sheet in workbook.iter(f"{{{MAIN_NS}}}sheet"):
+            if sheet.get("name") == self.worksheet_name:
+                sheet_rid = sheet.get(f"{{{REL_NS}}}id")
+                break
+        if sheet_rid is None:
+            raise ValueError(f"Worksheet '{self.worksheet_name}' not found in the Excel file. Please check if the worksheet name has changed. It should be 'Itemized'")
+
+        sheet_part = self._resolve_rel(zin, "xl/workbook.xml", sheet_rid)
+
+        for table_part in self._rel_targets(zin, sheet_part, type_suffix="/table"):
+            table = ET.fromstring(zin.read(table_part))
+            if self.table_name in (table.get("name"), table.get("displayName")):
+                return sheet_part, table_part, date1904
+        raise ValueError(f"Table '{self.table_name}' not found in Excel file. Please check if the table name has changed. It should be 'ReceiptTable'")
+
+    @staticmethod
+    def _rels_path(part: str) -> str:
+        directory, name = posixpath.split(part)
+        return posixpath.join(directory, "_rels", f"{name}.rels")
+
+    def _relationships(self, zin: zipfile.ZipFile, part: str) -> Iterator[ET.Element]:
+        try:
+            rels = ET.fromstring(zin.read(self._rels_path(part)))
+        except KeyError:
+            return iter(())
+        return rels.iter(f"{{{PKG_REL_NS}}}Relationship")
+
+    @staticmethod
+    def _target_path(part: str, target: str) -> str:
+        if target.startswith("/"):
+            return target.lstrip("/")
+        return posixpath.normpath(posixpath.join(posixpath.dirname(part), target))
+
+    def _resolve_rel(self, zin: zipfile.ZipFile, part: str, rid: str) -> str:
+        for rel in self._relationships(zin, part):
+            if rel.get("Id") == rid:
+                return self._target_path(part, rel.get("Target"))
+        raise FastAppendUnavailable(f"relationship {rid} missing from {part}")
+
+    def _rel_targets(self, zin: zipfile.ZipFile, part: str, type_suffix: str) -> List[str]:
+        return [
+            self._target_path(part, rel.get("Target"))
+            for rel in self._relationships(zin, part)
+            if rel.get("Type", "").endswith(type_suffix)
+        ]
+
+    @staticmethod
+    def _table_ref(table_xml: bytes) -> str:
+        return ET.fromstring(table_xml).get("ref")
+
+    @staticmethod
+    def _set_defined_names(workbook_xml: bytes, names: Dict[str, str]) -> bytes:
+        """
+        Sets hidden workbook level defined names on the raw workbook xml, adding the definedNames element if needed.
+        """
+        # openpyxl saves an empty <definedNames />, which has to go before one with names is added, as a second
+        # definedNames element isn't valid (and openpyxl only reads the last one)
+        workbook_xml = _EMPTY_DEFINED_NAMES.sub(b"", workbook_xml)
+        for name, value in names.items():
+            element = f'<definedName name="{name}" hidden="1">{escape(value)}</definedName>'.encode("utf-8")
+            existing = re.compile(rb'<definedName\b[^>]*\bname="' + re.escape(name.encode("utf-8")) + rb'"[^>]*>.*?</definedName>', re.DOTALL)
+            if existing.search(workbook_xml):
+                workbook_xml = existing.sub(lambda m: element, workbook_xml, count=1)
+            elif b"</definedNames>" in workbook_xml:
+                workbook_xml = workbook_xml.replace(b"</definedNames>", element + b"</definedNames>", 1)
+            else:
+                # definedNames comes after sheets (and the rarely used functionGroups and externalReferences)
+                anchor = b"</sheets>"
+                for later in (b"</functionGroups>", b"</externalReferences>"):
+                    if later in workbook_xml:
+                        anchor = later
+                at = workbook_xml.index(anchor) + len(anchor)
+                workbook_xml = workbook_xml[:at] + b"<definedNames>" + element + b"</definedNames>" + workbook_xml[at:]
+        return workbook_xml
+
+    @staticmethod
+    def _set_table_ref(table_xml: bytes, new_ref: str) -> bytes:
+        """
+        Points both the table and its autofilter at the new ref. This is done on the raw xml so that
+        every namespace and attribute Excel wrote is left exactly as it was.
+        """
+        ref = new_ref.encode("ascii")
+        table_xml = re.sub(rb'(<table\b[^>]*?\sref=")[^"]*(")', lambda m: m.group(1) + ref + m.group(2), table_xml, count=1)
+        table_xml = re.sub(rb'(<autoFilter\b[^>]*?\sref=")[^"]*(")', lambda m: m.group(1) + ref + m.group(2), table_xml, count=1)
+        return table_xml
+
+
+class _SheetSplicer:
+    """
+    Streams the worksheet xml through, handing back chunks of output. Rows are copied through untouched
+    except for:
+      - the template row (the last row of the table), whose cell styles are copied onto the new rows
+      - existing rows in the range being written (the template has pre-formatted empty rows after the table),
+        which keep any cells outside of the table columns
+      - the dimension, which is widened to cover the new rows
+    """
+    def __init__(
+            self,
+            values: List[List[Any]],
+            template_row: int,
+            write_start: int,
+            first_col: int,
+            date1904: bool
+        ):
+        self.values = values
+        self.template_row = template_row
+        self.write_start = write_start
+        self.write_end = write_start + len(values) - 1
+        self.first_col = first_col
+        self.table_cols = range(first_col, first_col + max(len(v) for v in values))
+        self.epoch = datetime(1904, 1, 1) if date1904 else datetime(1899, 12, 30)
+
+        self.template_start_tag: Optional[bytes] = None
+        self.template_styles: Dict[int, bytes] = {}
+        self.next_new = write_start
+
+    def run(self, src) -> Iterator[bytes]:
+        buf = b""
+        pos = 0
+
+        def fill() -> bool:
+            # drop what has already been handed back, and read the next chunk
+            nonlocal buf, pos
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                return False
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+
+        # everything up to the start of sheetData, which holds the dimension
+        while (head_end := buf.find(b"<sheetData", pos)) == -1:
+            if not fill():
+                raise FastAppendUnavailable("worksheet has no sheetData")
+        yield self._patch_dimension(buf[pos:head_end])
+        pos = head_end
+        while (tag_end := buf.find(b">", pos)) == -1:
+            if not fill():
+                raise FastAppendUnavailable("worksheet xml ended inside sheetData")
+        tag_end += 1
+        if buf[tag_end - 2:tag_end] == b"/>":
+            raise FastAppendUnavailable("worksheet has no rows")
+        yield buf[pos:tag_end]
+        pos = tag_end
+
+        # every row before the last row of the table is copied through in bulk, without looking at it
+        marker = f'<row r="{self.template_row}"'.encode("ascii")
+        close_tag = b"</sheetData>"
+        while True:
+            found = buf.find(marker, pos)
+            close_at = buf.find(close_tag, pos)
+            if found != -1 and (close_at == -1 or found < close_at):
+                yield buf[pos:found]
+                pos = found
+                break
+            if close_at != -1:
+                raise FastAppendUnavailable("last table row not found in the worksheet")
+            # keep a little back in case the marker is split across chunks
+            keep_from = max(pos, len(buf) - max(len(marker), len(close_tag)))
+            yield buf[pos:keep_from]
+            pos = keep_from
+            if not fill():
+                raise FastAppendUnavailable("worksheet xml ended inside sheetData")
+
+        # from the last table row on, go row by row
+        while True:
+            row_at = buf.find(b"<row", pos)
+            close_at = buf.find(close_tag, pos, row_at if row_at != -1 else len(buf))
+            if close_at != -1:
+                yield buf[pos:close_at]
+                yield self._new_rows_before(None)
+                yield buf[close_at:]
+                buf, pos = b"", 0
+                while fill():
+                    yield buf
+                    buf = b""
+                return
+            if row_at == -1:
+                keep_from = max(pos, len(buf) - len(close_tag))
+                yield buf[pos:keep_from]
+                pos = keep_from
+                if not fill():
+                    raise FastAppendUnavailable("worksheet xml ended inside sheetData")
+                continue
+            yield buf[pos:row_at]
+            pos = row_at
+
+            row_end = -1
+            while row_end == -1:
+                start_end = buf.find(b">", pos)
+                if start_end != -1 and buf[start_end - 1:start_end] == b"/":
+                    row_end = start_end + 1
+                elif start_end != -1 and (close_row := buf.find(b"</row>", start_end)) != -1:
+                    row_end = close_row + len(b"</row>")
+                elif not fill():
+                    raise FastAppendUnavailable("worksheet xml ended inside a row")
+            yield self._handle_row(buf[pos:row_end])
+            pos = row_end
+
+    def _handle_row(self, row_xml: bytes) -> bytes:
+        start_tag = row_xml[:row_xml.index(b">") + 1]
+        m = _ROW_R.search(start_tag)
+        if m is None:
+            # rows without a number can't be placed, so let openpyxl deal with this workbook
+            raise FastAppendUnavailable("row without an r attribute")
+        r = int(m.group(1))
+
+        if r == self.template_row:
+            self._capture_template(row_xml)
+        if r < self.write_start:
+            return row_xml
+
+        out = self._new_rows_before(r)
+        if r <= self.write_end:
+            out += self._replace_row(r, row_xml)
+            self.next_new = r + 1
+        else:
+            out += row_xml
+        return out
+
+    def _capture_template(self, row_xml: bytes):
+        if b"<v>" not in row_xml and b"<is>" not in row_xml:
+            # the fresh template has one empty, pre-formatted row in the table that gets written over
+            # instead of appended after, which openpyxl handles
+            raise FastAppendUnavailable("last table row is empty")
+        start_tag = row_xml[:row_xml.index(b">") + 1]
+        if start_tag.endswith(b"/>"):
+            start_tag = start_tag[:-2] + b">"
+        self.template_start_tag = start_tag
+        for cell in _CELL.finditer(row_xml):
+            style = _STYLE.search(cell.group(0)[:cell.group(0).index(b">") + 1])
+            if style:
+                self.template_styles[column_index(cell.group(1).decode())] = style.group(1)
+
+    def _new_rows_before(self, r: Optional[int]) -> bytes:
+        """
+        Builds every new row that has no existing row element and comes before row r (or all of them if r is None)
+        """
+        out = []
+        last = self.write_end if r is None else min(self.write_end, r - 1)
+        while self.next_new <= last:
+            out.append(self._build_row(self.next_new, start_tag=None, kept_cells=[]))
+            self.next_new += 1
+        return b"".join(out)
+
+    def _replace_row(self, r: int, row_xml: bytes) -> bytes:
+        start_tag = row_xml[:row_xml.index(b">") + 1]
+        if start_tag.endswith(b"/>"):
+            start_tag = start_tag[:-2] + b">"
+        # spans is only a hint, and it no longer matches once the table cells are in
+        start_tag = _SPANS.sub(b"", start_tag)
+        kept = [
+            (column_index(cell.group(1).decode()), cell.group(0))
+            for cell in _CELL.finditer(row_xml)
+            if column_index(cell.group(1).decode()) not in self.table_cols
+        ]
+        return self._build_row(r, start_tag=start_tag, kept_cells=kept)
+
+    def _build_row(self, r: int, start_tag: Optional[bytes], kept_cells: List[Tuple[int, bytes]]) -> bytes:
+        if self.template_start_tag is None:
+            raise FastAppendUnavailable("last table row not found in the worksheet")
+        if start_tag is None:
+            start_tag = _ROW_R.sub(f'r="{r}"'.encode("ascii"), self.template_start_tag, count=1)
+        values = self.values[r - self.write_start]
+        cells = list(kept_cells)
+        for offset, value in enumerate(values):
+            col = self.first_col + offset
+            cells.append((col, self._build_cell(f"{column_letter(col)}{r}", value, self.template_styles.get(col))))
+        cells.sort(key=lambda c: c[0])
+        return start_tag + b"".join(c for _, c in cells) + b"</row>"
+
+    def _build_cell(self, ref: str, value: Any, style: Optional[bytes]) -> bytes:
+        attrs = f'r="{ref}"'.encode("ascii")
+        if style is not None:
+            attrs += b' s="' + style + b'"'
+        if value is None:
+            return b"<c " + attrs + b"/>"
+        if isinstance(value, bool):
+            return b"<c " + attrs + b' t="b"><v>' + (b"1" if value else b"0") + b"</v></c>"
+        if isinstance(value, (datetime, date)):
+            return b"<c " + attrs + b"><v>" + repr(self._to_serial(value)).encode("ascii") + b"</v></c>"
+        if isinstance(value, (int, float)):
+            return b"<c " + attrs + b"><v>" + repr(value).encode("ascii") + b"</v></c>"
+        # inline strings, so the shared string table doesn't have to be rewritten
+        text = str(value)
+        space = ' xml:space="preserve"' if text != text.strip() else ""
+        return b"<c " + attrs + b' t="inlineStr"><is><t' + space.encode("ascii") + b">" + escape(text).encode("utf-8") + b"</t></is></c>"
+
+    def _to_serial(self, value) -> float:
+        if not isinstance(value, datetime):
+            value = datetime(value.year, value.month, value.day)
+        value = value.replace(tzinfo=None)
+        serial = (value - self.epoch).total_seconds() / 86400.0
+        return int(serial) if serial == int(serial) else serial
+
+    def _patch_dimension(self, head: bytes) -> bytes:
+        def widen(m):
+            start_col, start_row, end_col, end_row = m.group(1), m.group(2), m.group(3), m.group(4)
+            end_col = end_col or start_col
+            end_row = max(int(end_row or start_row), self.write_end)
+            return b'<dimension ref="' + start_col + start_row + b":" + end_col + str(end_row).encode("ascii") + b'"/>'
+        return _DIMENSION.sub(widen, head, count=1)